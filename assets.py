@@ -0,0 +1,71 @@
+from dagster import (
+    AssetDep,
+    AssetExecutionContext,
+    HourlyPartitionsDefinition,
+    TimeWindowPartitionMapping,
+    asset,
+)
+from common import connect_to_postgres
+from settings import env_str
+import profiling
+from ingest_etl import partition_key_to_hour_folders, process_dataset_partition
+
+# One partition per raw_data/date=YYYY-MM-DD/hour=HH folder
+hourly_partitions = HourlyPartitionsDefinition(
+    start_date=env_str("ASSET_PARTITIONS_START", "2022-01-01-00:00")
+)
+
+# Products, customers and erasure requests are applied hour by hour, in order,
+# so each of their partitions waits for the partition of the previous hour.
+# For products this lets the values of a later hour overwrite those of
+# earlier hours for the same SKU.
+# Transactions are validated against all customers and products loaded so
+# far, so through these chains they wait for every earlier hour of both.
+previous_hour = TimeWindowPartitionMapping(start_offset=-1, end_offset=-1)
+
+
+def materialize_partition(context: AssetExecutionContext, dataset_prefix: str) -> None:
+    # Hourly profiles of the run, if enabled, go to the run's directory
+    profiling.configure(run_id=context.run_id)
+    date_folder, hour_folder = partition_key_to_hour_folders(context.partition_key)
+    with connect_to_postgres() as connection:
+        raw_files = process_dataset_partition(
+            connection, dataset_prefix, date_folder, hour_folder
+        )
+    context.add_output_metadata({"raw_files": len(raw_files)})
+
+
+@asset(
+    partitions_def=hourly_partitions,
+    deps=[AssetDep("products", partition_mapping=previous_hour)],
+)
+def products(context: AssetExecutionContext) -> None:
+    materialize_partition(context, "products")
+
+
+@asset(
+    partitions_def=hourly_partitions,
+    deps=[products, AssetDep("customers", partition_mapping=previous_hour)],
+)
+def customers(context: AssetExecutionContext) -> None:
+    materialize_partition(context, "customers")
+
+
+@asset(partitions_def=hourly_partitions, deps=[products, customers])
+def transactions(context: AssetExecutionContext) -> None:
+    materialize_partition(context, "transactions")
+
+
+@asset(
+    partitions_def=hourly_partitions,
+    deps=[
+        customers,
+        transactions,
+        AssetDep("erasure_requests", partition_mapping=previous_hour),
+    ],
+)
+def erasure_requests(context: AssetExecutionContext) -> None:
+    materialize_partition(context, "erasure")
+
+
+hourly_assets = [products, customers, transactions, erasure_requests]
@@ -0,0 +1,255 @@
+"""
+End-to-end benchmarks of the four pipelines on synthetic raw data.
+
+Runs extraction, validation, loading and erasure, and whole pipeline hours,
+against the in-memory PostgreSQL stand-in, so only the Python side is
+measured. Needs pytest-benchmark; the file is not collected by a plain
+`pytest` run. Run from the project root:
+
+    pytest benchmarks/bench_pipelines.py --benchmark-json=benchmark.json
+
+BENCH_SCALE (default 1) multiplies the number of generated records. Each
+benchmark's extra_info holds its records/sec and the peak memory of one
+extra run; whole-hour benchmarks add records/sec per pipeline stage.
+"""
+
+import copy
+import os
+import resource
+import shutil
+import tracemalloc
+from typing import Any, Callable, Dict, Tuple
+from unittest.mock import patch
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import customers_etl  # noqa: E402
+import erasure_requests_etl  # noqa: E402
+import products_etl  # noqa: E402
+import transactions_etl  # noqa: E402
+from benchmarks.generate_raw_data import GeneratorConfig, generate_raw_data  # noqa: E402
+from benchmarks.stub_postgres import StubConnection  # noqa: E402
+from common import extract_data, iter_records  # noqa: E402
+
+BENCH_SCALE = float(os.getenv("BENCH_SCALE", "1"))
+
+CONFIG = GeneratorConfig(
+    hours=2,
+    products_per_hour=int(200 * BENCH_SCALE),
+    customers_per_hour=int(2000 * BENCH_SCALE),
+    transactions_per_hour=int(10000 * BENCH_SCALE),
+    erasure_requests_per_hour=int(50 * BENCH_SCALE),
+)
+
+DATE = "date=2022-01-01"
+HOUR = "hour=01"
+
+PIPELINES = {
+    "products": (products_etl, "products.json.gz"),
+    "customers": (customers_etl, "customers.json.gz"),
+    "transactions": (transactions_etl, "transactions.json.gz"),
+    "erasure": (erasure_requests_etl, "erasure-requests.json.gz"),
+}
+
+
+@pytest.fixture(scope="module")
+def raw_data(tmp_path_factory):
+    raw_data_path = str(tmp_path_factory.mktemp("raw_data"))
+    return raw_data_path, generate_raw_data(raw_data_path, CONFIG)
+
+
+@pytest.fixture
+def connection(raw_data):
+    _, generated = raw_data
+    return StubConnection(generated.customer_locations, generated.skus)
+
+
+@pytest.fixture
+def data_paths(tmp_path, raw_data):
+    """
+    Point every pipeline at a fresh copy of the raw data tree.
+    """
+    paths = {
+        "RAW_DATA_PATH": str(tmp_path / "raw_data"),
+        "PROCESSED_DATA_PATH": str(tmp_path / "processed_data"),
+        "ARCHIVED_DATA_PATH": str(tmp_path / "archived_data"),
+    }
+    shutil.copytree(raw_data[0], paths["RAW_DATA_PATH"])
+    with patch("common.advance_ingest_watermark"):
+        patches = [
+            patch.object(module, name, path)
+            for module, _ in PIPELINES.values()
+            for name, path in paths.items()
+        ]
+        for module_patch in patches:
+            module_patch.start()
+        yield paths
+        for module_patch in patches:
+            module_patch.stop()
+
+
+def raw_file(raw_data: Tuple[str, Any], file_name: str) -> str:
+    return os.path.join(raw_data[0], DATE, HOUR, file_name)
+
+
+def peak_memory(function: Callable[[], Any]) -> Dict[str, int]:
+    """
+    Run a function once more under tracemalloc.
+
+    Returns:
+        Dict[str, int]: The peak of Python allocations during the run, and the
+            peak resident set size of the whole process so far.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "tracemalloc_peak_bytes": peak,
+        # ru_maxrss is in kilobytes on Linux
+        "process_max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        * 1024,
+    }
+
+
+def report(benchmark: Any, record_count: int, function: Callable[[], Any]) -> None:
+    benchmark.extra_info["records"] = record_count
+    benchmark.extra_info["records_per_second"] = round(
+        record_count / benchmark.stats.stats.median
+    )
+    benchmark.extra_info.update(peak_memory(function))
+
+
+def test_extract_transactions(benchmark, raw_data):
+    file_path = raw_file(raw_data, "transactions.json.gz")
+
+    def extract():
+        return sum(1 for _ in iter_records(file_path))
+
+    record_count = benchmark(extract)
+
+    report(benchmark, record_count, extract)
+
+
+@pytest.mark.parametrize(
+    "module, file_name, validate",
+    [
+        (products_etl, "products.json.gz", "transform_and_validate_products"),
+        (customers_etl, "customers.json.gz", "transform_and_validate_customers"),
+        (
+            transactions_etl,
+            "transactions.json.gz",
+            "transform_and_validate_transactions",
+        ),
+    ],
+    ids=["products", "customers", "transactions"],
+)
+def test_validate(benchmark, raw_data, connection, module, file_name, validate):
+    records = extract_data(raw_file(raw_data, file_name))
+    validate = getattr(module, validate)
+
+    def setup():
+        # Validation updates records in place
+        return (connection, copy.deepcopy(records), DATE, HOUR), {}
+
+    benchmark.pedantic(validate, setup=setup, rounds=5)
+
+    report(benchmark, len(records), lambda: validate(*setup()[0]))
+
+
+def test_load_transactions(benchmark, raw_data, connection):
+    transactions = transactions_etl.transform_and_validate_transactions(
+        connection,
+        extract_data(raw_file(raw_data, "transactions.json.gz")),
+        DATE,
+        HOUR,
+    )
+
+    def load():
+        transactions_etl.log_processed_transactions(
+            connection, DATE, HOUR, transactions
+        )
+
+    benchmark(load)
+
+    report(benchmark, len(transactions), load)
+
+
+def test_erasure(benchmark, raw_data, connection, data_paths):
+    # Erasure rewrites the processed customers of the first hour
+    customers_etl.process_hourly_data(
+        connection, DATE, "hour=00", ["customers.json.gz"]
+    )
+    processed = data_paths["PROCESSED_DATA_PATH"]
+    pristine = processed + ".pristine"
+    shutil.copytree(processed, pristine)
+    requests = erasure_requests_etl.transform_and_validate_erasure_requests(
+        connection,
+        extract_data(raw_file(raw_data, "erasure-requests.json.gz")),
+        DATE,
+        HOUR,
+    )
+
+    def setup():
+        shutil.rmtree(processed)
+        shutil.copytree(pristine, processed)
+        return (connection, requests, DATE, HOUR), {}
+
+    benchmark.pedantic(
+        erasure_requests_etl.process_erasure_requests, setup=setup, rounds=5
+    )
+
+    report(
+        benchmark,
+        len(requests),
+        lambda: erasure_requests_etl.process_erasure_requests(*setup()[0]),
+    )
+
+
+@pytest.mark.parametrize("dataset", list(PIPELINES))
+def test_pipeline_hour(benchmark, raw_data, connection, data_paths, dataset):
+    module, file_name = PIPELINES[dataset]
+    raw_hour_path = os.path.join(data_paths["RAW_DATA_PATH"], DATE, HOUR)
+    pristine_hour_path = os.path.join(raw_data[0], DATE, HOUR)
+    if dataset == "erasure":
+        customers_etl.process_hourly_data(
+            connection, DATE, "hour=00", ["customers.json.gz"]
+        )
+    processed = data_paths["PROCESSED_DATA_PATH"]
+    os.makedirs(processed, exist_ok=True)
+    pristine_processed = processed + ".pristine"
+    shutil.copytree(processed, pristine_processed)
+
+    stages = []
+
+    def capture_statistics(*args, **kwargs):
+        stages.append(kwargs["stages"])
+
+    def setup():
+        # The hour's raw file is archived and processed files are rewritten
+        shutil.copy(
+            os.path.join(pristine_hour_path, file_name),
+            os.path.join(raw_hour_path, file_name),
+        )
+        shutil.rmtree(processed)
+        shutil.copytree(pristine_processed, processed)
+        return (connection, DATE, HOUR, [file_name]), {}
+
+    with patch.object(module, "log_processing_statistics", capture_statistics):
+        benchmark.pedantic(module.process_hourly_data, setup=setup, rounds=3)
+        report(
+            benchmark,
+            raw_data[1].record_counts[file_name] // CONFIG.hours,
+            lambda: module.process_hourly_data(*setup()[0]),
+        )
+
+    for name, counters in stages[-1].stages.items():
+        if counters["duration_ns"]:
+            rows = counters["rows_in"] or counters["rows_out"]
+            benchmark.extra_info[f"{name}_records_per_second"] = round(
+                rows / (counters["duration_ns"] / 1e9)
+            )
@@ -0,0 +1,125 @@
+"""
+Micro-benchmark of the JSON codecs used to read and write NDJSON files.
+
+Builds a synthetic hourly transactions file and measures how many records per
+second each installed codec decodes and encodes. Run from the project root:
+
+    python -m benchmarks.codec_benchmark --records 50000
+"""
+
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from common import JSON_CODECS, get_json_codec
+
+
+def synthetic_transaction(
+    rng: random.Random,
+    customer_count: int,
+    customer_ids: Optional[Sequence[str]] = None,
+    skus: Optional[Sequence[int]] = None,
+    max_purchases: int = 5,
+    transaction_time: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    """
+    Build one transaction record that follows transactions_schema.json.
+
+    Args:
+        rng (random.Random): The random number generator.
+        customer_count (int): The number of distinct customer IDs to draw from.
+        customer_ids (Optional[Sequence[str]]): Customer IDs to draw from instead.
+        skus (Optional[Sequence[int]]): Product SKUs to draw from, any SKU if None.
+        max_purchases (int): The maximum number of products purchased.
+        transaction_time (Optional[datetime]): The start of the hour of the
+            transaction, 2020-01-01T10:00 if None.
+
+    Returns:
+        Dict[str, Any]: The transaction record.
+    """
+    products = []
+    for _ in range(rng.randint(1, max_purchases)):
+        quantity = rng.randint(1, 10)
+        price = round(rng.uniform(1, 500), 2)
+        products.append(
+            {
+                "sku": rng.choice(skus) if skus else rng.randint(1, 100000),
+                "quanitity": quantity,
+                "price": f"{price:.2f}",
+                "total": f"{price * quantity:.2f}",
+            }
+        )
+    transaction_time = (transaction_time or datetime(2020, 1, 1, 10)) + timedelta(
+        seconds=rng.randint(0, 3599)
+    )
+    return {
+        "transaction_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "transaction_time": transaction_time.isoformat(),
+        "customer_id": (
+            rng.choice(customer_ids)
+            if customer_ids
+            else str(rng.randint(1, customer_count))
+        ),
+        "delivery_address": {
+            "address": f"{rng.randint(1, 200)} Ilica",
+            "postcode": f"{rng.randint(10000, 99999)}",
+            "city": "Zagreb",
+            "country": "Croatia",
+        },
+        "purchases": {
+            "products": products,
+            "total_cost": "%.2f" % sum(float(p["total"]) for p in products),
+        },
+    }
+
+
+def measure(function: Callable[[], Any], record_count: int, repeat: int) -> float:
+    """
+    Run a function a few times and return the best throughput in records/sec.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return record_count / best
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    records = [synthetic_transaction(rng, 10000) for _ in range(args.records)]
+    _, _, stdlib_dumps_line = get_json_codec("json")
+    lines = [stdlib_dumps_line(record) for record in records]
+
+    print(f"{args.records} synthetic transactions, best of {args.repeat} runs")
+    print(f"{'codec':<10}{'decode rec/s':>16}{'encode rec/s':>16}")
+    baseline = None
+    for name in JSON_CODECS:
+        _, loads, dumps_line = get_json_codec(name)
+        decode = measure(
+            lambda: [loads(line) for line in lines], len(lines), args.repeat
+        )
+        encode = measure(
+            lambda: b"".join(dumps_line(record) for record in records),
+            len(records),
+            args.repeat,
+        )
+        if baseline is None:
+            baseline = (decode, encode)
+        print(
+            f"{name:<10}{decode:>16,.0f}{encode:>16,.0f}"
+            f"   ({decode / baseline[0]:.1f}x / {encode / baseline[1]:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
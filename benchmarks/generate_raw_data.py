@@ -0,0 +1,362 @@
+"""
+Generator of synthetic raw_data trees for benchmarks.
+
+Writes date=YYYY-MM-DD/hour=HH partitions of products, customers,
+transactions and erasure requests that follow the JSON schemas of the
+project, with a configurable share of invalid and duplicate records. Run
+from the project root:
+
+    python -m benchmarks.generate_raw_data --output /tmp/raw_data --days 1 --hours 4
+"""
+
+import argparse
+import gzip
+import os
+import random
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from benchmarks.codec_benchmark import synthetic_transaction
+from common import get_json_codec
+
+CATEGORIES = ["books", "electronics", "garden", "toys", "clothing", "food"]
+COUNTRIES = ["Croatia", "Slovenia", "Austria", "Germany", "Italy"]
+KEY_FIELDS = {"id", "sku", "transaction_id", "customer-id"}
+
+
+class GeneratorConfig(NamedTuple):
+    start_date: date = date(2022, 1, 1)
+    days: int = 1
+    hours: int = 24
+    products_per_hour: int = 100
+    customers_per_hour: int = 1000
+    transactions_per_hour: int = 5000
+    erasure_requests_per_hour: int = 10
+    invalid_ratio: float = 0.05
+    duplicate_ratio: float = 0.02
+    max_purchases: int = 5
+    seed: int = 0
+
+
+DEFAULTS = GeneratorConfig()
+
+
+class GeneratedData(NamedTuple):
+    # (date folder, hour folder) of every generated partition, oldest first
+    partitions: List[Tuple[str, str]]
+    # Record counts per dataset file name, over all partitions
+    record_counts: Dict[str, int]
+    # Valid customer IDs with the date and hour of their record
+    customer_locations: Dict[int, Tuple[date, int]]
+    # Valid product SKUs
+    skus: List[int]
+
+
+def synthetic_product(rng: random.Random, sku: int) -> Dict[str, Any]:
+    """
+    Build one product record that follows products_schema.json, with the
+    price as a string like the raw files have it.
+
+    Args:
+        rng (random.Random): The random number generator.
+        sku (int): The SKU of the product.
+
+    Returns:
+        Dict[str, Any]: The product record.
+    """
+    return {
+        "sku": sku,
+        "name": f"Product {sku}",
+        "price": f"{rng.uniform(1, 500):.2f}",
+        "category": rng.choice(CATEGORIES),
+        "popularity": round(rng.uniform(0.01, 1), 3),
+    }
+
+
+def synthetic_customer(
+    rng: random.Random, customer_id: int, last_change: datetime
+) -> Dict[str, Any]:
+    """
+    Build one customer record that follows customer_schema.json.
+
+    Args:
+        rng (random.Random): The random number generator.
+        customer_id (int): The ID of the customer.
+        last_change (datetime): The time of the record.
+
+    Returns:
+        Dict[str, Any]: The customer record.
+    """
+    birth = date(1950, 1, 1) + timedelta(days=rng.randint(0, 20000))
+    return {
+        "id": str(customer_id),
+        "first_name": rng.choice(["Ana", "Ivan", "Marko", "Petra", "Luka", "Maja"]),
+        "last_name": rng.choice(["Horvat", "Kovač", "Babić", "Marić", "Novak"]),
+        "date_of_birth": birth.isoformat() if rng.random() > 0.1 else None,
+        "email": f"customer{customer_id}@example.com",
+        "phone_number": f"+385 91 {rng.randint(1000000, 9999999)}",
+        "address": f"{rng.randint(1, 200)} Ilica",
+        "city": "Zagreb",
+        "country": rng.choice(COUNTRIES),
+        "postcode": f"{rng.randint(10000, 99999)}",
+        "last_change": last_change.isoformat(),
+        "segment": rng.choice(["regular", "premium", None]),
+    }
+
+
+def invalidate(rng: random.Random, record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Make a record fail schema validation by dropping a field or changing its type.
+
+    Broken values stay scalars, so invalid records can still be logged to
+    their tables.
+
+    Args:
+        rng (random.Random): The random number generator.
+        record (Dict[str, Any]): A valid record.
+
+    Returns:
+        Dict[str, Any]: An invalid copy of the record.
+    """
+    record = dict(record)
+    # Invalid records are logged by their key, so the key itself stays intact
+    field = rng.choice(sorted(set(record) - KEY_FIELDS))
+    if rng.random() < 0.5 or not isinstance(record[field], str):
+        del record[field]
+        # Optional fields can go missing legitimately, so add an unknown one too
+        record["unexpected"] = True
+    else:
+        record[field] = rng.randint(1, 1000)
+    return record
+
+
+def with_noise(
+    rng: random.Random,
+    records: List[Dict[str, Any]],
+    invalid_ratio: float,
+    duplicate_ratio: float,
+    make_invalid: Callable[
+        [random.Random, Dict[str, Any]], Dict[str, Any]
+    ] = invalidate,
+) -> List[Dict[str, Any]]:
+    """
+    Replace a share of records by invalid ones and repeat a share of them.
+
+    Args:
+        rng (random.Random): The random number generator.
+        records (List[Dict[str, Any]]): Valid records.
+        invalid_ratio (float): The share of records made invalid.
+        duplicate_ratio (float): The share of records repeated later in the file.
+        make_invalid (Callable): Builds an invalid record from a valid one.
+
+    Returns:
+        List[Dict[str, Any]]: The records with noise, in file order.
+    """
+    noisy = [
+        make_invalid(rng, record) if rng.random() < invalid_ratio else record
+        for record in records
+    ]
+    duplicates = [dict(record) for record in records if rng.random() < duplicate_ratio]
+    for duplicate in duplicates:
+        noisy.insert(rng.randint(0, len(noisy)), duplicate)
+    return noisy
+
+
+def invalid_product(rng: random.Random, record: Dict[str, Any]) -> Dict[str, Any]:
+    # The products pipeline parses the price before validating, so the price
+    # and popularity are made non-positive rather than of the wrong type
+    record = dict(record)
+    field = rng.choice(["price", "popularity", "category"])
+    if field == "price":
+        record["price"] = "0"
+    elif field == "popularity":
+        record["popularity"] = 0
+    else:
+        del record["category"]
+    return record
+
+
+def invalid_transaction(rng: random.Random, record: Dict[str, Any]) -> Dict[str, Any]:
+    # Transactions also fail on unknown customers and wrong totals, not only on the schema
+    choice = rng.random()
+    if choice < 0.4:
+        return invalidate(rng, record)
+    record = dict(record)
+    if choice < 0.7:
+        record["customer_id"] = str(10**9 + rng.randint(0, 10**6))
+    else:
+        purchases = dict(record["purchases"])
+        purchases["total_cost"] = f"{float(purchases['total_cost']) + 1:.2f}"
+        record["purchases"] = purchases
+    return record
+
+
+def write_ndjson_gz(file_path: str, records: List[Dict[str, Any]]) -> None:
+    _, _, dumps_line = get_json_codec()
+    # Level 1 keeps generation fast; readers don't care about the level
+    with gzip.open(file_path, "wb", compresslevel=1) as file:
+        for record in records:
+            file.write(dumps_line(record))
+
+
+def generate_raw_data(output: str, config: GeneratorConfig) -> GeneratedData:
+    """
+    Write a synthetic raw_data tree.
+
+    Transactions only reference customers and products of the same or earlier
+    hours, so they validate once those hours are loaded. Erasure requests
+    target customers of earlier hours.
+
+    Args:
+        output (str): The root of the raw_data tree to write.
+        config (GeneratorConfig): What to generate.
+
+    Returns:
+        GeneratedData: The partitions, record counts and valid reference keys.
+    """
+    rng = random.Random(config.seed)
+    partitions = []
+    record_counts = {
+        "products.json.gz": 0,
+        "customers.json.gz": 0,
+        "transactions.json.gz": 0,
+        "erasure-requests.json.gz": 0,
+    }
+    customer_locations: Dict[int, Tuple[date, int]] = {}
+    customer_ids: List[str] = []
+    skus: List[int] = []
+    erased = set()
+
+    for day in range(config.days):
+        partition_date = config.start_date + timedelta(days=day)
+        for hour in range(config.hours):
+            date_folder = f"date={partition_date.isoformat()}"
+            hour_folder = f"hour={hour:02d}"
+            hour_path = os.path.join(output, date_folder, hour_folder)
+            os.makedirs(hour_path, exist_ok=True)
+            partitions.append((date_folder, hour_folder))
+            hour_start = datetime(
+                partition_date.year, partition_date.month, partition_date.day, hour
+            )
+
+            products = []
+            for _ in range(config.products_per_hour):
+                sku = len(skus) + 1
+                skus.append(sku)
+                products.append(synthetic_product(rng, sku))
+
+            earlier_customer_count = len(customer_ids)
+            customers = []
+            for _ in range(config.customers_per_hour):
+                customer_id = len(customer_locations) + 1
+                customer_locations[customer_id] = (partition_date, hour)
+                customer_ids.append(str(customer_id))
+                customers.append(synthetic_customer(rng, customer_id, hour_start))
+
+            transactions = (
+                [
+                    synthetic_transaction(
+                        rng,
+                        len(customer_ids),
+                        customer_ids=customer_ids,
+                        skus=skus,
+                        max_purchases=config.max_purchases,
+                        transaction_time=hour_start,
+                    )
+                    for _ in range(config.transactions_per_hour)
+                ]
+                if customer_ids and skus
+                else []
+            )
+
+            erasure_requests = []
+            for customer_id in rng.sample(
+                customer_ids[:earlier_customer_count],
+                min(config.erasure_requests_per_hour, earlier_customer_count),
+            ):
+                if customer_id not in erased:
+                    erased.add(customer_id)
+                    erasure_requests.append(
+                        {
+                            "customer-id": customer_id,
+                            "email": f"customer{customer_id}@example.com",
+                        }
+                    )
+
+            files = {
+                "products.json.gz": with_noise(
+                    rng,
+                    products,
+                    config.invalid_ratio,
+                    config.duplicate_ratio,
+                    invalid_product,
+                ),
+                "customers.json.gz": with_noise(
+                    rng, customers, config.invalid_ratio, config.duplicate_ratio
+                ),
+                "transactions.json.gz": with_noise(
+                    rng,
+                    transactions,
+                    config.invalid_ratio,
+                    config.duplicate_ratio,
+                    invalid_transaction,
+                ),
+                "erasure-requests.json.gz": erasure_requests,
+            }
+            for file_name, records in files.items():
+                if records:
+                    write_ndjson_gz(os.path.join(hour_path, file_name), records)
+                    record_counts[file_name] += len(records)
+
+    return GeneratedData(partitions, record_counts, customer_locations, skus)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--output", required=True)
+    parser.add_argument(
+        "--start-date", type=date.fromisoformat, default=DEFAULTS.start_date
+    )
+    parser.add_argument("--days", type=int, default=DEFAULTS.days)
+    parser.add_argument("--hours", type=int, default=DEFAULTS.hours)
+    parser.add_argument("--products", type=int, default=DEFAULTS.products_per_hour)
+    parser.add_argument("--customers", type=int, default=DEFAULTS.customers_per_hour)
+    parser.add_argument(
+        "--transactions", type=int, default=DEFAULTS.transactions_per_hour
+    )
+    parser.add_argument(
+        "--erasure-requests",
+        type=int,
+        default=DEFAULTS.erasure_requests_per_hour,
+    )
+    parser.add_argument("--invalid-ratio", type=float, default=DEFAULTS.invalid_ratio)
+    parser.add_argument(
+        "--duplicate-ratio", type=float, default=DEFAULTS.duplicate_ratio
+    )
+    parser.add_argument("--max-purchases", type=int, default=DEFAULTS.max_purchases)
+    parser.add_argument("--seed", type=int, default=DEFAULTS.seed)
+    args = parser.parse_args(argv)
+
+    generated = generate_raw_data(
+        args.output,
+        GeneratorConfig(
+            start_date=args.start_date,
+            days=args.days,
+            hours=args.hours,
+            products_per_hour=args.products,
+            customers_per_hour=args.customers,
+            transactions_per_hour=args.transactions,
+            erasure_requests_per_hour=args.erasure_requests,
+            invalid_ratio=args.invalid_ratio,
+            duplicate_ratio=args.duplicate_ratio,
+            max_purchases=args.max_purchases,
+            seed=args.seed,
+        ),
+    )
+    print(f"{len(generated.partitions)} partitions written to {args.output}")
+    for file_name, count in generated.record_counts.items():
+        print(f"{file_name:<28}{count:>12,}")
+
+
+if __name__ == "__main__":
+    main()
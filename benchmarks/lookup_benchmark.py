@@ -0,0 +1,321 @@
+"""
+Benchmark of the lookup queries of the pipelines before and after the
+lookup index migration.
+
+Creates the tables of init.sql in a scratch schema of the configured
+database (POSTGRES_* and DB_* variables, as for the pipelines), seeds them,
+times each lookup, applies sql-scripts/migration_001_lookup_indexes.sql to
+the same schema and times them again. The scratch schema is dropped at the
+end and the data schema is never touched. Run from the project root:
+
+    python -m benchmarks.lookup_benchmark --customers 200000 --transactions 500000
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import re
+import statistics
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from common import connect_to_postgres
+
+SQL_SCRIPTS_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql-scripts"
+)
+INIT_SCRIPT = "init.sql"
+MIGRATION_SCRIPT = "migration_001_lookup_indexes.sql"
+
+START_DATE = date(2022, 1, 1)
+
+SEEDED_TABLES = (
+    "customers",
+    "products",
+    "erasure_requests",
+    "transactions",
+    "delivery_addresses",
+    "purchases",
+)
+
+
+class Lookup(NamedTuple):
+    name: str
+    # Query with a {schema} placeholder and %s parameters
+    query: str
+    # Builds the parameters of one execution
+    params: Any
+
+
+def in_schema(sql: str, schema: str) -> str:
+    """
+    Point a SQL script written for the data schema at another schema.
+
+    Args:
+        sql (str): The SQL script.
+        schema (str): The schema to use instead of data.
+
+    Returns:
+        str: The rewritten SQL script.
+    """
+    sql = re.sub(
+        r"\bSCHEMA IF NOT EXISTS data\b", f"SCHEMA IF NOT EXISTS {schema}", sql
+    )
+    return re.sub(r"\bdata\.", f"{schema}.", sql)
+
+
+def run_script(connection: Any, file_name: str, schema: str) -> None:
+    with open(os.path.join(SQL_SCRIPTS_PATH, file_name)) as file:
+        sql = in_schema(file.read(), schema)
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+    connection.commit()
+
+
+def product_count(customers: int) -> int:
+    return max(customers // 10, 1)
+
+
+def seeded_transaction_id(i: int) -> str:
+    # Transactions are seeded with md5(i)::uuid as their ID
+    return str(uuid.UUID(hashlib.md5(str(i).encode()).hexdigest()))
+
+
+def seed(connection: Any, schema: str, customers: int, transactions: int) -> None:
+    """
+    Fill the scratch schema with hourly customers, products and transactions.
+
+    Records are spread over the hours of 30 days; every transaction has one
+    delivery address and three purchases, and one customer in a hundred has an
+    erasure request.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        schema (str): The scratch schema.
+        customers (int): The number of customers.
+        transactions (int): The number of transactions.
+    """
+    hours = 30 * 24
+    products = product_count(customers)
+    statements = [
+        f"""
+        INSERT INTO {schema}.customers (id, first_name, last_name, email, record_date, record_hour, processed_at)
+        SELECT i, 'First', 'Last', 'customer' || i || '@example.com',
+            DATE '{START_DATE}' + ((i % {hours}) / 24), (i % {hours}) % 24,
+            TIMESTAMP '{START_DATE}' + (i % {hours}) * INTERVAL '1 hour'
+        FROM generate_series(1, {customers}) AS i
+        """,
+        f"""
+        INSERT INTO {schema}.products (sku, name, price, category, popularity, record_date, record_hour, processed_at)
+        SELECT i, 'Product ' || i, 10, 'books', 0.5,
+            DATE '{START_DATE}' + ((i % {hours}) / 24), (i % {hours}) % 24,
+            TIMESTAMP '{START_DATE}' + (i % {hours}) * INTERVAL '1 hour'
+        FROM generate_series(1, {products}) AS i
+        """,
+        f"""
+        INSERT INTO {schema}.erasure_requests (customer_id, email, record_date, record_hour)
+        SELECT id, email, record_date, record_hour FROM {schema}.customers
+        WHERE id % 100 = 0
+        """,
+        f"""
+        INSERT INTO {schema}.transactions (transaction_id, transaction_time, customer_id, record_date, record_hour)
+        SELECT md5(i::text)::uuid, TIMESTAMP '{START_DATE}' + (i % {hours}) * INTERVAL '1 hour',
+            1 + i % {customers},
+            DATE '{START_DATE}' + ((i % {hours}) / 24), (i % {hours}) % 24
+        FROM generate_series(1, {transactions}) AS i
+        """,
+        f"""
+        INSERT INTO {schema}.delivery_addresses (transaction_id, address, postcode, city, country)
+        SELECT transaction_id, '1 Ilica', '10000', 'Zagreb', 'Croatia'
+        FROM {schema}.transactions
+        """,
+        f"""
+        INSERT INTO {schema}.purchases (transaction_id, product_sku, quantity, price, total)
+        SELECT transaction_id, 1 + (id * 3 + n) % {products}, 1, 10, 10
+        FROM {schema}.transactions, generate_series(1, 3) AS n
+        """,
+    ]
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+    connection.commit()
+    analyze(connection, schema)
+
+
+def analyze(connection: Any, schema: str) -> None:
+    with connection.cursor() as cursor:
+        for table in SEEDED_TABLES:
+            cursor.execute(f"ANALYZE {schema}.{table}")
+    connection.commit()
+
+
+def build_lookups(
+    rng: random.Random, customers: int, transactions: int
+) -> List[Lookup]:
+    """
+    Build the lookups to time, with random parameters.
+
+    Args:
+        rng (random.Random): The random number generator.
+        customers (int): The number of seeded customers.
+        transactions (int): The number of seeded transactions.
+
+    Returns:
+        List[Lookup]: The lookups to time.
+    """
+    hours = 30 * 24
+
+    def random_hour() -> Tuple[date, int]:
+        hour = rng.randrange(hours)
+        return START_DATE + timedelta(days=hour // 24), hour % 24
+
+    def hour_and_ids(count: int, population: int) -> Tuple[date, int, List[int]]:
+        ids = rng.sample(range(1, population + 1), min(count, population))
+        return (*random_hour(), ids)
+
+    def transaction_ids(count: int) -> Tuple[List[str]]:
+        return (
+            [seeded_transaction_id(rng.randint(1, transactions)) for _ in range(count)],
+        )
+
+    def recent() -> Tuple[datetime]:
+        return (
+            datetime.combine(START_DATE, datetime.min.time())
+            + timedelta(hours=hours - 2),
+        )
+
+    return [
+        Lookup(
+            "customers by id",
+            "SELECT id, record_date, record_hour FROM {schema}.customers WHERE id = ANY(%s)",
+            lambda: (rng.sample(range(1, customers + 1), 100),),
+        ),
+        Lookup(
+            "customers by hour and id",
+            "SELECT id FROM {schema}.customers "
+            "WHERE record_date = %s AND record_hour = %s AND id = ANY(%s)",
+            lambda: hour_and_ids(100, customers),
+        ),
+        Lookup(
+            "products by hour and sku",
+            "SELECT sku FROM {schema}.products "
+            "WHERE record_date = %s AND record_hour = %s AND sku = ANY(%s)",
+            lambda: hour_and_ids(10, product_count(customers)),
+        ),
+        Lookup(
+            "erasure requests by hour and customer",
+            "SELECT customer_id FROM {schema}.erasure_requests "
+            "WHERE record_date = %s AND record_hour = %s AND customer_id = ANY(%s)",
+            lambda: hour_and_ids(10, customers),
+        ),
+        Lookup(
+            "customers refreshed since",
+            "SELECT id, processed_at FROM {schema}.customers WHERE processed_at >= %s",
+            recent,
+        ),
+        Lookup(
+            "products refreshed since",
+            "SELECT sku, processed_at FROM {schema}.products WHERE processed_at >= %s",
+            recent,
+        ),
+        Lookup(
+            "purchases by transaction",
+            "SELECT product_sku, quantity FROM {schema}.purchases "
+            "WHERE transaction_id = ANY(%s::uuid[])",
+            lambda: transaction_ids(100),
+        ),
+        Lookup(
+            "delivery addresses by transaction",
+            "SELECT address FROM {schema}.delivery_addresses "
+            "WHERE transaction_id = ANY(%s::uuid[])",
+            lambda: transaction_ids(100),
+        ),
+    ]
+
+
+def time_lookup(
+    connection: Any, schema: str, lookup: Lookup, repeat: int
+) -> Dict[str, Any]:
+    """
+    Time a lookup and record the plan PostgreSQL chooses for it.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        schema (str): The scratch schema.
+        lookup (Lookup): The lookup to time.
+        repeat (int): The number of timed executions.
+
+    Returns:
+        Dict[str, Any]: The median time in milliseconds and the top plan node.
+    """
+    query = lookup.query.format(schema=schema)
+    timings = []
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", lookup.params())
+        plan = cursor.fetchone()[0][0]["Plan"]
+        while plan.get("Plans") and plan["Node Type"] in ("Gather", "Hash Join"):
+            plan = plan["Plans"][0]
+        for _ in range(repeat):
+            params = lookup.params()
+            start_time = time.perf_counter()
+            cursor.execute(query, params)
+            cursor.fetchall()
+            timings.append(time.perf_counter() - start_time)
+    connection.rollback()
+    return {
+        "median_ms": statistics.median(timings) * 1000,
+        "plan": plan["Node Type"],
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--customers", type=int, default=100000)
+    parser.add_argument("--transactions", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--schema", default="lookup_benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    lookups = build_lookups(rng, args.customers, args.transactions)
+    results: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    with connect_to_postgres() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE")
+        connection.commit()
+        try:
+            run_script(connection, INIT_SCRIPT, args.schema)
+            seed(connection, args.schema, args.customers, args.transactions)
+            for phase in ("before", "after"):
+                if phase == "after":
+                    run_script(connection, MIGRATION_SCRIPT, args.schema)
+                    analyze(connection, args.schema)
+                for lookup in lookups:
+                    results.setdefault(lookup.name, {})[phase] = time_lookup(
+                        connection, args.schema, lookup, args.repeat
+                    )
+        finally:
+            connection.rollback()
+            with connection.cursor() as cursor:
+                cursor.execute(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE")
+            connection.commit()
+
+    print(
+        f"{'lookup':<40}{'before ms':>12}{'after ms':>12}{'speedup':>10}  plan before -> after"
+    )
+    for name, phases in results.items():
+        before, after = phases["before"], phases["after"]
+        speedup = before["median_ms"] / after["median_ms"] if after["median_ms"] else 0
+        print(
+            f"{name:<40}{before['median_ms']:>12.3f}{after['median_ms']:>12.3f}"
+            f"{speedup:>9.1f}x  {before['plan']} -> {after['plan']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+In-memory stand-in for the PostgreSQL connection used by the pipelines.
+
+Statements are built client-side exactly like with psycopg2, including
+execute_values paging and COPY buffers, and are then dropped. Lookups of
+customers and products are answered from the reference keys the stand-in
+was created with, so validation and erasure behave as against a loaded
+database while the benchmarks measure only the Python side.
+"""
+
+import re
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from psycopg2.extensions import QuotedString, adapt
+
+_SELECT_KEYS = re.compile(
+    r"SELECT (\w+)(, processed_at)? FROM data\.(customers|products)", re.IGNORECASE
+)
+_SELECT_COUNT = re.compile(
+    r"SELECT COUNT\(\*\) FROM data\.(customers|products)", re.IGNORECASE
+)
+_SELECT_LOCATIONS = re.compile(
+    r"SELECT (id, )?record_date, record_hour FROM data\.customers", re.IGNORECASE
+)
+
+
+def _quote(value: Any) -> bytes:
+    adapter = adapt(value)
+    if isinstance(adapter, QuotedString):
+        # Without a connection psycopg2 would encode strings as latin-1
+        adapter.encoding = "utf8"
+    return adapter.getquoted()
+
+
+class StubCursor:
+    def __init__(self, connection: "StubConnection") -> None:
+        self.connection = connection
+        self.rowcount = -1
+        self._rows: List[Tuple[Any, ...]] = []
+
+    def __enter__(self) -> "StubCursor":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._rows = []
+
+    def mogrify(self, query: Any, vars: Any = None) -> bytes:
+        if isinstance(query, str):
+            query = query.encode("utf-8")
+        if vars is None:
+            return query
+        return query % tuple(_quote(value) for value in vars)
+
+    def execute(self, query: Any, vars: Any = None) -> None:
+        self.connection.query_count += 1
+        if isinstance(query, bytes):
+            query = query.decode("utf-8")
+        self._rows = self.connection.answer(" ".join(query.split()), vars)
+        self.rowcount = len(self._rows)
+
+    def executemany(self, query: Any, vars_list: Iterable[Any]) -> None:
+        self.connection.query_count += 1
+        self.rowcount = sum(1 for _ in vars_list)
+        self._rows = []
+
+    def copy_expert(self, sql: str, file: Any, size: int = 8192) -> None:
+        self.connection.query_count += 1
+        self.rowcount = file.read().count("\n")
+
+    def fetchone(self) -> Optional[Tuple[Any, ...]]:
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self) -> List[Tuple[Any, ...]]:
+        rows, self._rows = self._rows, []
+        return rows
+
+
+class StubConnection:
+    """
+    PostgreSQL connection stand-in holding the keys of the reference tables.
+
+    Args:
+        customer_locations (Dict[int, Tuple[date, int]]): Customer IDs with the
+            date and hour of their record.
+        skus (Iterable[int]): Product SKUs.
+    """
+
+    encoding = "UTF8"
+
+    def __init__(
+        self,
+        customer_locations: Optional[Dict[int, Tuple[date, int]]] = None,
+        skus: Iterable[int] = (),
+    ) -> None:
+        self.customer_locations = dict(customer_locations or {})
+        self.skus = set(skus)
+        self.closed = 0
+        self.query_count = 0
+        self.commit_count = 0
+
+    def cursor(self, *args: Any, **kwargs: Any) -> StubCursor:
+        return StubCursor(self)
+
+    def commit(self) -> None:
+        self.commit_count += 1
+
+    def rollback(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = 1
+
+    def answer(self, query: str, vars: Any) -> List[Tuple[Any, ...]]:
+        """
+        Answer the lookups the pipelines make; every other statement returns nothing.
+        """
+        match = _SELECT_LOCATIONS.search(query)
+        if match:
+            customer_ids = vars[0] if match.group(1) else [int(vars[0])]
+            return [
+                (
+                    (customer_id, *self.customer_locations[customer_id])
+                    if match.group(1)
+                    else self.customer_locations[customer_id]
+                )
+                for customer_id in customer_ids
+                if customer_id in self.customer_locations
+            ]
+
+        match = _SELECT_COUNT.search(query)
+        if match:
+            keys = self._keys(match.group(1))
+            return [(int(int(vars[0]) in keys),)]
+
+        match = _SELECT_KEYS.search(query)
+        if not match or "WHERE processed_at" in query:
+            # Incremental reference refreshes find nothing new
+            return []
+        keys = self._keys(match.group(3))
+        if match.group(2):
+            return [(key, None) for key in keys]
+        return [(key,) for key in vars[0] if key in keys]
+
+    def _keys(self, table: str) -> Any:
+        return self.customer_locations if table == "customers" else self.skus
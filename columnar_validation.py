@@ -0,0 +1,198 @@
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from settings import env_flag
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - optional dependency
+    np = None
+
+
+# Whether hourly batches are validated column-wise (requires NumPy)
+COLUMNAR_VALIDATION = env_flag("COLUMNAR_VALIDATION", False)
+
+# Reason codes for rows rejected by the columnar checks, in the order the
+# checks are applied; a row gets the code of the first check it fails
+REASON_VALID = 0
+REASON_DUPLICATE_TRANSACTION_ID = 1
+REASON_INVALID_CUSTOMER_ID = 2
+REASON_INVALID_PRODUCT_SKUS = 3
+REASON_INVALID_TOTAL_COST = 4
+
+
+def is_enabled() -> bool:
+    """
+    Check whether columnar validation is requested and NumPy is installed.
+
+    Returns:
+        bool: True if batches should be validated column-wise.
+    """
+    return COLUMNAR_VALIDATION and np is not None
+
+
+def reason_message(reason_code: int, transaction: Dict[str, Any]) -> str:
+    """
+    Describe a reason code the same way the row-by-row checks do.
+
+    Args:
+        reason_code (int): The reason code of a rejected row.
+        transaction (Dict[str, Any]): The rejected transaction.
+
+    Returns:
+        str: The error message stored in data.invalid_transactions.
+    """
+    if reason_code == REASON_DUPLICATE_TRANSACTION_ID:
+        return "Duplicate transaction_id"
+    if reason_code == REASON_INVALID_CUSTOMER_ID:
+        return f"Invalid customer_id: {transaction.get('customer_id')}"
+    if reason_code == REASON_INVALID_PRODUCT_SKUS:
+        return "Invalid product skus"
+    if reason_code == REASON_INVALID_TOTAL_COST:
+        return "Invalid total_cost"
+    raise ValueError(f"Unknown reason code: {reason_code}")
+
+
+def _to_float_array(values: List[Any]) -> Any:
+    try:
+        return np.array(values, dtype=str).astype(np.float64)
+    except ValueError:
+        # Fall back to per-value parsing so one malformed number only
+        # invalidates its own row
+        parsed = []
+        for value in values:
+            try:
+                parsed.append(float(value))
+            except (TypeError, ValueError):
+                parsed.append(float("nan"))
+        return np.array(parsed, dtype=np.float64)
+
+
+def transactions_to_columns(transactions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Turn schema-valid transactions into column arrays.
+
+    Purchases are flattened into a line-item table whose "item_transaction"
+    column holds the index of the transaction each line belongs to.
+
+    Args:
+        transactions (List[Dict[str, Any]]): Schema-valid transaction records.
+
+    Returns:
+        Dict[str, Any]: Transaction-level and line-item-level NumPy arrays.
+    """
+    item_transaction: List[int] = []
+    item_sku: List[int] = []
+    item_quantity: List[int] = []
+    item_price: List[Any] = []
+    for index, transaction in enumerate(transactions):
+        for product in transaction["purchases"]["products"]:
+            item_transaction.append(index)
+            item_sku.append(product["sku"])
+            item_quantity.append(product["quanitity"])
+            item_price.append(product["price"])
+
+    # Fixed-width string arrays rather than object arrays, so membership
+    # and uniqueness checks sort instead of comparing every pair
+    return {
+        "transaction_id": np.array(
+            [t["transaction_id"] for t in transactions], dtype=str
+        ),
+        "customer_id": np.array([t["customer_id"] for t in transactions], dtype=str),
+        "total_cost": _to_float_array(
+            [t["purchases"]["total_cost"] for t in transactions]
+        ),
+        "item_transaction": np.array(item_transaction, dtype=np.int64),
+        "item_sku": np.array(item_sku, dtype=np.int64),
+        "item_quantity": np.array(item_quantity, dtype=np.float64),
+        "item_price": _to_float_array(item_price),
+    }
+
+
+def _isin(values: Any, allowed: Iterable[Any]) -> Any:
+    allowed = list(allowed)
+    if not allowed or len(values) == 0:
+        return np.zeros(len(values), dtype=bool)
+    if values.dtype.kind == "U":
+        return np.isin(values, np.array(allowed, dtype=str))
+    return np.isin(values, np.array(allowed, dtype=values.dtype))
+
+
+def first_occurrence_mask(keys: Any, seen: Optional[Set[Any]] = None) -> Any:
+    """
+    Flag the first occurrence of every key that wasn't seen before.
+
+    Args:
+        keys (np.ndarray): The keys, in row order.
+        seen (Optional[Set[Any]]): Keys seen in earlier batches.
+
+    Returns:
+        np.ndarray: True for rows holding the first occurrence of a new key.
+    """
+    mask = np.zeros(len(keys), dtype=bool)
+    if len(keys):
+        _, first_indexes = np.unique(keys, return_index=True)
+        mask[first_indexes] = True
+    if seen:
+        mask &= ~_isin(keys, seen)
+    return mask
+
+
+def validate_transactions(
+    transactions: List[Dict[str, Any]],
+    existing_customer_ids: Set[str],
+    existing_skus: Set[int],
+    seen_transaction_ids: Optional[Set[str]] = None,
+) -> Tuple[Any, Any]:
+    """
+    Validate a batch of schema-valid transactions with vectorized operations.
+
+    Applies the same checks as the row-by-row validation, in the same order:
+    transaction_id uniqueness, customer_id existence, product SKU existence
+    and total cost. The transaction ids of the batch are added to
+    seen_transaction_ids.
+
+    Args:
+        transactions (List[Dict[str, Any]]): Schema-valid transaction records.
+        existing_customer_ids (Set[str]): Customer IDs that exist.
+        existing_skus (Set[int]): Product SKUs that exist.
+        seen_transaction_ids (Optional[Set[str]]): Transaction ids of earlier batches.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: A per-row validity mask and reason codes.
+    """
+    columns = transactions_to_columns(transactions)
+    transaction_count = len(transactions)
+
+    unique = first_occurrence_mask(columns["transaction_id"], seen_transaction_ids)
+    known_customer = _isin(columns["customer_id"], existing_customer_ids)
+
+    invalid_items = ~_isin(columns["item_sku"], existing_skus)
+    known_skus = (
+        np.bincount(
+            columns["item_transaction"],
+            weights=invalid_items,
+            minlength=transaction_count,
+        )
+        == 0
+    )
+
+    calculated_total_cost = np.bincount(
+        columns["item_transaction"],
+        weights=columns["item_price"] * columns["item_quantity"],
+        minlength=transaction_count,
+    )
+    valid_total_cost = np.round(calculated_total_cost, 2) == np.round(
+        columns["total_cost"], 2
+    )
+
+    reasons = np.full(transaction_count, REASON_VALID, dtype=np.int8)
+    # Assign from the last check to the first so the first failing check wins
+    reasons[~valid_total_cost] = REASON_INVALID_TOTAL_COST
+    reasons[~known_skus] = REASON_INVALID_PRODUCT_SKUS
+    reasons[~known_customer] = REASON_INVALID_CUSTOMER_ID
+    reasons[~unique] = REASON_DUPLICATE_TRANSACTION_ID
+
+    if seen_transaction_ids is not None:
+        seen_transaction_ids.update(columns["transaction_id"].tolist())
+
+    return reasons == REASON_VALID, reasons
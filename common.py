@@ -1,61 +1,811 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+import csv
+import io
 import os
-from psycopg2.pool import SimpleConnectionPool
-from datetime import datetime, timedelta
+import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from datetime import date, datetime, timedelta
 import logging
 import gzip
 import json
-from typing import Any, Generator
+import threading
+import time
+import jsonschema
+import metrics
+from settings import env_flag, env_float, env_int, env_str
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover - optional dependency
+    msgspec = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover - optional dependency
+    lz4_frame = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - optional dependency
+    pa = None
+    pq = None
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# JSON codec used for NDJSON files: "orjson", "msgspec", "json" or "auto"
+JSON_CODEC = env_str("JSON_CODEC", "auto")
+
+# Whether records are first checked with a validator specialised for the schema
+SCHEMA_FAST_PATH = env_flag("SCHEMA_FAST_PATH", True)
+
+# Size of the process-wide PostgreSQL connection pool
+POSTGRES_POOL_MINCONN = env_int("POSTGRES_POOL_MINCONN", 1)
+POSTGRES_POOL_MAXCONN = env_int("POSTGRES_POOL_MAXCONN", 10)
+
+# Number of hour partitions processed concurrently (1 processes them in order)
+ETL_MAX_WORKERS = env_int("ETL_MAX_WORKERS", 1)
+
+# Number of records extracted, transformed and loaded at a time
+ETL_CHUNK_SIZE = env_int("ETL_CHUNK_SIZE", 10000)
+
+# How long cached reference keys are trusted before an incremental refresh
+REFERENCE_CACHE_TTL_SECONDS = env_float("REFERENCE_CACHE_TTL_SECONDS", 3600.0)
+
+# Number of rows sent per multi-row INSERT statement
+UPSERT_PAGE_SIZE = env_int("UPSERT_PAGE_SIZE", 1000)
+
+# Suffix of the sidecar index written next to an indexed processed data file
+RECORD_INDEX_SUFFIX = ".index.json"
+
+# Records per independently compressed gzip block of processed files (0 writes one stream)
+PROCESSED_BLOCK_RECORDS = env_int("PROCESSED_BLOCK_RECORDS", 0)
+
+# Whether pipelines only look at raw_data partitions from their last ingested hour onwards
+INGEST_WATERMARKS = env_flag("INGEST_WATERMARKS", True)
+
+# How often the raw_data watcher polls, and how long a raw file must be left
+# untouched before it is considered completely written
+INGEST_POLL_INTERVAL_SECONDS = env_float("INGEST_POLL_INTERVAL_SECONDS", 5.0)
+RAW_FILE_SETTLE_SECONDS = env_float("RAW_FILE_SETTLE_SECONDS", 10.0)
+
+# Compression of processed files: "gzip", "zstd", "lz4" or "none";
+# PROCESSED_COMPRESSION_<DATASET> overrides it for a single dataset
+PROCESSED_COMPRESSION = env_str("PROCESSED_COMPRESSION", "gzip")
+GZIP_COMPRESSION_LEVEL = env_int("GZIP_COMPRESSION_LEVEL", 9)
+ZSTD_COMPRESSION_LEVEL = env_int("ZSTD_COMPRESSION_LEVEL", 3)
+# Worker threads for zstd compression (0 compresses on the calling thread, -1 uses every core)
+ZSTD_THREADS = env_int("ZSTD_THREADS", 0)
+LZ4_COMPRESSION_LEVEL = env_int("LZ4_COMPRESSION_LEVEL", 0)
+
+# Format of processed files: "json" or "parquet";
+# PROCESSED_FORMAT_<DATASET> overrides it for a single dataset
+PROCESSED_FORMAT = env_str("PROCESSED_FORMAT", "json")
+PARQUET_COMPRESSION = env_str("PARQUET_COMPRESSION", "snappy")
+
+
+def _stdlib_dumps_line(record: Any) -> bytes:
+    return (json.dumps(record) + "\n").encode("utf-8")
+
+
+def _orjson_dumps_line(record: Any) -> bytes:
+    try:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    except TypeError:
+        # orjson is stricter than the stdlib, e.g. about non-string keys
+        return _stdlib_dumps_line(record)
+
+
+def _msgspec_dumps_line(record: Any) -> bytes:
+    try:
+        return _msgspec_encoder.encode(record) + b"\n"
+    except TypeError:
+        return _stdlib_dumps_line(record)
+
+
+JSON_CODECS: Dict[str, Tuple[Callable[[Union[bytes, str]], Any], Callable]] = {
+    "json": (json.loads, _stdlib_dumps_line),
+}
+if orjson is not None:
+    JSON_CODECS["orjson"] = (orjson.loads, _orjson_dumps_line)
+if msgspec is not None:
+    _msgspec_encoder = msgspec.json.Encoder()
+    JSON_CODECS["msgspec"] = (msgspec.json.decode, _msgspec_dumps_line)
+
+
+def get_json_codec(name: str = JSON_CODEC) -> Tuple[str, Callable, Callable]:
+    """
+    Pick the JSON codec used to read and write NDJSON files.
+
+    "auto" picks the fastest installed backend: orjson, then msgspec, then the
+    standard library. A backend that isn't installed also falls back to the
+    standard library.
+
+    Args:
+        name (str): The codec name.
+
+    Returns:
+        Tuple[str, Callable, Callable]: The codec name, its loads function and
+            its function serializing a record to one newline-terminated line.
+    """
+    if name == "auto":
+        name = next(c for c in ("orjson", "msgspec", "json") if c in JSON_CODECS)
+    elif name not in JSON_CODECS:
+        logger.warning(f"JSON codec {name} is not available, using json instead.")
+        name = "json"
+    loads, dumps_line = JSON_CODECS[name]
+    return name, loads, dumps_line
+
+
+JSON_BACKEND, json_loads, json_dumps_line = get_json_codec()
+
+
+# File extension of each processed data compression
+COMPRESSION_EXTENSIONS = {
+    "gzip": ".json.gz",
+    "zstd": ".json.zst",
+    "lz4": ".json.lz4",
+    "none": ".json",
+}
+
+# Extensions of the data files the pipelines read and write
+DATA_FILE_EXTENSIONS = tuple(COMPRESSION_EXTENSIONS.values())
+
+# File extension of processed data written as Parquet
+PARQUET_EXTENSION = ".parquet"
+
+
+def get_compression(file_path: str) -> Optional[str]:
+    """
+    Get the compression of a data file from its extension.
+
+    Args:
+        file_path (str): The path of the file.
+
+    Returns:
+        Optional[str]: The compression, or None for unsupported extensions.
+    """
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if file_path.endswith(extension):
+            return compression
+    return None
+
+
+def dataset_file_paths(dataset_paths: Dict[str, str], dataset: str) -> List[str]:
+    """
+    Get the files of a dataset among the raw files of an hour, whatever their compression.
+
+    Args:
+        dataset_paths (Dict[str, str]): The file names of the hour mapped to their paths.
+        dataset (str): The dataset, e.g. "customers".
+
+    Returns:
+        List[str]: The paths of the dataset's files, .json.gz first.
+    """
+    return [
+        dataset_paths[f"{dataset}{extension}"]
+        for extension in DATA_FILE_EXTENSIONS
+        if f"{dataset}{extension}" in dataset_paths
+    ]
+
+
+def processed_dataset_type(dataset: str) -> str:
+    """
+    Get the processed file name of a dataset, with the configured format and compression.
+
+    Args:
+        dataset (str): The dataset, e.g. "transactions".
+
+    Returns:
+        str: The processed file name, e.g. "transactions.json.gz".
+    """
+    setting_suffix = dataset.upper().replace("-", "_")
+    processed_format = env_str(f"PROCESSED_FORMAT_{setting_suffix}", PROCESSED_FORMAT)
+    if processed_format == "parquet":
+        return f"{dataset}{PARQUET_EXTENSION}"
+    if processed_format != "json":
+        raise ValueError(f"Unsupported format for {dataset}: {processed_format}")
+
+    compression = env_str(
+        f"PROCESSED_COMPRESSION_{setting_suffix}", PROCESSED_COMPRESSION
+    )
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError(f"Unsupported compression for {dataset}: {compression}")
+    return f"{dataset}{COMPRESSION_EXTENSIONS[compression]}"
+
+
+def open_compressed(file_path: str, mode: str = "rb") -> Any:
+    """
+    Open a data file in binary mode, compressing or decompressing it by extension.
+
+    Args:
+        file_path (str): The path of the file.
+        mode (str): "rb" or "wb".
+
+    Returns:
+        Any: A binary file object.
+    """
+    compression = get_compression(file_path)
+    if compression == "gzip":
+        if "w" in mode:
+            return gzip.open(file_path, mode, compresslevel=GZIP_COMPRESSION_LEVEL)
+        return gzip.open(file_path, mode)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstandard is required for .zst files")
+        if "w" in mode:
+            compressor = zstandard.ZstdCompressor(
+                level=ZSTD_COMPRESSION_LEVEL, threads=ZSTD_THREADS
+            )
+            return zstandard.open(file_path, mode, cctx=compressor)
+        # The zstd reader doesn't split lines on its own
+        return io.BufferedReader(zstandard.open(file_path, mode))
+    if compression == "lz4":
+        if lz4_frame is None:
+            raise ImportError("lz4 is required for .lz4 files")
+        if "w" in mode:
+            return lz4_frame.open(
+                file_path, mode, compression_level=LZ4_COMPRESSION_LEVEL
+            )
+        return lz4_frame.open(file_path, mode)
+    return open(file_path, mode)
+
+
+_connection_pool: Optional[ThreadedConnectionPool] = None
+_connection_slots: Optional[threading.BoundedSemaphore] = None
+_connection_pool_lock = threading.Lock()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that counts the statements it sends on its connection.
+    """
+
+    def execute(self, query: Any, vars: Any = None) -> Any:
+        self.connection.query_count += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query: Any, vars_list: Any) -> Any:
+        self.connection.query_count += 1
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql: Any, file: Any, size: int = 8192) -> Any:
+        self.connection.query_count += 1
+        return super().copy_expert(sql, file, size)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """
+    Connection whose cursors count the statements sent on it in query_count.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.query_count = 0
+        self.cursor_factory = CountingCursor
+
+
+def get_query_count(connection: Any) -> int:
+    """
+    Get the number of statements sent on a connection so far.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+
+    Returns:
+        int: The statement count, 0 for connections that don't count them.
+    """
+    query_count = getattr(connection, "query_count", 0)
+    return query_count if isinstance(query_count, int) else 0
+
 
-def create_connection_pool() -> SimpleConnectionPool:
+def create_connection_pool() -> ThreadedConnectionPool:
     """
-    Create a PostgreSQL connection pool.
+    Create a thread-safe PostgreSQL connection pool.
 
     Returns:
-        SimpleConnectionPool: A PostgreSQL connection pool.
+        ThreadedConnectionPool: A PostgreSQL connection pool.
     """
-    return SimpleConnectionPool(
-        minconn=1,
-        maxconn=10,
+    metrics.set_pool_size(POSTGRES_POOL_MAXCONN)
+    return ThreadedConnectionPool(
+        minconn=POSTGRES_POOL_MINCONN,
+        maxconn=POSTGRES_POOL_MAXCONN,
         dbname=os.getenv("POSTGRES_DB"),
         user=os.getenv("POSTGRES_USER"),
         password=os.getenv("POSTGRES_PASSWORD"),
         host=os.getenv("DB_HOST"),
         port=os.getenv("DB_PORT"),
+        connection_factory=CountingConnection,
     )
 
 
+def get_connection_pool() -> ThreadedConnectionPool:
+    """
+    Get the process-wide PostgreSQL connection pool, creating it on first use.
+
+    Returns:
+        ThreadedConnectionPool: The shared PostgreSQL connection pool.
+    """
+    global _connection_pool, _connection_slots
+    with _connection_pool_lock:
+        if _connection_pool is None or _connection_pool.closed:
+            _connection_pool = create_connection_pool()
+            _connection_slots = threading.BoundedSemaphore(POSTGRES_POOL_MAXCONN)
+        return _connection_pool
+
+
+def close_connection_pool() -> None:
+    """
+    Close all connections of the process-wide pool, if it was created.
+    """
+    global _connection_pool, _connection_slots
+    with _connection_pool_lock:
+        if _connection_pool is not None and not _connection_pool.closed:
+            _connection_pool.closeall()
+        _connection_pool = None
+        _connection_slots = None
+
+
+def is_connection_healthy(connection: Any) -> bool:
+    """
+    Check that a pooled connection is still usable.
+
+    Args:
+        connection (Any): A PostgreSQL connection.
+
+    Returns:
+        bool: True if the connection answers a trivial query, False otherwise.
+    """
+    if connection.closed:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1;")
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
 @contextmanager
 def get_postgres_connection() -> Generator:
     """
-    Context manager for acquiring and releasing a PostgreSQL connection.
+    Context manager for acquiring and releasing a pooled PostgreSQL connection.
+
+    The connection is held for the whole block and returned to the pool
+    afterwards. The transaction is committed if the block succeeds and rolled
+    back otherwise. When every connection is in use, callers wait for one to
+    be released.
 
     Yields:
         Any: A PostgreSQL connection.
     """
-    connection_pool = create_connection_pool()
-    connection = connection_pool.getconn()
-
+    connection_pool = get_connection_pool()
+    connection_slots = _connection_slots
+    connection_slots.acquire()
     try:
-        yield connection
+        connection = connection_pool.getconn()
+        if not is_connection_healthy(connection):
+            logger.warning("Discarding broken PostgreSQL connection from the pool.")
+            connection_pool.putconn(connection, close=True)
+            connection = connection_pool.getconn()
+
+        metrics.connection_checked_out()
+        try:
+            yield connection
+            if not connection.closed:
+                connection.commit()
+        except BaseException:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            connection_pool.putconn(connection, close=bool(connection.closed))
+            metrics.connection_returned()
     finally:
-        connection_pool.putconn(connection)
+        connection_slots.release()
 
 
 def connect_to_postgres() -> Any:
     """
-    Connect to PostgreSQL using the context manager.
+    Connect to PostgreSQL using the shared connection pool.
+
+    Use the result as a context manager; the connection stays checked out
+    until the block exits.
 
     Returns:
-        Any: A PostgreSQL connection.
+        Any: A context manager yielding a PostgreSQL connection.
+    """
+    return get_postgres_connection()
+
+
+def parse_partition(date_folder: str, hour_folder: str) -> Optional[Tuple[date, int]]:
+    """
+    Parse the date and hour of a "date=YYYY-MM-DD/hour=HH" partition.
+
+    Args:
+        date_folder (str): The date folder name.
+        hour_folder (str): The hour folder name.
+
+    Returns:
+        Optional[Tuple[date, int]]: The date and hour, or None if the names don't match the layout.
+    """
+    try:
+        return extract_actual_date(date_folder), extract_actual_hour(hour_folder)
+    except ValueError:
+        return None
+
+
+def _walk_hour_folders(
+    raw_data_path: str, earliest: Optional[Tuple[date, int]] = None
+) -> List[Tuple[str, str]]:
+    with os.scandir(raw_data_path) as date_entries:
+        date_folders = sorted(entry.name for entry in date_entries if entry.is_dir())
+
+    hour_folders = []
+    for date_folder in date_folders:
+        if earliest is not None:
+            # Whole days before the watermark aren't opened at all
+            try:
+                if extract_actual_date(date_folder) < earliest[0]:
+                    continue
+            except ValueError:
+                pass
+
+        with os.scandir(os.path.join(raw_data_path, date_folder)) as hour_entries:
+            hour_folders.extend(
+                (date_folder, hour_folder)
+                for hour_folder in sorted(
+                    entry.name for entry in hour_entries if entry.is_dir()
+                )
+            )
+    return hour_folders
+
+
+def scan_hour_partitions(
+    raw_data_path: str,
+    dataset_prefixes: Sequence[str],
+    since: Optional[Dict[str, Optional[Tuple[date, int]]]] = None,
+    hour_folders: Optional[Sequence[Tuple[str, str]]] = None,
+) -> List[Tuple[str, str, Dict[str, List[str]]]]:
+    """
+    Walk the raw data tree once and sort the files of each hour by dataset.
+
+    Args:
+        raw_data_path (str): The root of the raw data tree.
+        dataset_prefixes (Sequence[str]): The filename prefixes of the datasets.
+        since (Optional[Dict[str, Optional[Tuple[date, int]]]]): Per dataset, skip
+            partitions before this date and hour.
+        hour_folders (Optional[Sequence[Tuple[str, str]]]): Only look at these date
+            and hour folders instead of walking the tree.
+
+    Returns:
+        List[Tuple[str, str, Dict[str, List[str]]]]: Date folder, hour folder and the
+            filenames of every dataset found in it, oldest first.
+    """
+    since = since or {}
+    dataset_since = [since.get(prefix) for prefix in dataset_prefixes]
+    # The tree is pruned by the oldest watermark; datasets without one see everything
+    earliest = None if None in dataset_since else min(dataset_since, default=None)
+
+    if hour_folders is None:
+        hour_folders = _walk_hour_folders(raw_data_path, earliest)
+    else:
+        hour_folders = sorted(
+            (date_folder, hour_folder)
+            for date_folder, hour_folder in hour_folders
+            if os.path.isdir(os.path.join(raw_data_path, date_folder, hour_folder))
+        )
+
+    partitions = []
+    for date_folder, hour_folder in hour_folders:
+        partition = parse_partition(date_folder, hour_folder)
+        hour_path = os.path.join(raw_data_path, date_folder, hour_folder)
+        with os.scandir(hour_path) as file_entries:
+            filenames = [
+                entry.name
+                for entry in file_entries
+                if entry.name.endswith(DATA_FILE_EXTENSIONS)
+            ]
+
+        datasets = {}
+        for prefix, prefix_since in zip(dataset_prefixes, dataset_since):
+            if (
+                prefix_since is not None
+                and partition is not None
+                and partition < prefix_since
+            ):
+                continue
+            dataset_files = [name for name in filenames if name.startswith(prefix)]
+            if dataset_files:
+                datasets[prefix] = dataset_files
+        partitions.append((date_folder, hour_folder, datasets))
+
+    return partitions
+
+
+def poll_raw_data_partitions(
+    raw_data_path: str,
+    state: Dict[str, Any],
+    now: float,
+    settle_seconds: float = RAW_FILE_SETTLE_SECONDS,
+) -> Tuple[List[Tuple[str, str]], Dict[str, Any]]:
+    """
+    Find the raw data partitions whose files have finished landing.
+
+    A file is finished once its size and modification time haven't changed
+    since the previous poll and it hasn't been modified for settle_seconds.
+    Files still being written under a temporary name aren't data files yet,
+    so a rename into place only waits for the settle time. A partition is
+    reported once all its data files are finished, and again only when its
+    files change.
+
+    Args:
+        raw_data_path (str): The root of the raw data tree.
+        state (Dict[str, Any]): The state returned by the previous poll, empty
+            on the first one.
+        now (float): The current time as a Unix timestamp.
+        settle_seconds (float): How long a file must be left untouched.
+
+    Returns:
+        Tuple[List[Tuple[str, str]], Dict[str, Any]]: The newly finished date and
+            hour folders, oldest first, and the state for the next poll.
+    """
+    previous_files = state.get("files", {})
+    previous_reported = state.get("reported", {})
+    settle_ns = int(settle_seconds * 1e9)
+    now_ns = int(now * 1e9)
+
+    files = {}
+    reported = {}
+    finished = []
+    # raw_data only holds files that haven't been ingested yet, so the walk
+    # is bounded by the backlog rather than by the history of the tree
+    for date_folder, hour_folder in _walk_hour_folders(raw_data_path):
+        partition_key = f"{date_folder}/{hour_folder}"
+        signature = []
+        settled = True
+        with os.scandir(
+            os.path.join(raw_data_path, date_folder, hour_folder)
+        ) as file_entries:
+            for entry in sorted(file_entries, key=lambda entry: entry.name):
+                if not entry.name.endswith(DATA_FILE_EXTENSIONS):
+                    continue
+                stat = entry.stat()
+                file_stat = [stat.st_size, stat.st_mtime_ns]
+                file_key = f"{partition_key}/{entry.name}"
+                files[file_key] = file_stat
+                if (
+                    previous_files.get(file_key) != file_stat
+                    or now_ns - stat.st_mtime_ns < settle_ns
+                ):
+                    settled = False
+                signature.append(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}")
+
+        if not signature:
+            continue
+        signature = ",".join(signature)
+        if previous_reported.get(partition_key) == signature:
+            # Reported before and not ingested (yet)
+            reported[partition_key] = signature
+        elif settled:
+            reported[partition_key] = signature
+            finished.append((date_folder, hour_folder))
+
+    # Partitions with files left, of any dataset
+    metrics.set_backlog("raw_data", len({key.rsplit("/", 1)[0] for key in files}))
+    return finished, {"files": files, "reported": reported}
+
+
+def list_hour_partitions(
+    raw_data_path: str,
+    dataset_prefix: str,
+    since: Optional[Tuple[date, int]] = None,
+) -> List[Tuple[str, str, List[str]]]:
+    """
+    List the date/hour partitions that contain files of a dataset, oldest first.
+
+    Args:
+        raw_data_path (str): The root of the raw data tree.
+        dataset_prefix (str): The filename prefix of the dataset, e.g. "customers".
+        since (Optional[Tuple[date, int]]): Skip partitions before this date and hour.
+
+    Returns:
+        List[Tuple[str, str, List[str]]]: Date folder, hour folder and dataset filenames.
+    """
+    partitions = []
+    for date_folder, hour_folder, datasets in scan_hour_partitions(
+        raw_data_path, [dataset_prefix], {dataset_prefix: since}
+    ):
+        partition = parse_partition(date_folder, hour_folder)
+        if since is not None and partition is not None and partition < since:
+            continue
+
+        if dataset_prefix in datasets:
+            partitions.append((date_folder, hour_folder, datasets[dataset_prefix]))
+        else:
+            logger.warning(f"No datasets found for {date_folder}/{hour_folder}")
+
+    return partitions
+
+
+def get_ingest_watermark(connection: Any, dataset: str) -> Optional[Tuple[date, int]]:
+    """
+    Get the date and hour of the last partition a dataset was ingested from.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        dataset (str): The dataset, e.g. "customers".
+
+    Returns:
+        Optional[Tuple[date, int]]: The date and hour, or None if nothing was ingested yet.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT record_date, record_hour FROM data.ingest_watermarks
+            WHERE dataset_type = %s;
+        """,
+            (dataset,),
+        )
+        result = cursor.fetchone()
+    return tuple(result) if result else None
+
+
+def advance_ingest_watermark(
+    connection: Any, dataset: str, date_folder: str, hour_folder: str
+) -> None:
+    """
+    Move the watermark of a dataset forward to an ingested partition.
+
+    The watermark never moves backwards.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        dataset (str): The dataset, e.g. "customers".
+        date_folder (str): The date folder of the ingested partition.
+        hour_folder (str): The hour folder of the ingested partition.
+    """
+    partition = parse_partition(date_folder, hour_folder)
+    if partition is None:
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO data.ingest_watermarks (dataset_type, record_date, record_hour)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (dataset_type) DO UPDATE
+            SET record_date = EXCLUDED.record_date,
+                record_hour = EXCLUDED.record_hour,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE (data.ingest_watermarks.record_date, data.ingest_watermarks.record_hour)
+                < (EXCLUDED.record_date, EXCLUDED.record_hour);
+        """,
+            (dataset, *partition),
+        )
+    connection.commit()
+
+
+def discover_hour_partitions(
+    connection: Any, raw_data_path: str, dataset_prefix: str
+) -> List[Tuple[str, str, List[str]]]:
+    """
+    List the partitions of a dataset that still need to be ingested.
+
+    With INGEST_WATERMARKS enabled, only the partitions from the dataset's
+    watermark onwards are listed. The watermark partition itself is listed
+    again, so files that land in the hour being ingested aren't missed.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        raw_data_path (str): The root of the raw data tree.
+        dataset_prefix (str): The filename prefix of the dataset, e.g. "customers".
+
+    Returns:
+        List[Tuple[str, str, List[str]]]: Date folder, hour folder and dataset filenames.
+    """
+    since = None
+    if INGEST_WATERMARKS:
+        since = get_ingest_watermark(connection, dataset_prefix)
+    return list_hour_partitions(raw_data_path, dataset_prefix, since)
+
+
+def process_hour_partitions(
+    connection: Any,
+    partitions: List[Tuple[str, str, List[str]]],
+    process_hourly_data: Callable[[Any, str, str, List[str]], None],
+    max_workers: int = ETL_MAX_WORKERS,
+    ordered: bool = False,
+    watermark_dataset: Optional[str] = None,
+) -> None:
+    """
+    Run a pipeline's hourly processing over a list of partitions.
+
+    With more than one worker, partitions are sent to a thread pool and each
+    worker checks out its own pooled connection. Pipelines whose hours must be
+    applied in order (ordered=True) always run sequentially on the given
+    connection. The first failure cancels the partitions that haven't started
+    and is re-raised. With a watermark_dataset, the dataset's ingest
+    watermark follows the partitions as they complete, in order, so it never
+    passes a partition that failed.
+
+    Args:
+        connection (Any): The PostgreSQL connection used for sequential processing.
+        partitions (List[Tuple[str, str, List[str]]]): Partitions from list_hour_partitions.
+        process_hourly_data (Callable): The pipeline's process_hourly_data function.
+        max_workers (int): The maximum number of partitions processed at once.
+        ordered (bool): Whether the partitions must be processed in order.
+        watermark_dataset (Optional[str]): The dataset whose ingest watermark to advance.
     """
-    with get_postgres_connection() as connection:
-        return connection
+
+    if watermark_dataset is not None:
+        metrics.set_backlog(watermark_dataset, len(partitions))
+
+    def partition_done(partition: Tuple[str, str, List[str]]) -> None:
+        if watermark_dataset is None:
+            return
+        metrics.partition_processed(watermark_dataset)
+        if INGEST_WATERMARKS:
+            date_folder, hour_folder, _ = partition
+            advance_ingest_watermark(
+                connection, watermark_dataset, date_folder, hour_folder
+            )
+
+    if ordered or max_workers <= 1 or len(partitions) <= 1:
+        for partition in partitions:
+            date_folder, hour_folder, available_datasets = partition
+            process_hourly_data(
+                connection, date_folder, hour_folder, available_datasets
+            )
+            partition_done(partition)
+        return
+
+    def process_partition(partition: Tuple[str, str, List[str]]) -> None:
+        date_folder, hour_folder, available_datasets = partition
+        with get_postgres_connection() as worker_connection:
+            process_hourly_data(
+                worker_connection, date_folder, hour_folder, available_datasets
+            )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process_partition, p) for p in partitions]
+        try:
+            for partition, future in zip(partitions, futures):
+                future.result()
+                partition_done(partition)
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
 
 
 def cleanup_empty_directories(directory: str) -> None:
@@ -73,6 +823,38 @@ def cleanup_empty_directories(directory: str) -> None:
                 logger.debug(f"Empty directory deleted: {dir_path}")
 
 
+def cleanup_partition_directories(
+    raw_data_path: str, partitions: Iterable[Tuple[str, str, Any]]
+) -> None:
+    """
+    Remove the given hour directories, and their date directories, if they're empty.
+
+    Unlike cleanup_empty_directories, this doesn't walk the whole tree.
+
+    Args:
+        raw_data_path (str): The root of the raw data tree.
+        partitions (Iterable[Tuple[str, str, Any]]): Date and hour folders of processed partitions.
+    """
+    date_folders = set()
+    for date_folder, hour_folder, _ in partitions:
+        date_folders.add(date_folder)
+        hour_path = os.path.join(raw_data_path, date_folder, hour_folder)
+        try:
+            os.rmdir(hour_path)
+            logger.debug(f"Empty directory deleted: {hour_path}")
+        except OSError:
+            # Not empty, or already removed
+            continue
+
+    for date_folder in sorted(date_folders):
+        date_path = os.path.join(raw_data_path, date_folder)
+        try:
+            os.rmdir(date_path)
+            logger.debug(f"Empty directory deleted: {date_path}")
+        except OSError:
+            continue
+
+
 def archive_and_delete(
     file_path: str, dataset_type: str, date: str, hour: str, archive_path: str
 ) -> None:
@@ -97,6 +879,25 @@ def archive_and_delete(
     logger.debug(f"File archived: {archive_file_path}")
 
 
+def get_files_size(file_paths: Iterable[str]) -> int:
+    """
+    Get the total size of the given files.
+
+    Args:
+        file_paths (Iterable[str]): The paths of the files.
+
+    Returns:
+        int: The total size in bytes, counting missing files as empty.
+    """
+    total_size = 0
+    for file_path in file_paths:
+        try:
+            total_size += os.path.getsize(file_path)
+        except OSError:
+            continue
+    return total_size
+
+
 def extract_actual_date(date_str: str) -> datetime.date:
     """
     Extract the actual date from the formatted date string.
@@ -131,10 +932,16 @@ def log_processing_statistics(
     dataset_type: str,
     record_count: int,
     processing_time: timedelta,
+    bytes_in: Optional[int] = None,
+    bytes_out: Optional[int] = None,
+    compression_time: Optional[timedelta] = None,
+    stages: Optional["StageStatistics"] = None,
 ) -> None:
     """
     Log processing statistics.
 
+    The per-stage statistics, if any, are inserted in the same transaction.
+
     Args:
         connection (Any): The PostgreSQL connection.
         date (str): The date of the processed data.
@@ -142,48 +949,586 @@ def log_processing_statistics(
         dataset_type (str): The type of the processed dataset.
         record_count (int): The number of records processed.
         processing_time (datetime.timedelta): The time taken for processing.
+        bytes_in (Optional[int]): The size of the raw files read.
+        bytes_out (Optional[int]): The size of the processed file written.
+        compression_time (Optional[timedelta]): The time taken to serialize and compress the processed file.
+        stages (Optional[StageStatistics]): The statistics of each stage of the hour.
     """
     actual_date = extract_actual_date(date)
     actual_hour = extract_actual_hour(hour)
     with connection.cursor() as cursor:
         cursor.execute(
             """
-            INSERT INTO data.processing_statistics (record_date, record_hour, dataset_type, record_count, processing_time)
-            VALUES (%s, %s, %s, %s, %s);
+            INSERT INTO data.processing_statistics (record_date, record_hour, dataset_type, record_count, processing_time, bytes_in, bytes_out, compression_time)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
         """,
-            (actual_date, actual_hour, dataset_type, record_count, processing_time),
+            (
+                actual_date,
+                actual_hour,
+                dataset_type,
+                record_count,
+                processing_time,
+                bytes_in,
+                bytes_out,
+                compression_time,
+            ),
         )
+        if stages is not None and stages.stages:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO data.processing_stage_statistics (record_date, record_hour, dataset_type, stage, duration, calls, rows_in, rows_out, bytes_read, query_count)
+                VALUES %s;
+            """,
+                [
+                    (actual_date, actual_hour, dataset_type, *row)
+                    for row in stages.rows()
+                ],
+            )
     connection.commit()
+    metrics.observe_hour(dataset_type, record_count, processing_time, stages)
 
 
-def extract_data(file_path: str) -> list:
+class StageStatistics:
     """
-    Extract data from the specified file.
-
-    Args:
-        file_path (str): The path of the file.
+    Per-stage timings and counters of one dataset-hour.
 
-    Returns:
-        list: The extracted data.
+    Each stage accumulates its duration, the number of times it ran, rows in
+    and out, raw bytes read and the statements sent to PostgreSQL. Stages are
+    timed with stage(), which works as a context manager or a decorator, or
+    with iterate() for stages that produce data lazily.
     """
-    if not file_path:
-        return []
 
-    _, file_extension = os.path.splitext(file_path)
+    def __init__(self) -> None:
+        self.stages: Dict[str, Dict[str, int]] = {}
 
-    if file_extension == ".gz":
-        # Extract raw_data from a gzipped JSON file
-        with gzip.open(file_path, "rt") as file:
-            data = [json.loads(line) for line in file]
-    elif file_extension == ".json":
-        # Extract raw_data from a plain JSON file
-        with open(file_path, "r", encoding="utf-8") as file:
-            data = [json.load(file)]
+    def counters(self, name: str) -> Dict[str, int]:
+        """
+        Get the counters of a stage, creating them on first use.
+
+        Args:
+            name (str): The stage name.
+
+        Returns:
+            Dict[str, int]: The stage's counters, updated in place.
+        """
+        if name not in self.stages:
+            self.stages[name] = {
+                "duration_ns": 0,
+                "calls": 0,
+                "rows_in": 0,
+                "rows_out": 0,
+                "bytes_read": 0,
+                "queries": 0,
+            }
+        return self.stages[name]
+
+    @contextmanager
+    def stage(
+        self, name: str, connection: Any = None, rows_in: int = 0, bytes_read: int = 0
+    ) -> Iterator[Dict[str, int]]:
+        """
+        Time a stage and count the statements it sends on connection.
+
+        Args:
+            name (str): The stage name.
+            connection (Any): The PostgreSQL connection the stage uses, if any.
+            rows_in (int): The number of rows the stage receives.
+            bytes_read (int): The number of raw bytes the stage reads.
+
+        Yields:
+            Dict[str, int]: The stage's counters, e.g. to add rows_out.
+        """
+        counters = self.counters(name)
+        counters["rows_in"] += rows_in
+        counters["bytes_read"] += bytes_read
+        query_count = get_query_count(connection)
+        start_ns = time.perf_counter_ns()
+        try:
+            yield counters
+        finally:
+            counters["duration_ns"] += time.perf_counter_ns() - start_ns
+            counters["calls"] += 1
+            counters["queries"] += get_query_count(connection) - query_count
+
+    def iterate(self, name: str, chunks: Iterable[List[Any]]) -> Iterator[List[Any]]:
+        """
+        Time the production of each chunk of a lazy stage, e.g. extraction.
+
+        Args:
+            name (str): The stage name.
+            chunks (Iterable[List[Any]]): The chunks produced by the stage.
+
+        Yields:
+            List[Any]: The chunks, counted as the stage's rows out.
+        """
+        counters = self.counters(name)
+        iterator = iter(chunks)
+        while True:
+            start_ns = time.perf_counter_ns()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                counters["duration_ns"] += time.perf_counter_ns() - start_ns
+            counters["calls"] += 1
+            counters["rows_out"] += len(chunk)
+            yield chunk
+
+    def rows(self) -> List[Tuple[str, timedelta, int, int, int, int, int]]:
+        """
+        Get the statistics of every stage, in the order the stages first ran.
+
+        Returns:
+            List[Tuple[str, timedelta, int, int, int, int, int]]: Stage name,
+                duration, calls, rows in, rows out, bytes read and statement count.
+        """
+        return [
+            (
+                name,
+                timedelta(microseconds=counters["duration_ns"] / 1000),
+                counters["calls"],
+                counters["rows_in"],
+                counters["rows_out"],
+                counters["bytes_read"],
+                counters["queries"],
+            )
+            for name, counters in self.stages.items()
+        ]
+
+
+def upsert_rows(
+    cursor: Any,
+    table: str,
+    columns: Dict[str, Any],
+    conflict_columns: Optional[Sequence[str]] = None,
+    update_columns: Optional[Sequence[str]] = None,
+    page_size: int = UPSERT_PAGE_SIZE,
+    conflict_expressions: Optional[Dict[str, str]] = None,
+) -> int:
+    """
+    Write a column-oriented batch with multi-row INSERT ... ON CONFLICT statements.
+
+    List and tuple values are columns and must all have the same length; any
+    other value is repeated for every row. Rows that conflict on
+    conflict_columns are skipped, or have update_columns overwritten when
+    given. Duplicate keys within the batch are collapsed the same way: the
+    first row wins when skipping and the last row wins when updating. Keys
+    with a NULL never conflict, as in PostgreSQL.
+
+    conflict_expressions replaces conflict columns with the expression their
+    unique index is built on, e.g. {"error_message": "md5(error_message)"} for
+    values too long to be indexed directly. The conflict target needs a
+    matching unique index; a database without one raises a RuntimeError
+    asking for the migrations in sql-scripts/.
+
+    Args:
+        cursor (Any): The PostgreSQL cursor.
+        table (str): The target table.
+        columns (Dict[str, Any]): Column names mapped to lists of values or a constant.
+        conflict_columns (Optional[Sequence[str]]): The conflict target, if any.
+        update_columns (Optional[Sequence[str]]): Columns to update on conflict.
+        page_size (int): The number of rows per INSERT statement.
+        conflict_expressions (Optional[Dict[str, str]]): Index expressions of
+            conflict columns that are not indexed as they are.
+
+    Returns:
+        int: The number of rows sent to the database.
+
+    Raises:
+        RuntimeError: If the table has no unique index on conflict_columns.
+    """
+    column_names = list(columns)
+    row_count = max(
+        (len(v) for v in columns.values() if isinstance(v, (list, tuple))), default=0
+    )
+    values = [
+        v if isinstance(v, (list, tuple)) else [v] * row_count for v in columns.values()
+    ]
+    if any(len(v) != row_count for v in values):
+        raise ValueError(f"Columns for {table} have different lengths")
+
+    rows: List[tuple] = list(zip(*values))
+    if not rows:
+        return 0
+
+    query = f"INSERT INTO {table} ({', '.join(column_names)}) VALUES %s"
+    conflict_target = ""
+    if conflict_columns:
+        key_indexes = [column_names.index(c) for c in conflict_columns]
+        unique_rows: Dict[tuple, tuple] = {}
+        for position, row in enumerate(rows):
+            key = tuple(row[i] for i in key_indexes)
+            if None in key:
+                # Kept apart from every other row by its position
+                key = (position,)
+            if update_columns or key not in unique_rows:
+                unique_rows[key] = row
+        rows = list(unique_rows.values())
+
+        conflict_expressions = conflict_expressions or {}
+        conflict_target = ", ".join(
+            conflict_expressions.get(c, c) for c in conflict_columns
+        )
+        query += f" ON CONFLICT ({conflict_target})"
+        if update_columns:
+            assignments = ", ".join(f"{c} = EXCLUDED.{c}" for c in update_columns)
+            query += f" DO UPDATE SET {assignments}"
+        else:
+            query += " DO NOTHING"
+
+    try:
+        execute_values(cursor, query, rows, page_size=page_size)
+    except psycopg2.errors.InvalidColumnReference as error:
+        # ON CONFLICT needs a unique index on exactly the conflict target
+        raise RuntimeError(
+            f"{table} has no unique index on ({conflict_target}); "
+            "apply the migrations in sql-scripts/ to the database"
+        ) from error
+    return len(rows)
+
+
+COPY_NULL = "\\N"
+
+
+def copy_rows(
+    cursor: Any, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]]
+) -> int:
+    """
+    Stream rows into a table with COPY FROM STDIN.
+
+    Rows are serialized as CSV into an in-memory buffer, with None written as
+    the unquoted NULL marker so empty strings stay empty strings.
+
+    Args:
+        cursor (Any): The PostgreSQL cursor.
+        table (str): The target table.
+        columns (Sequence[str]): The target columns, in row order.
+        rows (Iterable[Sequence[Any]]): The rows to copy.
+
+    Returns:
+        int: The number of rows copied.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    row_count = 0
+    for row in rows:
+        writer.writerow([COPY_NULL if value is None else value for value in row])
+        row_count += 1
+
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN "
+        f"WITH (FORMAT csv, NULL '{COPY_NULL}')",
+        buffer,
+    )
+    return row_count
+
+
+def iter_records(file_path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Lazily extract records from the specified file, one at a time.
+
+    Args:
+        file_path (str): The path of the file.
+
+    Yields:
+        Dict[str, Any]: The extracted records.
+    """
+    if not file_path:
+        return
+
+    compression = get_compression(file_path)
+
+    if compression == "none":
+        # Extract raw_data from a plain JSON file
+        with open(file_path, "rb") as file:
+            yield json_loads(file.read())
+    elif compression is not None:
+        # Extract raw_data from a compressed newline-delimited JSON file
+        with open_compressed(file_path, "rb") as file:
+            for line in file:
+                if line.strip():
+                    yield json_loads(line)
     else:
+        _, file_extension = os.path.splitext(file_path)
         logger.warning(f"Unsupported file format: {file_extension}")
-        return []
 
-    return data
+
+def extract_data_chunks(
+    file_path: str, chunk_size: int = ETL_CHUNK_SIZE
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Lazily extract records from the specified file in chunks of a fixed size.
+
+    Args:
+        file_path (str): The path of the file.
+        chunk_size (int): The maximum number of records per chunk.
+
+    Yields:
+        List[Dict[str, Any]]: The extracted records, chunk by chunk.
+    """
+    chunk = []
+    for record in iter_records(file_path):
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def extract_data(file_path: str) -> list:
+    """
+    Extract data from the specified file.
+
+    Args:
+        file_path (str): The path of the file.
+
+    Returns:
+        list: The extracted data.
+    """
+    return list(iter_records(file_path))
+
+
+def record_index_path(file_path: str) -> str:
+    """
+    Get the path of the sidecar record index of a processed data file.
+
+    Args:
+        file_path (str): The path to the processed data file.
+
+    Returns:
+        str: The path to the record index.
+    """
+    return f"{file_path}{RECORD_INDEX_SUFFIX}"
+
+
+def write_record_index(
+    file_path: str,
+    key: Optional[str],
+    entries: Dict[str, Tuple[int, int]],
+    blocks: Optional[List[Tuple[int, int, int, int]]] = None,
+) -> None:
+    """
+    Write the sidecar record index of a processed data file.
+
+    Args:
+        file_path (str): The path to the processed data file.
+        key (Optional[str]): The record field the index is keyed by, if any.
+        entries (Dict[str, Tuple[int, int]]): Line number and uncompressed byte offset by key.
+        blocks (Optional[List[Tuple[int, int, int, int]]]): Compressed offset, compressed
+            length, first line number and record count of every gzip block.
+    """
+    index_path = record_index_path(file_path)
+    temp_path = f"{index_path}.tmp"
+    with open(temp_path, "w") as index_file:
+        json.dump({"key": key, "records": entries, "blocks": blocks}, index_file)
+    os.replace(temp_path, index_path)
+
+
+def _read_sidecar_index(file_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(record_index_path(file_path), "r") as index_file:
+            return json.load(index_file)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.warning(f"Ignoring unreadable record index of {file_path}")
+        return None
+
+
+def read_record_index(file_path: str) -> Optional[Dict[str, Tuple[int, int]]]:
+    """
+    Read the sidecar record index of a processed data file.
+
+    Args:
+        file_path (str): The path to the processed data file.
+
+    Returns:
+        Optional[Dict[str, Tuple[int, int]]]: Line number and uncompressed byte offset
+            by key, or None if the file has no readable index.
+    """
+    index = _read_sidecar_index(file_path)
+    if index is None or index.get("key") is None:
+        return None
+    return {
+        key: (line_number, offset)
+        for key, (line_number, offset) in index["records"].items()
+    }
+
+
+def read_block_table(file_path: str) -> Optional[List[Tuple[int, int, int, int]]]:
+    """
+    Read the gzip block table of a block-compressed processed data file.
+
+    Args:
+        file_path (str): The path to the processed data file.
+
+    Returns:
+        Optional[List[Tuple[int, int, int, int]]]: Compressed offset, compressed length,
+            first line number and record count of every block, or None if the file
+            isn't block-compressed.
+    """
+    index = _read_sidecar_index(file_path)
+    if index is None or not index.get("blocks"):
+        return None
+    return [tuple(block) for block in index["blocks"]]
+
+
+def read_block_lines(file_path: str, block: Tuple[int, int, int, int]) -> List[bytes]:
+    """
+    Decompress a single block of a block-compressed processed data file.
+
+    Args:
+        file_path (str): The path to the processed data file.
+        block (Tuple[int, int, int, int]): The block, as listed in the block table.
+
+    Returns:
+        List[bytes]: The encoded records of the block, one line each.
+    """
+    offset, length, _, _ = block
+    with open(file_path, "rb") as file:
+        file.seek(offset)
+        return gzip.decompress(file.read(length)).splitlines(keepends=True)
+
+
+class ProcessedDataWriter:
+    """
+    Incrementally write the processed records of one dataset and hour.
+
+    The output file is only created once the first record is written, so
+    empty datasets leave nothing behind. With an index_key, a sidecar index
+    of the line number and uncompressed byte offset of every record is
+    written next to the file on close.
+
+    With block_records set, a .json.gz file is written as a series of
+    independent gzip members of that many records each (like BGZF). The
+    result is still a regular gzip file, and the sidecar index lists the
+    blocks so a single one can be decompressed or replaced.
+    """
+
+    def __init__(
+        self,
+        dataset_type: str,
+        date: str,
+        hour: str,
+        processed_data_path: str,
+        index_key: Optional[str] = None,
+        block_records: int = PROCESSED_BLOCK_RECORDS,
+    ) -> None:
+        # Determine the appropriate file extension based on dataset_type
+        compression = get_compression(dataset_type)
+        if compression is None:
+            raise ValueError(
+                f"Unsupported file extension in dataset_type: {dataset_type}"
+            )
+        file_extension = COMPRESSION_EXTENSIONS[compression]
+
+        # Remove the existing extension if present
+        dataset_type_without_extension, _ = dataset_type.split(".", 1)
+
+        self.dataset_type = dataset_type
+        self.output_dir = os.path.join(processed_data_path, date, hour)
+        self.output_path = os.path.join(
+            str(self.output_dir), f"{dataset_type_without_extension}{file_extension}"
+        )
+        # Compress according to the file extension
+        self._open_func = open_compressed
+        self._file = None
+        self.record_count = 0
+        # Time spent serializing to and compressing the output file
+        self.compression_time = timedelta()
+        self.bytes_written = 0
+        self.index_key = index_key
+        self._index: Dict[str, Tuple[int, int]] = {}
+        self._offset = 0
+        # Block-compressed files are written as raw bytes, one gzip member per block
+        self.block_records = block_records if compression == "gzip" else 0
+        if self.block_records > 0:
+            self._open_func = open
+        self._pending_lines: List[bytes] = []
+        self._blocks: List[Tuple[int, int, int, int]] = []
+        self._compressed_offset = 0
+
+    def write(self, records: Iterable[Dict[str, Any]]) -> None:
+        """
+        Append records to the output file.
+
+        Args:
+            records (Iterable[Dict[str, Any]]): The records to write.
+        """
+        records = list(records)
+        started_at = time.perf_counter()
+        try:
+            self._write(records)
+        finally:
+            self.compression_time += timedelta(seconds=time.perf_counter() - started_at)
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        lines = [json_dumps_line(record) for record in records]
+        if not lines:
+            return
+
+        if self.index_key is not None:
+            for line_number, (record, line) in enumerate(
+                zip(records, lines), start=self.record_count
+            ):
+                self._index[str(record.get(self.index_key))] = (
+                    line_number,
+                    self._offset,
+                )
+                self._offset += len(line)
+
+        if self._file is None:
+            # Create the corresponding subdirectories in processed_data
+            os.makedirs(self.output_dir, exist_ok=True)
+            self._file = self._open_func(self.output_path, "wb")
+        self.record_count += len(lines)
+        if self.block_records <= 0:
+            self._file.write(b"".join(lines))
+            return
+
+        self._pending_lines.extend(lines)
+        while len(self._pending_lines) >= self.block_records:
+            self._write_block(self._pending_lines[: self.block_records])
+            del self._pending_lines[: self.block_records]
+
+    def _write_block(self, lines: List[bytes]) -> None:
+        first_line = self.record_count - len(self._pending_lines)
+        data = gzip.compress(b"".join(lines), compresslevel=GZIP_COMPRESSION_LEVEL)
+        self._file.write(data)
+        self._blocks.append(
+            (self._compressed_offset, len(data), first_line, len(lines))
+        )
+        self._compressed_offset += len(data)
+
+    def close(self) -> None:
+        """
+        Close the output file, if one was created.
+        """
+        if self._file is not None:
+            started_at = time.perf_counter()
+            if self._pending_lines:
+                self._write_block(self._pending_lines)
+                self._pending_lines = []
+            self._file.close()
+            self._file = None
+            self.compression_time += timedelta(seconds=time.perf_counter() - started_at)
+            self.bytes_written = os.path.getsize(self.output_path)
+            if self.index_key is not None or self._blocks:
+                write_record_index(
+                    self.output_path, self.index_key, self._index, self._blocks or None
+                )
+        elif self.record_count == 0:
+            logger.debug(f"Skipping loading for empty dataset: {self.dataset_type}")
+
+    def __enter__(self) -> "ProcessedDataWriter":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
 
 
 def load_data(
@@ -200,33 +1545,536 @@ def load_data(
         processed_data_path (str): The path where the data should be loaded.
     """
     logger.debug(f"Loading data {data} for {dataset_type} {date} {hour}")
-    # Create the corresponding subdirectories in processed_data
-    output_dir = os.path.join(processed_data_path, date, hour)
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Determine the appropriate file extension based on dataset_type
-    if dataset_type.endswith(".json.gz"):
-        file_extension = ".json.gz"
-    elif dataset_type.endswith(".json"):
-        file_extension = ".json"
-    else:
-        raise ValueError(f"Unsupported file extension in dataset_type: {dataset_type}")
-
-    # Remove the existing extension if present
-    dataset_type_without_extension, _ = dataset_type.split(".", 1)
-
-    # Load processed data to the new location only if the dataset is not empty
-    if data:
-        # Use gzip compression if the file extension is .json.gz
-        open_func = gzip.open if file_extension == ".json.gz" else open
-        # Construct the output path
-        output_path = os.path.join(
-            str(output_dir), f"{dataset_type_without_extension}{file_extension}"
+    with ProcessedDataWriter(dataset_type, date, hour, processed_data_path) as writer:
+        writer.write(data)
+
+
+# Fields with few distinct values, stored dictionary-encoded in Parquet
+PARQUET_DICTIONARY_FIELDS = {"category", "country"}
+
+_ARROW_TYPES = {
+    "integer": "int64",
+    "number": "float64",
+    "boolean": "bool_",
+}
+
+
+def arrow_type_from_json_schema(
+    schema: Dict[str, Any], field_name: str = "", top_level: bool = True
+) -> Any:
+    """
+    Derive the Arrow type of a JSON schema.
+
+    Objects become structs, arrays become lists, and "anyOf" with "null" is
+    treated as the nullable other alternative. Top-level strings in
+    PARQUET_DICTIONARY_FIELDS are dictionary-encoded; nested ones are left to
+    Parquet's own dictionary pages, as pyarrow can't read nested dictionary
+    columns back across row groups.
+
+    Args:
+        schema (Dict[str, Any]): The JSON schema.
+        field_name (str): The name of the field the schema describes.
+        top_level (bool): Whether the field is a top-level record field.
+
+    Returns:
+        pyarrow.DataType: The Arrow type.
+    """
+    if "anyOf" in schema:
+        alternatives = [
+            alternative
+            for alternative in schema["anyOf"]
+            if alternative.get("type") != "null"
+        ]
+        if len(alternatives) != 1:
+            raise ValueError(f"Unsupported anyOf for {field_name}: {schema['anyOf']}")
+        return arrow_type_from_json_schema(alternatives[0], field_name, top_level)
+
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return pa.struct(
+            [
+                (name, arrow_type_from_json_schema(property_schema, name, False))
+                for name, property_schema in schema.get("properties", {}).items()
+            ]
+        )
+    if schema_type == "array":
+        return pa.list_(
+            arrow_type_from_json_schema(schema.get("items", {}), field_name)
         )
+    if schema_type == "string":
+        if top_level and field_name in PARQUET_DICTIONARY_FIELDS:
+            return pa.dictionary(pa.int32(), pa.string())
+        return pa.string()
+    if schema_type in _ARROW_TYPES:
+        return getattr(pa, _ARROW_TYPES[schema_type])()
+    raise ValueError(f"Unsupported JSON schema type for {field_name}: {schema_type}")
 
-        with open_func(output_path, "wt") as file:
-            for record in data:
-                json.dump(record, file)
-                file.write("\n")
-    else:
-        logger.debug(f"Skipping loading for empty dataset: {dataset_type}")
+
+def arrow_schema_from_json_schema(
+    schema: Dict[str, Any], extra_fields: Optional[Dict[str, str]] = None
+) -> Any:
+    """
+    Derive the Arrow schema of the records described by a JSON schema.
+
+    Args:
+        schema (Dict[str, Any]): The JSON schema of a record.
+        extra_fields (Optional[Dict[str, str]]): JSON schema types of fields the
+            pipeline adds to the records, e.g. {"last_change": "string"}.
+
+    Returns:
+        pyarrow.Schema: The Arrow schema.
+    """
+    fields = [
+        (name, arrow_type_from_json_schema(property_schema, name))
+        for name, property_schema in schema.get("properties", {}).items()
+    ]
+    known_fields = {name for name, _ in fields}
+    for name, schema_type in (extra_fields or {}).items():
+        if name not in known_fields:
+            fields.append(
+                (name, arrow_type_from_json_schema({"type": schema_type}, name))
+            )
+    return pa.schema(fields)
+
+
+class ParquetDataWriter:
+    """
+    Incrementally write the processed records of one dataset and hour to Parquet.
+
+    Has the interface of ProcessedDataWriter. Every write becomes one row
+    group, and records are converted to the Arrow schema derived from the
+    JSON schema of the dataset.
+    """
+
+    def __init__(
+        self,
+        dataset_type: str,
+        date: str,
+        hour: str,
+        processed_data_path: str,
+        json_schema: Dict[str, Any],
+        extra_fields: Optional[Dict[str, str]] = None,
+    ) -> None:
+        if pa is None:
+            raise ImportError("pyarrow is required to write Parquet files")
+        if not dataset_type.endswith(PARQUET_EXTENSION):
+            raise ValueError(
+                f"Unsupported file extension in dataset_type: {dataset_type}"
+            )
+
+        self.dataset_type = dataset_type
+        self.output_dir = os.path.join(processed_data_path, date, hour)
+        self.output_path = os.path.join(str(self.output_dir), dataset_type)
+        self.schema = arrow_schema_from_json_schema(json_schema, extra_fields)
+        self._writer = None
+        self.record_count = 0
+        self.compression_time = timedelta()
+        self.bytes_written = 0
+
+    def write(self, records: Iterable[Dict[str, Any]]) -> None:
+        """
+        Append records to the output file as one row group.
+
+        Args:
+            records (Iterable[Dict[str, Any]]): The records to write.
+        """
+        records = list(records)
+        if not records:
+            return
+
+        started_at = time.perf_counter()
+        table = pa.Table.from_pylist(records, schema=self.schema)
+        if self._writer is None:
+            # Create the corresponding subdirectories in processed_data
+            os.makedirs(self.output_dir, exist_ok=True)
+            self._writer = pq.ParquetWriter(
+                self.output_path, self.schema, compression=PARQUET_COMPRESSION
+            )
+        self._writer.write_table(table)
+        self.record_count += len(records)
+        self.compression_time += timedelta(seconds=time.perf_counter() - started_at)
+
+    def close(self) -> None:
+        """
+        Close the output file, if one was created.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self.bytes_written = os.path.getsize(self.output_path)
+        elif self.record_count == 0:
+            logger.debug(f"Skipping loading for empty dataset: {self.dataset_type}")
+
+    def __enter__(self) -> "ParquetDataWriter":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def create_processed_data_writer(
+    dataset_type: str,
+    date: str,
+    hour: str,
+    processed_data_path: str,
+    json_schema: Dict[str, Any],
+    extra_fields: Optional[Dict[str, str]] = None,
+    **kwargs: Any,
+) -> Union[ProcessedDataWriter, ParquetDataWriter]:
+    """
+    Create the writer for the processed file of one dataset and hour.
+
+    Args:
+        dataset_type (str): The processed file name, see processed_dataset_type.
+        date (str): The date of the dataset.
+        hour (str): The hour of the dataset.
+        processed_data_path (str): The path where the data should be loaded.
+        json_schema (Dict[str, Any]): The JSON schema of the records, used for Parquet.
+        extra_fields (Optional[Dict[str, str]]): JSON schema types of fields the
+            pipeline adds to the records, used for Parquet.
+        **kwargs (Any): Options passed on to ProcessedDataWriter.
+
+    Returns:
+        Union[ProcessedDataWriter, ParquetDataWriter]: The writer.
+    """
+    if dataset_type.endswith(PARQUET_EXTENSION):
+        return ParquetDataWriter(
+            dataset_type, date, hour, processed_data_path, json_schema, extra_fields
+        )
+    return ProcessedDataWriter(dataset_type, date, hour, processed_data_path, **kwargs)
+
+
+class ReferenceDataCache:
+    """
+    In-process cache of the keys of a reference table (e.g. customer IDs or SKUs).
+
+    The first lookup loads every key. Once the TTL expires, or after the cache is
+    invalidated, only rows whose processed_at is at or after the last refresh
+    watermark are loaded. Keys missing from the cache are looked up in the
+    database, so a stale cache never rejects a key that exists.
+    """
+
+    def __init__(self, table: str, key_column: str, ttl_seconds: float) -> None:
+        self.table = table
+        self.key_column = key_column
+        self.ttl_seconds = ttl_seconds
+        self._keys: Set[Any] = set()
+        self._watermark: Optional[datetime] = None
+        self._refreshed_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0
+
+    def _is_stale(self) -> bool:
+        return (
+            self._refreshed_at is None
+            or time.monotonic() - self._refreshed_at >= self.ttl_seconds
+        )
+
+    def _refresh(self, connection: Any) -> None:
+        with connection.cursor() as cursor:
+            if self._watermark is None:
+                cursor.execute(
+                    f"SELECT {self.key_column}, processed_at FROM {self.table};"
+                )
+            else:
+                cursor.execute(
+                    f"""
+                    SELECT {self.key_column}, processed_at FROM {self.table}
+                    WHERE processed_at >= %s;
+                """,
+                    (self._watermark,),
+                )
+            rows = cursor.fetchall()
+
+        for key, processed_at in rows:
+            self._keys.add(key)
+            if processed_at is not None and (
+                self._watermark is None or processed_at > self._watermark
+            ):
+                self._watermark = processed_at
+        self._refreshed_at = time.monotonic()
+        logger.debug(
+            f"Refreshed {self.table} cache with {len(rows)} rows, "
+            f"{len(self._keys)} keys cached."
+        )
+
+    def _fetch_existing(self, connection: Any, keys: Set[Any]) -> Set[Any]:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT {self.key_column} FROM {self.table}
+                WHERE {self.key_column} = ANY(%s);
+            """,
+                (list(keys),),
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def lookup(self, connection: Any, keys: Set[Any]) -> Set[Any]:
+        """
+        Return the subset of the given keys that exist in the reference table.
+
+        Args:
+            connection (Any): The PostgreSQL connection.
+            keys (Set[Any]): The keys to look up.
+
+        Returns:
+            Set[Any]: The keys that exist.
+        """
+        if not keys:
+            return set()
+
+        if not self.enabled:
+            return self._fetch_existing(connection, keys)
+
+        with self._lock:
+            if self._is_stale():
+                self._refresh(connection)
+            existing = keys & self._keys
+
+        misses = keys - existing
+        if misses:
+            found = self._fetch_existing(connection, misses)
+            if found:
+                with self._lock:
+                    self._keys |= found
+                existing |= found
+
+        return existing
+
+    def invalidate(self, full: bool = False) -> None:
+        """
+        Mark the cache as stale so the next lookup refreshes it.
+
+        Args:
+            full (bool): Drop all cached keys instead of refreshing incrementally.
+        """
+        with self._lock:
+            self._refreshed_at = None
+            if full:
+                self._keys = set()
+                self._watermark = None
+
+
+REFERENCE_CACHES: Dict[str, ReferenceDataCache] = {
+    "customers": ReferenceDataCache(
+        "data.customers", "id", REFERENCE_CACHE_TTL_SECONDS
+    ),
+    "products": ReferenceDataCache("data.products", "sku", REFERENCE_CACHE_TTL_SECONDS),
+}
+
+
+def get_reference_cache(dataset: str) -> ReferenceDataCache:
+    """
+    Get the process-wide reference cache for a dataset.
+
+    Args:
+        dataset (str): The reference dataset ("customers" or "products").
+
+    Returns:
+        ReferenceDataCache: The cache for the dataset.
+    """
+    return REFERENCE_CACHES[dataset]
+
+
+def invalidate_reference_cache(
+    dataset: Optional[str] = None, full: bool = False
+) -> None:
+    """
+    Invalidate the reference cache of a dataset, or of all datasets.
+
+    Args:
+        dataset (Optional[str]): The reference dataset, or None for all of them.
+        full (bool): Drop all cached keys instead of refreshing incrementally.
+    """
+    datasets = [dataset] if dataset else list(REFERENCE_CACHES)
+    for name in datasets:
+        REFERENCE_CACHES[name].invalidate(full=full)
+
+
+# Keywords that don't constrain instances and can be ignored by the fast path
+_ANNOTATION_KEYWORDS = {"$schema", "$id", "title", "description", "default", "unique"}
+
+
+def _is_integer(instance: Any) -> bool:
+    if isinstance(instance, bool):
+        return False
+    return isinstance(instance, int) or (
+        isinstance(instance, float) and instance.is_integer()
+    )
+
+
+_TYPE_CHECKS: Dict[str, Callable[[Any], bool]] = {
+    "string": lambda instance: isinstance(instance, str),
+    "integer": _is_integer,
+    "number": lambda instance: isinstance(instance, (int, float))
+    and not isinstance(instance, bool),
+    "object": lambda instance: isinstance(instance, dict),
+    "array": lambda instance: isinstance(instance, list),
+    "boolean": lambda instance: isinstance(instance, bool),
+    "null": lambda instance: instance is None,
+}
+
+
+def _never_valid(instance: Any) -> bool:
+    return False
+
+
+def compile_schema_check(
+    schema: Dict[str, Any], format_checker: Any
+) -> Callable[[Any], bool]:
+    """
+    Compile a JSON schema into a Python function that accepts valid instances.
+
+    Only the keywords used by the dataset schemas are supported. A schema with
+    any other keyword compiles to a function that rejects everything, so the
+    result never accepts an instance that jsonschema would reject.
+
+    Args:
+        schema (Dict[str, Any]): The JSON schema.
+        format_checker (Any): The jsonschema format checker used for "format".
+
+    Returns:
+        Callable[[Any], bool]: A function returning True for valid instances.
+    """
+    checks: List[Callable[[Any], bool]] = []
+
+    for keyword, value in schema.items():
+        if keyword in _ANNOTATION_KEYWORDS:
+            continue
+
+        if keyword == "type":
+            types = [value] if isinstance(value, str) else list(value)
+            if any(t not in _TYPE_CHECKS for t in types):
+                return _never_valid
+            type_checks = [_TYPE_CHECKS[t] for t in types]
+            checks.append(
+                lambda instance, type_checks=type_checks: any(
+                    check(instance) for check in type_checks
+                )
+            )
+
+        elif keyword == "properties":
+            property_checks = {
+                name: compile_schema_check(subschema, format_checker)
+                for name, subschema in value.items()
+            }
+
+            def check_properties(instance, property_checks=property_checks):
+                if not isinstance(instance, dict):
+                    return True
+                for name, check in property_checks.items():
+                    if name in instance and not check(instance[name]):
+                        return False
+                return True
+
+            checks.append(check_properties)
+
+        elif keyword == "required":
+            required = tuple(value)
+            checks.append(
+                lambda instance, required=required: not isinstance(instance, dict)
+                or all(name in instance for name in required)
+            )
+
+        elif keyword == "additionalProperties":
+            if value is True:
+                continue
+            if value is not False or "patternProperties" in schema:
+                return _never_valid
+            allowed = frozenset(schema.get("properties", {}))
+            checks.append(
+                lambda instance, allowed=allowed: not isinstance(instance, dict)
+                or allowed.issuperset(instance)
+            )
+
+        elif keyword == "items":
+            if not isinstance(value, dict):
+                return _never_valid
+            item_check = compile_schema_check(value, format_checker)
+            checks.append(
+                lambda instance, item_check=item_check: not isinstance(instance, list)
+                or all(item_check(item) for item in instance)
+            )
+
+        elif keyword == "anyOf":
+            options = [compile_schema_check(option, format_checker) for option in value]
+            checks.append(
+                lambda instance, options=options: any(
+                    option(instance) for option in options
+                )
+            )
+
+        elif keyword in ("minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum"):
+            compare = {
+                "minimum": lambda instance, bound: instance >= bound,
+                "maximum": lambda instance, bound: instance <= bound,
+                "exclusiveMinimum": lambda instance, bound: instance > bound,
+                "exclusiveMaximum": lambda instance, bound: instance < bound,
+            }[keyword]
+            checks.append(
+                lambda instance, bound=value, compare=compare: not _TYPE_CHECKS[
+                    "number"
+                ](instance)
+                or compare(instance, bound)
+            )
+
+        elif keyword == "format":
+            checks.append(
+                lambda instance, format_name=value: format_checker.conforms(
+                    instance, format_name
+                )
+            )
+
+        else:
+            return _never_valid
+
+    def check_schema(instance: Any) -> bool:
+        for check in checks:
+            if not check(instance):
+                return False
+        return True
+
+    return check_schema
+
+
+class SchemaValidator:
+    """
+    Validate records against a JSON schema with a validator built once.
+
+    The validator class matching the schema's "$schema" is created with format
+    checking enabled. When the fast path is enabled, records are first checked
+    with a function compiled from the schema, and the full validator only runs
+    for records the fast path rejects, to confirm and describe the error.
+    """
+
+    def __init__(self, schema: Dict[str, Any], fast_path: bool = SCHEMA_FAST_PATH):
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        self.schema = schema
+        self.validator = validator_class(
+            schema, format_checker=validator_class.FORMAT_CHECKER
+        )
+        self.is_valid_fast = (
+            compile_schema_check(schema, self.validator.format_checker)
+            if fast_path
+            else None
+        )
+
+    def validate(self, instance: Any) -> None:
+        """
+        Validate a record.
+
+        Args:
+            instance (Any): The record to validate.
+
+        Raises:
+            jsonschema.exceptions.ValidationError: If the record is invalid.
+        """
+        if self.is_valid_fast is not None and self.is_valid_fast(instance):
+            return
+        error = jsonschema.exceptions.best_match(self.validator.iter_errors(instance))
+        if error is not None:
+            raise error
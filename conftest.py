@@ -1,6 +1,14 @@
 import pytest
 from psycopg2 import pool
 from unittest.mock import Mock
+from common import close_connection_pool, invalidate_reference_cache
+
+
+@pytest.fixture(autouse=True)
+def reset_reference_caches():
+    invalidate_reference_cache(full=True)
+    yield
+    invalidate_reference_cache(full=True)
 
 
 @pytest.fixture
@@ -25,12 +33,13 @@ def mock_open(mocker):
 
 @pytest.fixture
 def mock_connection_pool(mocker):
-    mocker.patch.object(pool, "SimpleConnectionPool", autospec=True)
+    mocker.patch.object(pool, "ThreadedConnectionPool", autospec=True)
     mocker.patch("psycopg2.connect")  #
 
     yield
 
     # Cleanup
+    close_connection_pool()
     mocker.stopall()
 
 
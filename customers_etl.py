@@ -4,19 +4,29 @@ import os
 from datetime import datetime
 from dotenv import load_dotenv
 import jsonschema
-from jsonschema import validate
+import metrics
+import profiling
 from common import (
-    extract_data,
+    dataset_file_paths,
+    extract_data_chunks,
     connect_to_postgres,
     cleanup_empty_directories,
     archive_and_delete,
     log_processing_statistics,
+    StageStatistics,
     extract_actual_date,
     extract_actual_hour,
-    load_data,
+    create_processed_data_writer,
+    invalidate_reference_cache,
+    upsert_rows,
+    discover_hour_partitions,
+    process_hour_partitions,
+    processed_dataset_type,
+    get_files_size,
+    SchemaValidator,
 )
 import psycopg2
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 
 load_dotenv()
@@ -37,64 +47,74 @@ CUSTOMERS_SCHEMA_FILE = "customer_schema.json"
 with open(CUSTOMERS_SCHEMA_FILE, "r") as schema_file:
     CUSTOMERS_SCHEMA = json.load(schema_file)
 
+# Build the validator once and reuse it for every record
+CUSTOMERS_VALIDATOR = SchemaValidator(CUSTOMERS_SCHEMA)
 
-def log_invalid_customer(
-    connection: Any, customer: Dict[str, Any], error_message: str, date: str, hour: str
+
+def log_invalid_customers(
+    connection: Any,
+    invalid_customers: List[Tuple[Dict[str, Any], str]],
+    date: str,
+    hour: str,
 ) -> None:
     """
-    Log invalid customer data into the database.
+    Log a batch of invalid customer data into the database.
+
+    Customers that are already logged as invalid get their error message updated.
 
     Args:
         connection (Any): The PostgreSQL connection.
-        customer (Dict[str, Any]): The invalid customer data.
-        error_message (str): The error message describing the validation error.
+        invalid_customers (List[Tuple[Dict[str, Any], str]]): Invalid customers with their error messages.
         date (str): The date of the data.
         hour (str): The hour of the data.
     """
+    if not invalid_customers:
+        return
+
     actual_date = extract_actual_date(date)
     actual_hour = extract_actual_hour(hour)
+    customers = [customer for customer, _ in invalid_customers]
     with connection.cursor() as cursor:
-        # Check if the customer with the same id already exists
-        cursor.execute(
-            """
-            SELECT id FROM data.invalid_customers WHERE id = %s;
-        """,
-            (customer.get("id"),),
+        upsert_rows(
+            cursor,
+            "data.invalid_customers",
+            {
+                "record_date": actual_date,
+                "record_hour": actual_hour,
+                "id": [customer.get("id") for customer in customers],
+                "first_name": [customer.get("first_name") for customer in customers],
+                "last_name": [customer.get("last_name") for customer in customers],
+                "email": [customer.get("email") for customer in customers],
+                "error_message": [error for _, error in invalid_customers],
+            },
+            conflict_columns=("id",),
+            update_columns=("error_message",),
         )
-
-        existing_record = cursor.fetchone()
-
-        if existing_record:
-            # Update the existing record if needed
-            cursor.execute(
-                """
-                UPDATE data.invalid_customers
-                SET error_message = %s
-                WHERE id = %s;
-            """,
-                (error_message, customer.get("id")),
-            )
-        else:
-            cursor.execute(
-                """
-                INSERT INTO data.invalid_customers (record_date, record_hour, id, first_name, last_name, email, error_message)
-                VALUES (%s, %s, %s, %s, %s, %s, %s);
-            """,
-                (
-                    actual_date,
-                    actual_hour,
-                    customer.get("id"),
-                    customer.get("first_name"),
-                    customer.get("last_name"),
-                    customer.get("email"),
-                    error_message,
-                ),
-            )
     connection.commit()
 
 
+def log_invalid_customer(
+    connection: Any, customer: Dict[str, Any], error_message: str, date: str, hour: str
+) -> None:
+    """
+    Log invalid customer data into the database.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        customer (Dict[str, Any]): The invalid customer data.
+        error_message (str): The error message describing the validation error.
+        date (str): The date of the data.
+        hour (str): The hour of the data.
+    """
+    log_invalid_customers(connection, [(customer, error_message)], date, hour)
+
+
 def transform_and_validate_customers(
-    connection: Any, customers_data: List[Dict[str, Any]], date: str, hour: str
+    connection: Any,
+    customers_data: List[Dict[str, Any]],
+    date: str,
+    hour: str,
+    unique_ids: Optional[Set[int]] = None,
 ) -> List[Dict[str, Any]]:
     """
     Transform and validate customer data.
@@ -104,22 +124,23 @@ def transform_and_validate_customers(
         customers_data (List[Dict[str, Any]]): List of customer records.
         date (str): The date of the data.
         hour (str): The hour of the data.
+        unique_ids (Optional[Set[int]]): Ids already seen in earlier chunks of the same file.
 
     Returns:
         List[Dict[str, Any]]: List of valid customer records.
     """
     # Load the JSON schema
-    schema = CUSTOMERS_SCHEMA
-
     valid_customers = []
+    invalid_customers = []
 
     # Keep track of unique ids
-    unique_ids = set()
+    if unique_ids is None:
+        unique_ids = set()
 
     # Validate each customer record against the schema
     for customer in customers_data:
         try:
-            validate(instance=customer, schema=schema)
+            CUSTOMERS_VALIDATOR.validate(customer)
 
             # Convert 'id' to integer
             customer_id = int(customer["id"])
@@ -131,14 +152,17 @@ def transform_and_validate_customers(
             else:
                 # Log or handle duplicate id
                 logger.debug(f"Duplicate id found for customer: {customer['id']}")
-                log_invalid_customer(connection, customer, "Duplicate id", date, hour)
+                invalid_customers.append((customer, "Duplicate id"))
 
         except jsonschema.exceptions.ValidationError as e:
             # Log or handle validation errors
             logger.error(f"Validation error for customer: {e}")
-            log_invalid_customer(connection, customer, str(e), date, hour)
+            invalid_customers.append((customer, str(e)))
             continue
 
+    # Log all invalid customers in one batch
+    log_invalid_customers(connection, invalid_customers, date, hour)
+
     # Update last_change timestamp
     for customer in valid_customers:
         customer["last_change"] = datetime.utcnow().isoformat()
@@ -170,43 +194,24 @@ def log_processed_customers(
     actual_date = extract_actual_date(date)
     actual_hour = extract_actual_hour(hour)
     with connection.cursor() as cursor:
-        for customer_id, first_name, last_name, email in zip(
-            customer_ids, first_names, last_names, emails
-        ):
-            # Check if the record already exists
-            cursor.execute(
-                """
-                SELECT COUNT(*) FROM data.customers
-                WHERE record_date = %s AND record_hour = %s AND id = %s;
-            """,
-                (actual_date, actual_hour, customer_id),
-            )
-
-            count = cursor.fetchone()[0]
-            if count == 0:
-                # Record doesn't exist, insert it
-                cursor.execute(
-                    """
-                    INSERT INTO data.customers (record_date, record_hour, id, first_name, last_name, email)
-                    VALUES (%s, %s, %s, %s, %s, %s);
-                """,
-                    (
-                        actual_date,
-                        actual_hour,
-                        customer_id,
-                        first_name,
-                        last_name,
-                        email,
-                    ),
-                )
-            else:
-                # Record already exists, log or handle accordingly
-                logger.info(
-                    f"Record for customer_id {customer_id} at {actual_date} {actual_hour} already exists."
-                )
+        # Customers that already exist are left untouched
+        upsert_rows(
+            cursor,
+            "data.customers",
+            {
+                "record_date": actual_date,
+                "record_hour": actual_hour,
+                "id": customer_ids,
+                "first_name": first_names,
+                "last_name": last_names,
+                "email": emails,
+            },
+            conflict_columns=("id",),
+        )
     connection.commit()
 
 
+@profiling.profiled_hour("customers")
 def process_hourly_data(
     connection: Any, date: str, hour: str, available_datasets: List[str]
 ) -> None:
@@ -228,27 +233,70 @@ def process_hourly_data(
     # Record the start time
     start_time = datetime.now()
 
-    # Extract raw_data
-    customers_data = extract_data(dataset_paths.get("customers.json.gz", ""))
+    # Extract, transform, validate and load raw_data chunk by chunk
+    stages = StageStatistics()
+    unique_ids = set()
+    record_count = 0
+    # Raw files may come with any of the supported compressions
+    customers_paths = dataset_file_paths(dataset_paths, "customers")
+    stages.counters("extract")["bytes_read"] += get_files_size(customers_paths)
+    # Index the customers by id so erasure requests can target their records
+    with create_processed_data_writer(
+        processed_dataset_type("customers"),
+        date,
+        hour,
+        PROCESSED_DATA_PATH,
+        CUSTOMERS_SCHEMA,
+        index_key="id",
+    ) as writer:
+        for customers_data in stages.iterate(
+            "extract",
+            (chunk for path in customers_paths for chunk in extract_data_chunks(path)),
+        ):
+            with stages.stage(
+                "validate", connection, rows_in=len(customers_data)
+            ) as counters:
+                transformed_customers = transform_and_validate_customers(
+                    connection, customers_data, date, hour, unique_ids
+                )
+                counters["rows_out"] += len(transformed_customers)
+
+            # Load processed raw_data
+            with stages.stage("write", rows_in=len(transformed_customers)):
+                writer.write(transformed_customers)
 
-    # Transform and validate raw_data
-    transformed_customers = transform_and_validate_customers(
-        connection, customers_data, date, hour
-    )
+            # Log processed customers
+            with stages.stage("load", connection, rows_in=len(transformed_customers)):
+                customer_ids = [customer["id"] for customer in transformed_customers]
+                first_names = [
+                    customer["first_name"] for customer in transformed_customers
+                ]
+                last_names = [
+                    customer["last_name"] for customer in transformed_customers
+                ]
+                emails = [customer["email"] for customer in transformed_customers]
+                log_processed_customers(
+                    connection,
+                    date,
+                    hour,
+                    customer_ids,
+                    first_names,
+                    last_names,
+                    emails,
+                )
+            record_count += len(transformed_customers)
 
-    # Load processed raw_data
-    load_data(
-        transformed_customers, "customers.json.gz", date, hour, PROCESSED_DATA_PATH
-    )
+    # Newly committed customers must be visible to the transactions pipeline
+    invalidate_reference_cache("customers")
 
-    # Log processed customers
-    customer_ids = [customer["id"] for customer in transformed_customers]
-    first_names = [customer["first_name"] for customer in transformed_customers]
-    last_names = [customer["last_name"] for customer in transformed_customers]
-    emails = [customer["email"] for customer in transformed_customers]
-    log_processed_customers(
-        connection, date, hour, customer_ids, first_names, last_names, emails
-    )
+    # Archive and delete the original files
+    bytes_in = get_files_size(dataset_paths.values())
+    with stages.stage("archive", rows_in=len(dataset_paths)):
+        for dataset_type, dataset_path in dataset_paths.items():
+            logger.debug("Processing dataset:", dataset_type, "Path:", dataset_path)
+            archive_and_delete(
+                dataset_path, dataset_type, date, hour, ARCHIVED_DATA_PATH
+            )
 
     # Record the end time
     end_time = datetime.now()
@@ -260,14 +308,13 @@ def process_hourly_data(
         date,
         hour,
         "customers.json.gz",
-        len(transformed_customers),
+        record_count,
         processing_time,
+        bytes_in=bytes_in,
+        bytes_out=writer.bytes_written,
+        compression_time=writer.compression_time,
+        stages=stages,
     )
-
-    # Archive and delete the original files
-    for dataset_type, dataset_path in dataset_paths.items():
-        logger.debug("Processing dataset:", dataset_type, "Path:", dataset_path)
-        archive_and_delete(dataset_path, dataset_type, date, hour, ARCHIVED_DATA_PATH)
     logger.debug("Processing completed.")
 
 
@@ -278,34 +325,11 @@ def process_all_data(connection: Any) -> None:
     Args:
         connection (Any): The PostgreSQL connection.
     """
-    # Get a sorted list of date folders
     try:
-        date_folders = os.listdir(RAW_DATA_PATH)
-        date_folders.sort()
-        # Process all available raw_data
-        for date_folder in date_folders:
-            date_path = os.path.join(RAW_DATA_PATH, date_folder)
-
-            # Get a sorted list of hour folders
-            hour_folders = os.listdir(date_path)
-            hour_folders.sort()
-
-            for hour_folder in hour_folders:
-                hour_path = os.path.join(date_path, hour_folder)
-
-                available_datasets = [
-                    filename
-                    for filename in os.listdir(hour_path)
-                    if filename.startswith("customers")
-                    and filename.endswith((".json", ".json.gz"))
-                ]
-
-                if available_datasets:
-                    process_hourly_data(
-                        connection, date_folder, hour_folder, available_datasets
-                    )
-                else:
-                    logger.warning(f"No datasets found for {date_folder}/{hour_folder}")
+        partitions = discover_hour_partitions(connection, RAW_DATA_PATH, "customers")
+        process_hour_partitions(
+            connection, partitions, process_hourly_data, watermark_dataset="customers"
+        )
 
         # Clean up empty directories in raw_data after processing
         cleanup_empty_directories(RAW_DATA_PATH)
@@ -319,12 +343,15 @@ def main() -> None:
     Main function to run the customer data processing pipeline.
     """
     try:
-        with connect_to_postgres() as connection:
+        with profiling.profile_run("customers"), connect_to_postgres() as connection:
             process_all_data(connection)
     except psycopg2.Error:
         logger.exception("An error occurred while processing data")
     except Exception:
         logger.exception("An error occurred")
+    finally:
+        # Publish this run's metrics for the textfile collector
+        metrics.write_textfile("customers_etl")
 
 
 if __name__ == "__main__":
@@ -1,9 +1,11 @@
-from dagster import graph, op
+from dagster import Field, graph, op
+import profiling
 from erasure_requests_etl import main
 
 
-@op
-def erasure_requests_op():
+@op(config_schema={"profiler": Field(str, default_value=profiling.PROFILER)})
+def erasure_requests_op(context):
+    profiling.configure(context.op_config["profiler"], context.run_id)
     main()
 
 
@@ -1,23 +1,51 @@
+import bisect
 import gzip
 import json
 import hashlib
+import itertools
 import logging
 import os
 from datetime import datetime
 from dotenv import load_dotenv
 import jsonschema
-from jsonschema import validate
+import metrics
+import profiling
 from common import (
+    dataset_file_paths,
     connect_to_postgres,
     cleanup_empty_directories,
     archive_and_delete,
     extract_actual_date,
     extract_actual_hour,
     log_processing_statistics,
+    get_files_size,
+    StageStatistics,
     extract_data,
+    upsert_rows,
+    discover_hour_partitions,
+    process_hour_partitions,
+    json_loads,
+    json_dumps_line,
+    open_compressed,
+    DATA_FILE_EXTENSIONS,
+    GZIP_COMPRESSION_LEVEL,
+    PARQUET_COMPRESSION,
+    PARQUET_EXTENSION,
+    SchemaValidator,
+    read_block_table,
+    read_record_index,
+    record_index_path,
+    write_record_index,
 )
 import psycopg2
-from typing import Any, Optional, Tuple, List, Dict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - optional dependency
+    pa = None
+    pq = None
 
 load_dotenv()
 
@@ -31,11 +59,18 @@ PROCESSED_DATA_PATH = "/opt/dagster/app/processed_data"
 ARCHIVED_DATA_PATH = "/opt/dagster/app/archived_data"
 INVALID_RECORDS_TABLE = "data.invalid_customers"
 ERASURE_REQUESTS_SCHEMA_FILE = "erasure_requests_schema.json"
+# Names the customers pipeline gives its processed files, in order of preference
+PROCESSED_CUSTOMERS_FILES = tuple(
+    f"customers{extension}" for extension in DATA_FILE_EXTENSIONS + (PARQUET_EXTENSION,)
+)
 
 
 with open(ERASURE_REQUESTS_SCHEMA_FILE, "r") as schema_file:
     ERASURE_REQUESTS_SCHEMA = json.load(schema_file)
 
+# Build the validator once and reuse it for every record
+ERASURE_REQUESTS_VALIDATOR = SchemaValidator(ERASURE_REQUESTS_SCHEMA)
+
 
 # Query the customers table to get date and hour for a given customer_id
 def get_date_and_hour_to_anonymize(
@@ -81,14 +116,279 @@ def locate_processed_data_file(date: datetime, hour: int) -> Optional[str]:
     processed_data_path = os.path.join(
         PROCESSED_DATA_PATH, str(formatted_date), str(formatted_hour)
     )
-    for filename in os.listdir(processed_data_path):
-        if filename.endswith((".json", ".json.gz")) and filename.startswith(
-            "customers"
-        ):
-            return os.path.join(processed_data_path, filename)
+    for filename in PROCESSED_CUSTOMERS_FILES:
+        file_path = os.path.join(processed_data_path, filename)
+        if os.path.exists(file_path):
+            return file_path
     return None
 
 
+def anonymize_email(email: str) -> str:
+    """
+    Anonymize an email address.
+
+    Args:
+        email (str): The email address to anonymize.
+
+    Returns:
+        str: The SHA-256 hex digest of the email address.
+    """
+    return hashlib.sha256(email.encode()).hexdigest()
+
+
+class StaleRecordIndexError(Exception):
+    """
+    Raised when a record index points at a record of another customer.
+    """
+
+
+def anonymize_customers_in_file(
+    file_path: str, anonymized_emails: Dict[str, str], use_index: bool = True
+) -> int:
+    """
+    Anonymize the emails of the given customers in a processed data file.
+
+    The file is streamed line by line into a temporary file next to it, which
+    then replaces the original. Records of other customers are copied as-is.
+    Files without any of the given customers are left untouched. If the file
+    has a record index, only the indexed lines of the given customers are
+    decoded and the index is updated with the new offsets.
+
+    Args:
+        file_path (str): The path to the processed data file.
+        anonymized_emails (Dict[str, str]): Anonymized emails by customer ID.
+        use_index (bool): Whether to use the record index of the file, if any.
+
+    Returns:
+        int: The number of anonymized records.
+    """
+    if file_path.endswith(PARQUET_EXTENSION):
+        return anonymize_customers_in_parquet(file_path, anonymized_emails)
+
+    index = read_record_index(file_path) if use_index else None
+    target_lines: Optional[Dict[int, str]] = None
+    keys_by_line: Dict[int, str] = {}
+    if index is not None:
+        target_lines = {
+            index[customer_id][0]: customer_id
+            for customer_id in anonymized_emails
+            if customer_id in index
+        }
+        if not target_lines:
+            logger.debug(f"No customers to anonymize in {file_path}")
+            return 0
+        keys_by_line = {line_number: key for key, (line_number, _) in index.items()}
+
+    # The temporary file keeps the extension, and with it the compression
+    temp_path = os.path.join(
+        os.path.dirname(file_path), f".tmp-{os.path.basename(file_path)}"
+    )
+    anonymized_count = 0
+    new_index: Dict[str, Tuple[int, int]] = {}
+    offset = 0
+    try:
+        blocks = read_block_table(file_path) if target_lines is not None else None
+        if blocks is not None:
+            return anonymize_customers_in_blocks(
+                file_path, anonymized_emails, index, target_lines, blocks, temp_path
+            )
+
+        with open_compressed(file_path, "rb") as source, open_compressed(
+            temp_path, "wb"
+        ) as target:
+            line_number = 0
+            for line in source:
+                if not line.strip():
+                    continue
+                if not line.endswith(b"\n"):
+                    line += b"\n"
+
+                record = None
+                if target_lines is None:
+                    record = json_loads(line)
+                    customer_id = record.get("id")
+                else:
+                    customer_id = target_lines.get(line_number)
+                    if customer_id is not None:
+                        record = json_loads(line)
+                        if record.get("id") != customer_id:
+                            raise StaleRecordIndexError(customer_id)
+
+                anonymized_email = anonymized_emails.get(customer_id)
+                if anonymized_email is not None:
+                    # Anonymize the email in the record
+                    record["email"] = anonymized_email
+                    line = json_dumps_line(record)
+                    anonymized_count += 1
+
+                if line_number in keys_by_line:
+                    new_index[keys_by_line[line_number]] = (line_number, offset)
+                target.write(line)
+                offset += len(line)
+                line_number += 1
+
+        if not anonymized_count:
+            # None of the customers are in the file, so it is left untouched
+            logger.debug(f"No customers to anonymize in {file_path}")
+            os.remove(temp_path)
+            return 0
+        os.replace(temp_path, file_path)
+        if index is not None:
+            write_record_index(file_path, "id", new_index)
+    except StaleRecordIndexError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        os.remove(record_index_path(file_path))
+        logger.warning(f"Record index of {file_path} is stale, scanning the file")
+        return anonymize_customers_in_file(
+            file_path, anonymized_emails, use_index=False
+        )
+    except Exception:
+        logger.exception(f"An error occurred while updating file {file_path}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return anonymized_count
+
+
+def anonymize_customers_in_blocks(
+    file_path: str,
+    anonymized_emails: Dict[str, str],
+    index: Dict[str, Tuple[int, int]],
+    target_lines: Dict[int, str],
+    blocks: List[Tuple[int, int, int, int]],
+    temp_path: str,
+) -> int:
+    """
+    Anonymize the emails of the given customers in a block-compressed file.
+
+    Only the blocks holding the given customers are decompressed and
+    recompressed; every other block is copied as compressed bytes. The
+    caller removes the temporary file if anything goes wrong.
+
+    Args:
+        file_path (str): The path to the processed data file.
+        anonymized_emails (Dict[str, str]): Anonymized emails by customer ID.
+        index (Dict[str, Tuple[int, int]]): The record index of the file.
+        target_lines (Dict[int, str]): Customer IDs by the line number of their record.
+        blocks (List[Tuple[int, int, int, int]]): The block table of the file.
+        temp_path (str): The temporary file the new file is written to.
+
+    Returns:
+        int: The number of anonymized records.
+    """
+    first_lines = [first_line for _, _, first_line, _ in blocks]
+    targets_by_block: Dict[int, List[int]] = {}
+    for line_number in sorted(target_lines):
+        block_number = bisect.bisect_right(first_lines, line_number) - 1
+        targets_by_block.setdefault(block_number, []).append(line_number)
+
+    anonymized_count = 0
+    # Change in length of every rewritten line, to shift the offsets after it
+    length_changes: List[Tuple[int, int]] = []
+    new_blocks = []
+    compressed_offset = 0
+    with open(file_path, "rb") as source, open(temp_path, "wb") as target:
+        for block_number, (offset, length, first_line, count) in enumerate(blocks):
+            source.seek(offset)
+            data = source.read(length)
+            if block_number in targets_by_block:
+                lines = gzip.decompress(data).splitlines(keepends=True)
+                for line_number in targets_by_block[block_number]:
+                    customer_id = target_lines[line_number]
+                    line = lines[line_number - first_line]
+                    record = json_loads(line)
+                    if record.get("id") != customer_id:
+                        raise StaleRecordIndexError(customer_id)
+
+                    # Anonymize the email in the record
+                    record["email"] = anonymized_emails[customer_id]
+                    new_line = json_dumps_line(record)
+                    length_changes.append((line_number, len(new_line) - len(line)))
+                    lines[line_number - first_line] = new_line
+                    anonymized_count += 1
+                data = gzip.compress(
+                    b"".join(lines), compresslevel=GZIP_COMPRESSION_LEVEL
+                )
+
+            target.write(data)
+            new_blocks.append((compressed_offset, len(data), first_line, count))
+            compressed_offset += len(data)
+
+    os.replace(temp_path, file_path)
+
+    # Rewritten lines are in file order, so offsets shift by a running total
+    changed_lines = [line for line, _ in length_changes]
+    total_changes = list(itertools.accumulate(change for _, change in length_changes))
+    new_index = {}
+    for key, (line_number, offset) in index.items():
+        changes_before = bisect.bisect_left(changed_lines, line_number)
+        shift = total_changes[changes_before - 1] if changes_before else 0
+        new_index[key] = (line_number, offset + shift)
+    write_record_index(file_path, "id", new_index, new_blocks)
+    return anonymized_count
+
+
+def anonymize_customers_in_parquet(
+    file_path: str, anonymized_emails: Dict[str, str]
+) -> int:
+    """
+    Anonymize the emails of the given customers in a Parquet processed data file.
+
+    Only the id and email columns are read to find the affected rows; the file
+    is rewritten, with the same row groups, only if any are found.
+
+    Args:
+        file_path (str): The path to the processed data file.
+        anonymized_emails (Dict[str, str]): Anonymized emails by customer ID.
+
+    Returns:
+        int: The number of anonymized records.
+    """
+    if pq is None:
+        logger.error(f"pyarrow is required to anonymize {file_path}")
+        return 0
+
+    parquet_file = pq.ParquetFile(file_path)
+    columns = parquet_file.read(columns=["id", "email"]).to_pydict()
+    emails = [
+        anonymized_emails.get(customer_id, email)
+        for customer_id, email in zip(columns["id"], columns["email"])
+    ]
+    anonymized_count = sum(
+        customer_id in anonymized_emails for customer_id in columns["id"]
+    )
+    if not anonymized_count:
+        logger.debug(f"No customers to anonymize in {file_path}")
+        return 0
+
+    temp_path = os.path.join(
+        os.path.dirname(file_path), f".tmp-{os.path.basename(file_path)}"
+    )
+    try:
+        email_position = parquet_file.schema_arrow.get_field_index("email")
+        start = 0
+        with pq.ParquetWriter(
+            temp_path, parquet_file.schema_arrow, compression=PARQUET_COMPRESSION
+        ) as writer:
+            for row_group in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(row_group)
+                end = start + table.num_rows
+                table = table.set_column(
+                    email_position,
+                    table.schema.field(email_position),
+                    pa.array(emails[start:end], type=pa.string()),
+                )
+                writer.write_table(table)
+                start = end
+        os.replace(temp_path, file_path)
+    except Exception:
+        logger.exception(f"An error occurred while updating file {file_path}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return 0
+    return anonymized_count
+
+
 # Anonymize and update the data in the processed data file
 def anonymize_and_update_data(
     file_path: str, customer_id: str, erasure_request: Dict[str, Any]
@@ -102,25 +402,9 @@ def anonymize_and_update_data(
         erasure_request (Dict[str, Any]): The erasure request data.
     """
     email_to_anonymize = erasure_request.get("email")
-    anonymized_email = hashlib.sha256(email_to_anonymize.encode()).hexdigest()
+    anonymized_email = anonymize_email(email_to_anonymize)
     logger.debug(f"email: {email_to_anonymize}, anonymized_email: {anonymized_email}")
-    try:
-        is_gzipped = file_path.endswith(".gz")
-
-        with gzip.open(file_path, "rt") if is_gzipped else open(file_path, "r") as file:
-            data = [json.loads(line) for line in file]
-
-        for record in data:
-            if record.get("id") == customer_id:
-                # Anonymize the email in the record
-                record["email"] = anonymized_email
-
-        with gzip.open(file_path, "wt") if is_gzipped else open(file_path, "w") as file:
-            for record in data:
-                json.dump(record, file)
-                file.write("\n")
-    except Exception:
-        logger.exception(f"An error occurred while updating file {file_path}")
+    anonymize_customers_in_file(file_path, {customer_id: anonymized_email})
 
 
 def archive_updated_file(file_path: str, date: datetime, hour: int) -> None:
@@ -139,35 +423,138 @@ def archive_updated_file(file_path: str, date: datetime, hour: int) -> None:
     archive_file_path = os.path.join(archive_path, archive_file)
 
     os.rename(file_path, archive_file_path)
+
+    # The record index travels with its file
+    index_path = record_index_path(file_path)
+    if os.path.exists(index_path):
+        os.rename(index_path, record_index_path(archive_file_path))
     logger.info(f"File archived: {archive_file_path}")
 
 
-def process_erasure_requests(
+def resolve_customer_locations(
+    connection: Any, customer_ids: Iterable[str]
+) -> Tuple[Dict[Tuple[datetime, int], Set[str]], Set[str]]:
+    """
+    Find the date and hour of many customers with a single query.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        customer_ids (Iterable[str]): The customer IDs.
+
+    Returns:
+        Tuple[Dict[Tuple[datetime, int], Set[str]], Set[str]]: Customer IDs grouped by
+            the date and hour of their record, and the customer IDs that weren't found.
+    """
+    numeric_ids: Dict[int, str] = {}
+    missing_ids = set()
+    for customer_id in customer_ids:
+        try:
+            numeric_ids[int(customer_id)] = customer_id
+        except (TypeError, ValueError):
+            missing_ids.add(customer_id)
+
+    locations: Dict[Tuple[datetime, int], Set[str]] = {}
+    if numeric_ids:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT id, record_date, record_hour FROM data.customers
+                WHERE id = ANY(%s)
+            """,
+                (list(numeric_ids),),
+            )
+            for numeric_id, date, hour in cursor.fetchall():
+                customer_id = numeric_ids.pop(numeric_id)
+                locations.setdefault((date, hour), set()).add(customer_id)
+
+    missing_ids.update(numeric_ids.values())
+    return locations, missing_ids
+
+
+def plan_erasures(
     connection: Any, erasure_requests: List[Dict[str, Any]]
-) -> None:
+) -> Tuple[Dict[Tuple[datetime, int], Dict[str, str]], Set[str]]:
     """
-    Process erasure requests by anonymizing and updating customer data.
+    Group erasure requests by the processed data file that holds the customer.
 
     Args:
         connection (Any): The PostgreSQL connection.
         erasure_requests (List[Dict[str, Any]]): List of erasure requests.
+
+    Returns:
+        Tuple[Dict[Tuple[datetime, int], Dict[str, str]], Set[str]]: Anonymized emails
+            by customer ID, grouped by the date and hour of the customer record, and
+            the customer IDs that weren't found.
     """
+    anonymized_emails = {}
     for erasure_request in erasure_requests:
         customer_id = erasure_request.get("customer-id")
-        if customer_id:
-            # Step 1: Query the processed_data_log table to get date and hour
-            result = get_date_and_hour_to_anonymize(connection, customer_id)
-            if result:
-                date, hour = result
+        email = erasure_request.get("email")
+        if customer_id and isinstance(email, str):
+            anonymized_emails[customer_id] = anonymize_email(email)
 
-                # Step 2: Locate the processed data file
-                file_path = locate_processed_data_file(date, hour)
-                if file_path:
-                    # Step 3: Anonymize and update the data
-                    anonymize_and_update_data(file_path, customer_id, erasure_request)
+    locations, missing_ids = resolve_customer_locations(
+        connection, anonymized_emails.keys()
+    )
+    plan = {
+        location: {
+            customer_id: anonymized_emails[customer_id] for customer_id in customer_ids
+        }
+        for location, customer_ids in locations.items()
+    }
+    return plan, missing_ids
 
-                    # Step 4: Archive the updated file
-                    archive_updated_file(file_path, date, hour)
+
+def process_erasure_requests(
+    connection: Any,
+    erasure_requests: List[Dict[str, Any]],
+    date: Optional[str] = None,
+    hour: Optional[str] = None,
+) -> Set[str]:
+    """
+    Process erasure requests by anonymizing and updating customer data.
+
+    Each affected processed data file is rewritten and archived once, no
+    matter how many of its customers asked for erasure.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        erasure_requests (List[Dict[str, Any]]): List of erasure requests.
+        date (Optional[str]): The date of the erasure requests, needed to log unknown customers.
+        hour (Optional[str]): The hour of the erasure requests, needed to log unknown customers.
+
+    Returns:
+        Set[str]: The customer IDs that weren't found, whose requests weren't processed.
+    """
+    plan, missing_ids = plan_erasures(connection, erasure_requests)
+
+    # Log requests for unknown customers in one batch
+    if missing_ids and date and hour:
+        log_invalid_erasure_requests(
+            connection,
+            [
+                (erasure_request, "Customer not found")
+                for erasure_request in erasure_requests
+                if erasure_request.get("customer-id") in missing_ids
+            ],
+            date,
+            hour,
+        )
+
+    for (record_date, record_hour), anonymized_emails in plan.items():
+        # Locate the processed data file
+        file_path = locate_processed_data_file(record_date, record_hour)
+        if file_path:
+            # Anonymize and update the data
+            anonymized_count = anonymize_customers_in_file(file_path, anonymized_emails)
+            logger.info(f"Anonymized {anonymized_count} customers in {file_path}")
+
+            # Archive the updated file; files without any of the customers
+            # weren't rewritten and stay where they are
+            if anonymized_count:
+                archive_updated_file(file_path, record_date, record_hour)
+
+    return missing_ids
 
 
 def format_date_for_file_system(actual_date: datetime) -> str:
@@ -196,56 +583,93 @@ def format_hour_for_file_system(actual_hour: int) -> str:
     return f"hour={actual_hour:02}"
 
 
-def log_invalid_erasure_request(
+def parse_customer_id(customer_id: Any) -> Optional[int]:
+    """
+    Parse the customer-id of an erasure request as the integer ID of a customer.
+
+    Args:
+        customer_id (Any): The customer-id of the request.
+
+    Returns:
+        Optional[int]: The customer ID, or None if it isn't an integer.
+    """
+    if isinstance(customer_id, bool):
+        return None
+    try:
+        return int(customer_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def log_invalid_erasure_requests(
     connection: Any,
-    erasure_request: Dict[str, Any],
-    error_message: str,
+    invalid_erasure_requests: List[Tuple[Dict[str, Any], str]],
     date: str,
     hour: str,
 ) -> None:
     """
-    Log invalid erasure requests into the database.
+    Log a batch of invalid erasure requests into the database.
+
+    Requests that are already logged as invalid get their error message updated.
 
     Args:
         connection (Any): The PostgreSQL connection.
-        erasure_request (Dict[str, Any]): The invalid erasure request data.
-        error_message (str): The error message describing the validation error.
+        invalid_erasure_requests (List[Tuple[Dict[str, Any], str]]): Invalid erasure requests with their error messages.
         date (str): The date of the data.
         hour (str): The hour of the data.
     """
+    # Invalid requests are keyed by the integer ID of the customer
+    loggable_requests = []
+    for request, error in invalid_erasure_requests:
+        customer_id = parse_customer_id(request.get("customer-id"))
+        if customer_id is None:
+            logger.error(
+                f"Cannot log erasure request without an integer customer-id: "
+                f"{request!r} ({error})"
+            )
+        else:
+            loggable_requests.append((customer_id, error))
+    if not loggable_requests:
+        return
+
     actual_date = extract_actual_date(date)
     actual_hour = extract_actual_hour(hour)
     with connection.cursor() as cursor:
-        # Check if the customer with the same id already exists
-        customer_id = erasure_request.get("customer-id")
-        cursor.execute(
-            """
-            SELECT customer_id FROM data.invalid_erasure_requests WHERE customer_id = %s;
-        """,
-            (customer_id,),
+        upsert_rows(
+            cursor,
+            "data.invalid_erasure_requests",
+            {
+                "record_date": actual_date,
+                "record_hour": actual_hour,
+                "customer_id": [customer_id for customer_id, _ in loggable_requests],
+                "error_message": [error for _, error in loggable_requests],
+            },
+            conflict_columns=("customer_id",),
+            update_columns=("error_message",),
         )
+    connection.commit()
 
-        existing_record = cursor.fetchone()
 
-        if existing_record:
-            # Update the existing record if needed
-            cursor.execute(
-                """
-                UPDATE data.invalid_erasure_requests
-                SET error_message = %s
-                WHERE customer_id = %s;
-            """,
-                (error_message, customer_id),
-            )
-        else:
-            cursor.execute(
-                """
-                INSERT INTO data.invalid_erasure_requests (record_date, record_hour, customer_id, error_message)
-                VALUES (%s, %s, %s, %s);
-            """,
-                (actual_date, actual_hour, customer_id, error_message),
-            )
-    connection.commit()
+def log_invalid_erasure_request(
+    connection: Any,
+    erasure_request: Dict[str, Any],
+    error_message: str,
+    date: str,
+    hour: str,
+) -> None:
+    """
+    Log invalid erasure requests into the database.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        erasure_request (Dict[str, Any]): The invalid erasure request data.
+        error_message (str): The error message describing the validation error.
+        date (str): The date of the data.
+        hour (str): The hour of the data.
+    """
+    log_invalid_erasure_requests(
+        connection, [(erasure_request, error_message)], date, hour
+    )
 
 
 def transform_and_validate_erasure_requests(
@@ -263,9 +687,8 @@ def transform_and_validate_erasure_requests(
     Returns:
         List[Dict[str, Any]]: List of valid erasure requests.
     """
-    schema = ERASURE_REQUESTS_SCHEMA
-
     valid_erasure_requests = []
+    invalid_erasure_requests = []
 
     # Keep track of unique customer-ids
     unique_customer_ids = set()
@@ -274,13 +697,24 @@ def transform_and_validate_erasure_requests(
     for erasure_request in erasure_requests_data:
         try:
             # Perform validation
-            validate(instance=erasure_request, schema=schema)
+            ERASURE_REQUESTS_VALIDATOR.validate(erasure_request)
 
             # Extract customer-id from the erasure request
             customer_id = erasure_request.get("customer-id")
 
+            # Customers have integer IDs, so other IDs can't match any of them
+            if parse_customer_id(customer_id) is None:
+                logger.debug(f"Invalid customer-id in erasure request: {customer_id}")
+                invalid_erasure_requests.append(
+                    (erasure_request, "Invalid customer-id")
+                )
+            # The email is what gets anonymized, so a request without one
+            # can't be carried out
+            elif not erasure_request.get("email"):
+                logger.debug(f"Missing email in erasure request: {customer_id}")
+                invalid_erasure_requests.append((erasure_request, "Missing email"))
             # Check uniqueness of customer-id
-            if customer_id and customer_id not in unique_customer_ids:
+            elif customer_id not in unique_customer_ids:
                 unique_customer_ids.add(customer_id)
                 valid_erasure_requests.append(erasure_request)
             else:
@@ -288,16 +722,19 @@ def transform_and_validate_erasure_requests(
                 logger.debug(
                     f"Duplicate customer-id found for erasure request: {customer_id}"
                 )
-                log_invalid_erasure_request(
-                    connection, erasure_request, "Duplicate customer-id", date, hour
+                invalid_erasure_requests.append(
+                    (erasure_request, "Duplicate customer-id")
                 )
 
         except jsonschema.exceptions.ValidationError as e:
             # Log or handle validation errors
             logger.error(f"Validation error for erasure request: {e}")
-            log_invalid_erasure_request(connection, erasure_request, str(e), date, hour)
+            invalid_erasure_requests.append((erasure_request, str(e)))
             continue
 
+    # Log all invalid erasure requests in one batch
+    log_invalid_erasure_requests(connection, invalid_erasure_requests, date, hour)
+
     return valid_erasure_requests
 
 
@@ -317,34 +754,22 @@ def log_processed_erasure_requests(
     actual_date = extract_actual_date(date)
     actual_hour = extract_actual_hour(hour)
     with connection.cursor() as cursor:
-        for customer_id, email in zip(customer_ids, emails):
-            # Check if the record already exists
-            cursor.execute(
-                """
-                SELECT COUNT(*) FROM data.erasure_requests
-                WHERE record_date = %s AND record_hour = %s AND customer_id = %s;
-            """,
-                (actual_date, actual_hour, customer_id),
-            )
-
-            count = cursor.fetchone()[0]
-            if count == 0:
-                # Record doesn't exist, insert it
-                cursor.execute(
-                    """
-                    INSERT INTO data.erasure_requests (record_date, record_hour, customer_id, email)
-                    VALUES (%s, %s, %s, %s);
-                """,
-                    (actual_date, actual_hour, customer_id, email),
-                )
-            else:
-                # Record already exists, log or handle accordingly
-                logger.info(
-                    f"Record for customer_id {customer_id} at {actual_date} {actual_hour} already exists."
-                )
+        # Erasure requests that were already logged are left untouched
+        upsert_rows(
+            cursor,
+            "data.erasure_requests",
+            {
+                "record_date": actual_date,
+                "record_hour": actual_hour,
+                "customer_id": customer_ids,
+                "email": emails,
+            },
+            conflict_columns=("customer_id",),
+        )
     connection.commit()
 
 
+@profiling.profiled_hour("erasure_requests")
 def process_hourly_data(
     connection: Any, date: str, hour: str, available_datasets: List[str]
 ) -> None:
@@ -366,26 +791,51 @@ def process_hourly_data(
     # Record the start time
     start_time = datetime.now()
 
-    # Extract raw_data from both .json.gz and .json files
+    # Extract raw_data from the files of every supported compression
+    stages = StageStatistics()
     erasure_requests_data = []
-    for dataset_type in ["erasure-requests.json.gz", "erasure-requests.json"]:
-        if dataset_type in dataset_paths:
-            erasure_requests_data.extend(extract_data(dataset_paths[dataset_type]))
-
-    transformed_and_validated_erasure_requests = (
-        transform_and_validate_erasure_requests(
-            connection, erasure_requests_data, date, hour
+    bytes_in = get_files_size(dataset_paths.values())
+    with stages.stage("extract", bytes_read=bytes_in) as counters:
+        for path in dataset_file_paths(dataset_paths, "erasure-requests"):
+            erasure_requests_data.extend(extract_data(path))
+        counters["rows_out"] += len(erasure_requests_data)
+
+    with stages.stage(
+        "validate", connection, rows_in=len(erasure_requests_data)
+    ) as counters:
+        transformed_and_validated_erasure_requests = (
+            transform_and_validate_erasure_requests(
+                connection, erasure_requests_data, date, hour
+            )
         )
-    )
+        counters["rows_out"] += len(transformed_and_validated_erasure_requests)
 
-    process_erasure_requests(connection, erasure_requests_data)
-    customer_ids = [
-        request["customer-id"] for request in transformed_and_validated_erasure_requests
-    ]
-    emails = [
-        request["email"] for request in transformed_and_validated_erasure_requests
+    with stages.stage(
+        "erase", connection, rows_in=len(transformed_and_validated_erasure_requests)
+    ):
+        missing_ids = process_erasure_requests(
+            connection, transformed_and_validated_erasure_requests, date, hour
+        )
+    # Requests for unknown customers are logged as invalid, not as processed
+    processed_erasure_requests = [
+        request
+        for request in transformed_and_validated_erasure_requests
+        if request["customer-id"] not in missing_ids
     ]
-    log_processed_erasure_requests(connection, date, hour, customer_ids, emails)
+
+    with stages.stage("load", connection, rows_in=len(processed_erasure_requests)):
+        customer_ids = [
+            request["customer-id"] for request in processed_erasure_requests
+        ]
+        emails = [request["email"] for request in processed_erasure_requests]
+        log_processed_erasure_requests(connection, date, hour, customer_ids, emails)
+
+    # Archive and delete the original files
+    with stages.stage("archive", rows_in=len(dataset_paths)):
+        for dataset_type, dataset_path in dataset_paths.items():
+            archive_and_delete(
+                dataset_path, dataset_type, date, hour, ARCHIVED_DATA_PATH
+            )
 
     # Record the end time
     end_time = datetime.now()
@@ -399,11 +849,9 @@ def process_hourly_data(
         "erasure_requests.json.gz",
         len(erasure_requests_data),
         processing_time,
+        bytes_in=bytes_in,
+        stages=stages,
     )
-
-    # Archive and delete the original files
-    for dataset_type, dataset_path in dataset_paths.items():
-        archive_and_delete(dataset_path, dataset_type, date, hour, ARCHIVED_DATA_PATH)
     logger.debug("Processing completed.")
 
 
@@ -414,34 +862,17 @@ def process_all_data(connection: Any) -> None:
     Args:
         connection (Any): The PostgreSQL connection.
     """
-    # Get a sorted list of date folders
     try:
-        date_folders = os.listdir(RAW_DATA_PATH)
-        date_folders.sort()
-        # Process all available raw_data
-        for date_folder in date_folders:
-            date_path = os.path.join(RAW_DATA_PATH, date_folder)
-
-            # Get a sorted list of hour folders
-            hour_folders = os.listdir(date_path)
-            hour_folders.sort()
-
-            for hour_folder in hour_folders:
-                hour_path = os.path.join(date_path, hour_folder)
-
-                available_datasets = [
-                    filename
-                    for filename in os.listdir(hour_path)
-                    if filename.startswith("erasure")
-                    and filename.endswith((".json", ".json.gz"))
-                ]
-
-                if available_datasets:
-                    process_hourly_data(
-                        connection, date_folder, hour_folder, available_datasets
-                    )
-                else:
-                    logger.warning(f"No datasets found for {date_folder}/{hour_folder}")
+        partitions = discover_hour_partitions(connection, RAW_DATA_PATH, "erasure")
+
+        # Erasure rewrites shared processed files, so hours are applied in order
+        process_hour_partitions(
+            connection,
+            partitions,
+            process_hourly_data,
+            ordered=True,
+            watermark_dataset="erasure",
+        )
 
         # Clean up empty directories in raw_data after processing
         cleanup_empty_directories(RAW_DATA_PATH)
@@ -455,12 +886,17 @@ def main() -> None:
     Main function to run the erasure requests processing pipeline.
     """
     try:
-        with connect_to_postgres() as connection:
+        with profiling.profile_run(
+            "erasure_requests"
+        ), connect_to_postgres() as connection:
             process_all_data(connection)
     except psycopg2.Error:
         logger.exception("An error occurred while processing data")
     except Exception:
         logger.exception("An error occurred")
+    finally:
+        # Publish this run's metrics for the textfile collector
+        metrics.write_textfile("erasure_requests_etl")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,36 @@
+from dagster import Field, graph, op
+import profiling
+from common import connect_to_postgres
+from ingest_etl import main, process_partitions
+
+
+@op(config_schema={"profiler": Field(str, default_value=profiling.PROFILER)})
+def ingest_op(context):
+    profiling.configure(context.op_config["profiler"], context.run_id)
+    main()
+
+
+@op(
+    config_schema={
+        "partitions": [{"date": str, "hour": str}],
+        "profiler": Field(str, default_value=profiling.PROFILER),
+    }
+)
+def ingest_partitions_op(context):
+    profiling.configure(context.op_config["profiler"], context.run_id)
+    hour_folders = [
+        (partition["date"], partition["hour"])
+        for partition in context.op_config["partitions"]
+    ]
+    with profiling.profile_run("ingest"), connect_to_postgres() as connection:
+        process_partitions(connection, hour_folders)
+
+
+@graph
+def ingest_graph():
+    ingest_op()
+
+
+@graph
+def ingest_partitions_graph():
+    ingest_partitions_op()
@@ -0,0 +1,283 @@
+import logging
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence, Tuple
+from dotenv import load_dotenv
+import psycopg2
+import metrics
+import profiling
+from common import (
+    connect_to_postgres,
+    scan_hour_partitions,
+    poll_raw_data_partitions,
+    get_ingest_watermark,
+    process_hour_partitions,
+    cleanup_partition_directories,
+    INGEST_WATERMARKS,
+    INGEST_POLL_INTERVAL_SECONDS,
+    RAW_FILE_SETTLE_SECONDS,
+)
+import customers_etl
+import erasure_requests_etl
+import products_etl
+import transactions_etl
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # pragma: no cover - optional dependency
+    FileSystemEventHandler = object
+    Observer = None
+
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+RAW_DATA_PATH = "/opt/dagster/app/raw_data"
+
+
+class Pipeline(NamedTuple):
+    dataset_prefix: str
+    process_hourly_data: Callable[[Any, str, str, List[str]], None]
+    ordered: bool
+
+
+# Pipelines in dependency order: transactions reference products and customers,
+# and erasure requests rewrite processed customers
+PIPELINES = [
+    Pipeline("products", products_etl.process_hourly_data, ordered=True),
+    Pipeline("customers", customers_etl.process_hourly_data, ordered=False),
+    Pipeline("transactions", transactions_etl.process_hourly_data, ordered=False),
+    Pipeline("erasure", erasure_requests_etl.process_hourly_data, ordered=True),
+]
+
+
+def run_pipelines(
+    connection: Any,
+    partitions: List[Tuple[str, str, Any]],
+    advance_watermarks: bool = True,
+) -> None:
+    """
+    Run every pipeline over the hour partitions found by a scan of the tree.
+
+    Pipelines run one after the other in dependency order, each over all of
+    its hours. If a pipeline fails, the pipelines that depend on it are not
+    run.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        partitions (List[Tuple[str, str, Any]]): Date folder, hour folder and
+            the files of each dataset, as returned by scan_hour_partitions.
+        advance_watermarks (bool): Whether the ingest watermarks follow the
+            processed partitions. Only a scan from the watermarks onwards may
+            advance them, since other partitions can be older than an
+            unprocessed one.
+    """
+    try:
+        for pipeline in PIPELINES:
+            pipeline_partitions = [
+                (date_folder, hour_folder, datasets[pipeline.dataset_prefix])
+                for date_folder, hour_folder, datasets in partitions
+                if pipeline.dataset_prefix in datasets
+            ]
+            logger.info(
+                f"Processing {len(pipeline_partitions)} hours of {pipeline.dataset_prefix}"
+            )
+            process_hour_partitions(
+                connection,
+                pipeline_partitions,
+                pipeline.process_hourly_data,
+                ordered=pipeline.ordered,
+                watermark_dataset=(
+                    pipeline.dataset_prefix if advance_watermarks else None
+                ),
+            )
+
+    except (psycopg2.Error, Exception):
+        logger.exception("An error occurred while processing data")
+
+    finally:
+        # Only the directories this run looked at can have been emptied by it
+        cleanup_partition_directories(RAW_DATA_PATH, partitions)
+
+
+def process_all_data(connection: Any) -> None:
+    """
+    Process all available raw data of every dataset from a single walk of the tree.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+    """
+    since = {}
+    if INGEST_WATERMARKS:
+        since = {
+            pipeline.dataset_prefix: get_ingest_watermark(
+                connection, pipeline.dataset_prefix
+            )
+            for pipeline in PIPELINES
+        }
+    partitions = scan_hour_partitions(
+        RAW_DATA_PATH, [pipeline.dataset_prefix for pipeline in PIPELINES], since
+    )
+    run_pipelines(connection, partitions)
+
+
+def process_partitions(
+    connection: Any, hour_folders: Sequence[Tuple[str, str]]
+) -> None:
+    """
+    Process the raw data of every dataset in the given hour partitions only.
+
+    The ingest watermarks are left alone: an older hour may have failed and
+    must still be found by the next process_all_data run.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        hour_folders (Sequence[Tuple[str, str]]): The date and hour folders to
+            process, e.g. ("date=2022-01-01", "hour=10").
+    """
+    partitions = scan_hour_partitions(
+        RAW_DATA_PATH,
+        [pipeline.dataset_prefix for pipeline in PIPELINES],
+        hour_folders=hour_folders,
+    )
+    run_pipelines(connection, partitions, advance_watermarks=False)
+
+
+def partition_key_to_hour_folders(partition_key: str) -> Tuple[str, str]:
+    """
+    Map an hourly Dagster partition key to its raw_data date and hour folders.
+
+    Args:
+        partition_key (str): The partition key, e.g. "2022-01-01-10:00".
+
+    Returns:
+        Tuple[str, str]: The date and hour folders, e.g. ("date=2022-01-01", "hour=10").
+    """
+    partition = datetime.strptime(partition_key, "%Y-%m-%d-%H:%M")
+    return f"date={partition:%Y-%m-%d}", f"hour={partition:%H}"
+
+
+def process_dataset_partition(
+    connection: Any, dataset_prefix: str, date_folder: str, hour_folder: str
+) -> List[str]:
+    """
+    Process the raw data of a single dataset in a single hour partition.
+
+    Unlike the other entry points, errors are re-raised so the caller can mark
+    the partition as failed and retry it. Partitions can be processed in any
+    order, so the ingest watermark is left alone.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        dataset_prefix (str): The filename prefix of the dataset's pipeline.
+        date_folder (str): The date folder, e.g. "date=2022-01-01".
+        hour_folder (str): The hour folder, e.g. "hour=10".
+
+    Returns:
+        List[str]: The raw files that were processed, empty if the hour has none.
+    """
+    pipeline = next(p for p in PIPELINES if p.dataset_prefix == dataset_prefix)
+    partitions = scan_hour_partitions(
+        RAW_DATA_PATH, [dataset_prefix], hour_folders=[(date_folder, hour_folder)]
+    )
+    pipeline_partitions = [
+        (date_folder, hour_folder, datasets[dataset_prefix])
+        for date_folder, hour_folder, datasets in partitions
+        if dataset_prefix in datasets
+    ]
+    try:
+        process_hour_partitions(
+            connection,
+            pipeline_partitions,
+            pipeline.process_hourly_data,
+            ordered=True,
+        )
+    finally:
+        cleanup_partition_directories(RAW_DATA_PATH, partitions)
+
+    return [filename for _, _, files in pipeline_partitions for filename in files]
+
+
+class _WakeUpHandler(FileSystemEventHandler):
+    def __init__(self, event: threading.Event) -> None:
+        self.event = event
+
+    def on_any_event(self, _event: Any) -> None:
+        self.event.set()
+
+
+def watch(
+    poll_interval: float = INGEST_POLL_INTERVAL_SECONDS,
+    settle_seconds: float = RAW_FILE_SETTLE_SECONDS,
+    max_polls: Optional[int] = None,
+) -> None:
+    """
+    Keep ingesting raw data partitions as soon as their files have finished landing.
+
+    raw_data is polled every poll_interval seconds. When watchdog is
+    installed, file system events wake the watcher up early instead.
+
+    Args:
+        poll_interval (float): Seconds between polls of raw_data.
+        settle_seconds (float): How long a raw file must be left untouched.
+        max_polls (Optional[int]): Stop after this many polls; None runs forever.
+    """
+    metrics.serve()
+    wake_up = threading.Event()
+    observer = None
+    if Observer is not None:
+        observer = Observer()
+        observer.schedule(_WakeUpHandler(wake_up), RAW_DATA_PATH, recursive=True)
+        observer.start()
+
+    state = {}
+    polls = 0
+    try:
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            hour_folders, state = poll_raw_data_partitions(
+                RAW_DATA_PATH, state, time.time(), settle_seconds
+            )
+            if hour_folders:
+                logger.info(f"Ingesting finished partitions: {hour_folders}")
+                try:
+                    with connect_to_postgres() as connection:
+                        process_partitions(connection, hour_folders)
+                except psycopg2.Error:
+                    logger.exception("An error occurred while processing data")
+
+            wake_up.wait(poll_interval)
+            wake_up.clear()
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
+def main() -> None:
+    """
+    Main function to run every data processing pipeline.
+    """
+    try:
+        with profiling.profile_run("ingest"), connect_to_postgres() as connection:
+            process_all_data(connection)
+    except psycopg2.Error:
+        logger.exception("An error occurred while processing data")
+    except Exception:
+        logger.exception("An error occurred")
+    finally:
+        # Publish this run's metrics for the textfile collector
+        metrics.write_textfile("ingest_etl")
+
+
+if __name__ == "__main__":
+    if "--watch" in sys.argv[1:]:
+        watch()
+    else:
+        main()
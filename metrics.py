@@ -0,0 +1,241 @@
+import logging
+import os
+import threading
+from datetime import timedelta
+from typing import Any, Optional
+
+from settings import env_int, env_str
+
+try:
+    from prometheus_client import (
+        CollectorRegistry,
+        Counter,
+        Gauge,
+        Histogram,
+        start_http_server,
+        write_to_textfile,
+    )
+except ImportError:  # pragma: no cover - optional dependency
+    CollectorRegistry = None
+
+logger = logging.getLogger(__name__)
+
+# Port of the HTTP endpoint serving the metrics (0 disables it)
+METRICS_PORT = env_int("METRICS_PORT", 0)
+
+# Directory of the node_exporter textfile collector the metrics of each
+# run are written to (empty disables it)
+METRICS_TEXTFILE_DIR = env_str("METRICS_TEXTFILE_DIR", "")
+
+HOUR_DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+STAGE_DURATION_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_server_lock = threading.Lock()
+_server_started = False
+
+if CollectorRegistry is not None:
+    REGISTRY = CollectorRegistry()
+    RECORDS_PROCESSED = Counter(
+        "etl_records_processed",
+        "Records written to processed data and loaded into PostgreSQL.",
+        ["dataset"],
+        registry=REGISTRY,
+    )
+    RECORDS_INVALID = Counter(
+        "etl_records_invalid",
+        "Records rejected by validation.",
+        ["dataset"],
+        registry=REGISTRY,
+    )
+    BYTES_READ = Counter(
+        "etl_raw_bytes_read",
+        "Bytes of raw files read.",
+        ["dataset"],
+        registry=REGISTRY,
+    )
+    HOUR_DURATION = Histogram(
+        "etl_hour_duration_seconds",
+        "Time taken to process one hour of a dataset.",
+        ["dataset"],
+        buckets=HOUR_DURATION_BUCKETS,
+        registry=REGISTRY,
+    )
+    STAGE_DURATION = Histogram(
+        "etl_stage_duration_seconds",
+        "Time spent in one stage of processing an hour of a dataset.",
+        ["dataset", "stage"],
+        buckets=STAGE_DURATION_BUCKETS,
+        registry=REGISTRY,
+    )
+    BACKLOG_PARTITIONS = Gauge(
+        "etl_backlog_partitions",
+        "Raw data hour partitions of a dataset waiting to be processed.",
+        ["dataset"],
+        registry=REGISTRY,
+    )
+    POOL_CONNECTIONS_IN_USE = Gauge(
+        "etl_pool_connections_in_use",
+        "PostgreSQL connections checked out of the pool.",
+        registry=REGISTRY,
+    )
+    POOL_CONNECTIONS_MAX = Gauge(
+        "etl_pool_connections_max",
+        "Maximum number of PostgreSQL connections in the pool.",
+        registry=REGISTRY,
+    )
+
+
+def is_enabled() -> bool:
+    """
+    Check whether prometheus_client is installed.
+
+    Returns:
+        bool: True if metrics are collected.
+    """
+    return CollectorRegistry is not None
+
+
+def dataset_label(dataset_type: str) -> str:
+    """
+    Turn a dataset type such as "customers.json.gz" into a metric label.
+
+    Args:
+        dataset_type (str): The dataset type.
+
+    Returns:
+        str: The dataset name without file extensions.
+    """
+    return dataset_type.split(".", 1)[0]
+
+
+def observe_hour(
+    dataset_type: str,
+    record_count: int,
+    processing_time: timedelta,
+    stages: Optional[Any] = None,
+) -> None:
+    """
+    Record the outcome of processing one hour of a dataset.
+
+    Args:
+        dataset_type (str): The type of the processed dataset.
+        record_count (int): The number of records processed.
+        processing_time (timedelta): The time taken for processing.
+        stages (Optional[StageStatistics]): The statistics of each stage of the hour.
+    """
+    if not is_enabled():
+        return
+
+    dataset = dataset_label(dataset_type)
+    RECORDS_PROCESSED.labels(dataset).inc(record_count)
+    HOUR_DURATION.labels(dataset).observe(processing_time.total_seconds())
+    if stages is None:
+        return
+
+    for name, counters in stages.stages.items():
+        STAGE_DURATION.labels(dataset, name).observe(counters["duration_ns"] / 1e9)
+    validate = stages.stages.get("validate")
+    if validate is not None:
+        RECORDS_INVALID.labels(dataset).inc(validate["rows_in"] - validate["rows_out"])
+    extract = stages.stages.get("extract")
+    if extract is not None:
+        BYTES_READ.labels(dataset).inc(extract["bytes_read"])
+
+
+def set_backlog(dataset: str, partition_count: int) -> None:
+    """
+    Set the number of hour partitions of a dataset waiting to be processed.
+
+    Args:
+        dataset (str): The dataset name.
+        partition_count (int): The number of waiting partitions.
+    """
+    if is_enabled():
+        BACKLOG_PARTITIONS.labels(dataset_label(dataset)).set(partition_count)
+
+
+def partition_processed(dataset: str) -> None:
+    """
+    Take one processed hour partition off a dataset's backlog.
+
+    Args:
+        dataset (str): The dataset name.
+    """
+    if is_enabled():
+        BACKLOG_PARTITIONS.labels(dataset_label(dataset)).dec()
+
+
+def set_pool_size(maxconn: int) -> None:
+    """
+    Set the maximum number of connections in the PostgreSQL pool.
+
+    Args:
+        maxconn (int): The maximum number of connections.
+    """
+    if is_enabled():
+        POOL_CONNECTIONS_MAX.set(maxconn)
+
+
+def connection_checked_out() -> None:
+    """
+    Count a connection checked out of the PostgreSQL pool.
+    """
+    if is_enabled():
+        POOL_CONNECTIONS_IN_USE.inc()
+
+
+def connection_returned() -> None:
+    """
+    Count a connection returned to the PostgreSQL pool.
+    """
+    if is_enabled():
+        POOL_CONNECTIONS_IN_USE.dec()
+
+
+def serve(port: int = METRICS_PORT) -> bool:
+    """
+    Serve the metrics over HTTP from this process, once.
+
+    Every process loading the Dagster repository calls this, including the
+    run workers. Only the first to bind the port serves the metrics; the
+    others log a warning and carry on.
+
+    Args:
+        port (int): The port to listen on; 0 doesn't serve them.
+
+    Returns:
+        bool: True if the metrics are served by this process.
+    """
+    global _server_started
+
+    if not port or not is_enabled():
+        return False
+    with _server_lock:
+        if not _server_started:
+            try:
+                start_http_server(port, registry=REGISTRY)
+            except OSError as e:
+                logger.warning(f"Not serving metrics on port {port}: {e}")
+                return False
+            _server_started = True
+            logger.info(f"Serving metrics on port {port}")
+    return True
+
+
+def write_textfile(job_name: str, directory: str = METRICS_TEXTFILE_DIR) -> None:
+    """
+    Write the metrics of this process to <directory>/<job_name>.prom.
+
+    The file is replaced atomically, so the textfile collector never reads a
+    partial file.
+
+    Args:
+        job_name (str): The name of the job, used as the file name.
+        directory (str): The textfile collector directory; empty doesn't write.
+    """
+    if not directory or not is_enabled():
+        return
+    try:
+        write_to_textfile(os.path.join(directory, f"{job_name}.prom"), REGISTRY)
+    except OSError:
+        logger.exception("Failed to write the metrics textfile")
@@ -4,19 +4,29 @@ import os
 from datetime import datetime
 from dotenv import load_dotenv
 import jsonschema
-from jsonschema import validate
+import metrics
+import profiling
 from common import (
+    dataset_file_paths,
     connect_to_postgres,
     cleanup_empty_directories,
     archive_and_delete,
     log_processing_statistics,
-    extract_data,
-    load_data,
+    StageStatistics,
+    extract_data_chunks,
+    create_processed_data_writer,
     extract_actual_date,
     extract_actual_hour,
+    invalidate_reference_cache,
+    upsert_rows,
+    discover_hour_partitions,
+    process_hour_partitions,
+    processed_dataset_type,
+    get_files_size,
+    SchemaValidator,
 )
 import psycopg2
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
 load_dotenv()
 
@@ -33,42 +43,67 @@ PRODUCTS_SCHEMA_FILE = "products_schema.json"
 with open(PRODUCTS_SCHEMA_FILE, "r") as schema_file:
     PRODUCTS_SCHEMA = json.load(schema_file)
 
+# Build the validator once and reuse it for every record
+PRODUCTS_VALIDATOR = SchemaValidator(PRODUCTS_SCHEMA)
 
-def log_invalid_product(
-    connection: Any, product: Dict[str, Any], error_message: str, date: str, hour: str
+
+def log_invalid_products(
+    connection: Any,
+    invalid_products: List[Tuple[Dict[str, Any], str]],
+    date: str,
+    hour: str,
 ) -> None:
     """
-    Log invalid product information into the database.
+    Log a batch of invalid product information into the database.
 
     Args:
         connection (Any): The PostgreSQL connection.
-        product (Dict[str, Any]): The invalid product information.
-        error_message (str): The error message describing the validation error.
+        invalid_products (List[Tuple[Dict[str, Any], str]]): Invalid products with their error messages.
         date (str): The date of the data.
         hour (str): The hour of the data.
     """
+    if not invalid_products:
+        return
+
     actual_date = extract_actual_date(date)
     actual_hour = extract_actual_hour(hour)
+    products = [product for product, _ in invalid_products]
     with connection.cursor() as cursor:
-        cursor.execute(
-            """
-            INSERT INTO data.invalid_products (record_date, record_hour, sku, name, price, category, popularity, error_message)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-        """,
-            (
-                actual_date,
-                actual_hour,
-                product.get("sku"),
-                product.get("name"),
-                product.get("price"),
-                product.get("category"),
-                product.get("popularity"),
-                error_message,
-            ),
+        upsert_rows(
+            cursor,
+            "data.invalid_products",
+            {
+                "record_date": actual_date,
+                "record_hour": actual_hour,
+                "sku": [product.get("sku") for product in products],
+                "name": [product.get("name") for product in products],
+                "price": [product.get("price") for product in products],
+                "category": [product.get("category") for product in products],
+                "popularity": [product.get("popularity") for product in products],
+                "error_message": [error for _, error in invalid_products],
+            },
+            conflict_columns=("sku", "record_date", "record_hour"),
+            update_columns=("name", "price", "category", "popularity", "error_message"),
         )
     connection.commit()
 
 
+def log_invalid_product(
+    connection: Any, product: Dict[str, Any], error_message: str, date: str, hour: str
+) -> None:
+    """
+    Log invalid product information into the database.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        product (Dict[str, Any]): The invalid product information.
+        error_message (str): The error message describing the validation error.
+        date (str): The date of the data.
+        hour (str): The hour of the data.
+    """
+    log_invalid_products(connection, [(product, error_message)], date, hour)
+
+
 def transform_and_validate_products(
     connection: Any, products_data: List[Dict[str, Any]], date: str, hour: str
 ) -> List[Dict[str, Any]]:
@@ -84,24 +119,25 @@ def transform_and_validate_products(
     Returns:
         List[Dict[str, Any]]: List of valid products.
     """
-    schema = PRODUCTS_SCHEMA
-
     valid_products = []
+    invalid_products = []
 
     # Validate each product record against the schema
     for product in products_data:
         try:
             # Convert 'price' to a number before validation
             product["price"] = float(product["price"])
-            validate(instance=product, schema=schema)
+            PRODUCTS_VALIDATOR.validate(product)
             valid_products.append(product)
         except jsonschema.exceptions.ValidationError as e:
             # Log or handle validation errors
             logger.error(f"Validation error for product: {e}")
-            # Log the invalid record to the database
-            log_invalid_product(connection, product, str(e), date, hour)
+            invalid_products.append((product, str(e)))
             continue
 
+    # Log all invalid records to the database in one batch
+    log_invalid_products(connection, invalid_products, date, hour)
+
     # Update last_change timestamp
     for product in valid_products:
         product["last_change"] = datetime.utcnow().isoformat()
@@ -135,36 +171,36 @@ def log_processed_products(
     actual_date = extract_actual_date(date)
     actual_hour = extract_actual_hour(hour)
     with connection.cursor() as cursor:
-        for sku, name, price, category, popularity in zip(
-            skus, names, prices, categories, popularities
-        ):
-            # Check if the record already exists
-            cursor.execute(
-                """
-                SELECT COUNT(*) FROM data.products
-                WHERE record_date = %s AND record_hour = %s AND sku = %s;
-            """,
-                (actual_date, actual_hour, sku),
-            )
-
-            count = cursor.fetchone()[0]
-            if count == 0:
-                # Record doesn't exist, insert it
-                cursor.execute(
-                    """
-                    INSERT INTO data.products (sku, name, price, category, popularity, record_date, record_hour)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s);
-                """,
-                    (sku, name, price, category, popularity, actual_date, actual_hour),
-                )
-            else:
-                # Record already exists, log or handle accordingly
-                logger.info(
-                    f"Record for sku {sku} at {actual_date} {actual_hour} already exists."
-                )
+        # Products that already exist take the latest name, price, category
+        # and popularity. processed_at is reset to the insert default so the
+        # reference data caches pick the change up on their next refresh.
+        upsert_rows(
+            cursor,
+            "data.products",
+            {
+                "sku": skus,
+                "name": names,
+                "price": prices,
+                "category": categories,
+                "popularity": popularities,
+                "record_date": actual_date,
+                "record_hour": actual_hour,
+            },
+            conflict_columns=("sku",),
+            update_columns=(
+                "name",
+                "price",
+                "category",
+                "popularity",
+                "record_date",
+                "record_hour",
+                "processed_at",
+            ),
+        )
     connection.commit()
 
 
+@profiling.profiled_hour("products")
 def process_hourly_data(
     connection: Any, date: str, hour: str, available_datasets: List[str]
 ) -> None:
@@ -186,26 +222,67 @@ def process_hourly_data(
     # Record the start time
     start_time = datetime.now()
 
-    # Extract raw_data
-    products_data = extract_data(dataset_paths.get("products.json.gz", ""))
+    # Extract, transform, validate and load raw_data chunk by chunk
+    stages = StageStatistics()
+    record_count = 0
+    # Raw files may come with any of the supported compressions
+    products_paths = dataset_file_paths(dataset_paths, "products")
+    stages.counters("extract")["bytes_read"] += get_files_size(products_paths)
+    with create_processed_data_writer(
+        processed_dataset_type("products"),
+        date,
+        hour,
+        PROCESSED_DATA_PATH,
+        PRODUCTS_SCHEMA,
+        extra_fields={"last_change": "string"},
+    ) as writer:
+        for products_data in stages.iterate(
+            "extract",
+            (chunk for path in products_paths for chunk in extract_data_chunks(path)),
+        ):
+            with stages.stage(
+                "validate", connection, rows_in=len(products_data)
+            ) as counters:
+                transformed_products = transform_and_validate_products(
+                    connection, products_data, date, hour
+                )
+                counters["rows_out"] += len(transformed_products)
+
+            # Load processed raw_data
+            with stages.stage("write", rows_in=len(transformed_products)):
+                writer.write(transformed_products)
+
+            # Log processed products
+            with stages.stage("load", connection, rows_in=len(transformed_products)):
+                skus = [product["sku"] for product in transformed_products]
+                names = [product["name"] for product in transformed_products]
+                prices = [product["price"] for product in transformed_products]
+                categories = [product["category"] for product in transformed_products]
+                popularities = [
+                    product["popularity"] for product in transformed_products
+                ]
+                log_processed_products(
+                    connection,
+                    date,
+                    hour,
+                    skus,
+                    names,
+                    prices,
+                    categories,
+                    popularities,
+                )
+            record_count += len(transformed_products)
 
-    # Transform and validate raw_data
-    transformed_products = transform_and_validate_products(
-        connection, products_data, date, hour
-    )
+    # Newly committed products must be visible to the transactions pipeline
+    invalidate_reference_cache("products")
 
-    # Load processed raw_data
-    load_data(transformed_products, "products.json.gz", date, hour, PROCESSED_DATA_PATH)
-
-    # Log processed products
-    skus = [product["sku"] for product in transformed_products]
-    names = [product["name"] for product in transformed_products]
-    prices = [product["price"] for product in transformed_products]
-    categories = [product["category"] for product in transformed_products]
-    popularities = [product["popularity"] for product in transformed_products]
-    log_processed_products(
-        connection, date, hour, skus, names, prices, categories, popularities
-    )
+    # Archive and delete the original files
+    bytes_in = get_files_size(dataset_paths.values())
+    with stages.stage("archive", rows_in=len(dataset_paths)):
+        for dataset_type, dataset_path in dataset_paths.items():
+            archive_and_delete(
+                dataset_path, dataset_type, date, hour, ARCHIVED_DATA_PATH
+            )
 
     # Record the end time
     end_time = datetime.now()
@@ -217,13 +294,13 @@ def process_hourly_data(
         date,
         hour,
         "products.json.gz",
-        len(transformed_products),
+        record_count,
         processing_time,
+        bytes_in=bytes_in,
+        bytes_out=writer.bytes_written,
+        compression_time=writer.compression_time,
+        stages=stages,
     )
-
-    # Archive and delete the original files
-    for dataset_type, dataset_path in dataset_paths.items():
-        archive_and_delete(dataset_path, dataset_type, date, hour, ARCHIVED_DATA_PATH)
     logger.debug("Processing completed.")
 
 
@@ -235,32 +312,16 @@ def process_all_data(connection: Any) -> None:
         connection (Any): The PostgreSQL connection.
     """
     try:
-        date_folders = os.listdir(RAW_DATA_PATH)
-        date_folders.sort()
-        # Process all available raw_data
-        for date_folder in date_folders:
-            date_path = os.path.join(RAW_DATA_PATH, date_folder)
-
-            # Get a sorted list of hour folders
-            hour_folders = os.listdir(date_path)
-            hour_folders.sort()
-
-            for hour_folder in hour_folders:
-                hour_path = os.path.join(date_path, hour_folder)
-
-                available_datasets = [
-                    filename
-                    for filename in os.listdir(hour_path)
-                    if filename.startswith("products")
-                    and filename.endswith((".json", ".json.gz"))
-                ]
-
-                if available_datasets:
-                    process_hourly_data(
-                        connection, date_folder, hour_folder, available_datasets
-                    )
-                else:
-                    logger.warning(f"No datasets found for {date_folder}/{hour_folder}")
+        partitions = discover_hour_partitions(connection, RAW_DATA_PATH, "products")
+
+        # Hours are applied in order, so later values of a SKU overwrite earlier ones
+        process_hour_partitions(
+            connection,
+            partitions,
+            process_hourly_data,
+            ordered=True,
+            watermark_dataset="products",
+        )
 
         # Clean up empty directories in raw_data after processing
         cleanup_empty_directories(RAW_DATA_PATH)
@@ -274,12 +335,15 @@ def main() -> None:
     Main function to execute data processing for products.
     """
     try:
-        with connect_to_postgres() as connection:
+        with profiling.profile_run("products"), connect_to_postgres() as connection:
             process_all_data(connection)
     except psycopg2.Error:
         logger.exception("An error occurred while processing data")
     except Exception:
         logger.exception("An error occurred")
+    finally:
+        # Publish this run's metrics for the textfile collector
+        metrics.write_textfile("products_etl")
 
 
 if __name__ == "__main__":
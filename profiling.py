@@ -0,0 +1,200 @@
+import cProfile
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from settings import env_float, env_str
+
+logger = logging.getLogger(__name__)
+
+# Profiler wrapped around pipeline runs: "cprofile", "sampling" or empty for none
+PROFILER = env_str("ETL_PROFILER", "")
+
+# Whether a profile covers a whole run ("run") or each hour of a dataset ("hour")
+PROFILE_SCOPE = env_str("ETL_PROFILE_SCOPE", "hour")
+
+# Profiles of a run are written to <ETL_PROFILE_DIR>/<run id>/
+PROFILE_DIR = env_str("ETL_PROFILE_DIR", "/opt/dagster/app/profiles")
+
+# Milliseconds between two samples of the sampling profiler
+SAMPLING_INTERVAL_MS = env_float("ETL_SAMPLING_INTERVAL_MS", 5.0)
+
+PROFILERS = ("cprofile", "sampling")
+
+_settings: Dict[str, Optional[str]] = {
+    "profiler": PROFILER,
+    "run_id": os.getenv("ETL_PROFILE_RUN_ID")
+    or f"{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}",
+}
+
+
+def configure(profiler: Optional[str] = None, run_id: Optional[str] = None) -> None:
+    """
+    Override the profiler and run id of this process, e.g. from Dagster op config.
+
+    Args:
+        profiler (Optional[str]): "cprofile", "sampling" or empty for none.
+        run_id (Optional[str]): The id of the run, used as the output directory.
+    """
+    if profiler is not None:
+        if profiler and profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler: {profiler}")
+        _settings["profiler"] = profiler
+    if run_id is not None:
+        _settings["run_id"] = run_id
+
+
+def profile_path(dataset: str, date: Optional[str], hour: Optional[str]) -> str:
+    """
+    Build the path of a profile, without extension.
+
+    Args:
+        dataset (str): The dataset being processed.
+        date (Optional[str]): The date folder, for hourly profiles.
+        hour (Optional[str]): The hour folder, for hourly profiles.
+
+    Returns:
+        str: <ETL_PROFILE_DIR>/<run id>/<dataset>[_<date>_<hour>].
+    """
+    name = dataset
+    if date is not None and hour is not None:
+        name += f"_{date.split('=')[-1]}_{hour.split('=')[-1]}"
+    return os.path.join(PROFILE_DIR, str(_settings["run_id"]), name)
+
+
+class SamplingProfiler:
+    """
+    Pure-Python sampling profiler for one thread.
+
+    A background thread captures the stack of the profiled thread every
+    interval. The samples are written as collapsed stacks, one
+    "frame;frame;frame count" line per distinct stack, which flamegraph.pl
+    and speedscope read directly.
+    """
+
+    def __init__(self, interval: Optional[float] = None) -> None:
+        self.interval = interval or SAMPLING_INTERVAL_MS / 1000
+        self.samples: Counter = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+                )
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def enable(self) -> None:
+        self._sampler.start()
+
+    def disable(self) -> None:
+        self._stopped.set()
+        self._sampler.join()
+
+    def dump_stats(self, file_path: str) -> None:
+        with open(file_path, "w") as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profile(
+    dataset: str, date: Optional[str] = None, hour: Optional[str] = None
+) -> Iterator[None]:
+    """
+    Profile a block with the configured profiler, if any.
+
+    cProfile output is written to <path>.pstats and sampling output to
+    <path>.collapsed, see profile_path(). Profiling problems are logged and
+    never fail the block.
+
+    Args:
+        dataset (str): The dataset being processed.
+        date (Optional[str]): The date folder, for hourly profiles.
+        hour (Optional[str]): The hour folder, for hourly profiles.
+    """
+    profiler_name = _settings["profiler"]
+    if not profiler_name:
+        yield
+        return
+
+    if profiler_name == "cprofile":
+        profiler, extension = cProfile.Profile(), ".pstats"
+    else:
+        profiler, extension = SamplingProfiler(), ".collapsed"
+    try:
+        profiler.enable()
+    except ValueError:
+        # Only one cProfile profiler can be active at a time on Python 3.12+
+        logger.warning(f"Could not start profiling {dataset}", exc_info=True)
+        yield
+        return
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        file_path = profile_path(dataset, date, hour) + extension
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            profiler.dump_stats(file_path)
+            logger.info(
+                f"Profiled {dataset} for {time.perf_counter() - start_time:.2f}s: {file_path}"
+            )
+        except OSError:
+            logger.exception(f"Could not write profile {file_path}")
+
+
+@contextmanager
+def profile_run(dataset: str) -> Iterator[None]:
+    """
+    Profile a whole run of a pipeline when ETL_PROFILE_SCOPE is "run".
+
+    Args:
+        dataset (str): The pipeline being run.
+    """
+    if PROFILE_SCOPE != "run":
+        yield
+        return
+    with profile(dataset):
+        yield
+
+
+def profiled_hour(dataset: str) -> Callable:
+    """
+    Profile each call of a process_hourly_data function when ETL_PROFILE_SCOPE is "hour".
+
+    Args:
+        dataset (str): The dataset the function processes.
+
+    Returns:
+        Callable: A decorator for functions taking (connection, date, hour, ...).
+    """
+
+    def decorator(process_hourly_data: Callable) -> Callable:
+        @functools.wraps(process_hourly_data)
+        def wrapper(connection: Any, date: str, hour: str, *args: Any) -> Any:
+            if PROFILE_SCOPE != "hour":
+                return process_hourly_data(connection, date, hour, *args)
+            with profile(dataset, date, hour):
+                return process_hourly_data(connection, date, hour, *args)
+
+        return wrapper
+
+    return decorator
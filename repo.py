@@ -1,14 +1,48 @@
-from dagster import DefaultScheduleStatus, repository, schedule
+import hashlib
+import json
+import time
+from dagster import (
+    AssetSelection,
+    DefaultScheduleStatus,
+    DefaultSensorStatus,
+    RunRequest,
+    SkipReason,
+    build_schedule_from_partitioned_job,
+    define_asset_job,
+    repository,
+    schedule,
+    sensor,
+)
+from assets import hourly_assets, hourly_partitions
+from common import (
+    poll_raw_data_partitions,
+    INGEST_POLL_INTERVAL_SECONDS,
+    RAW_FILE_SETTLE_SECONDS,
+)
 from customers import customers_graph
 from transactions import transactions_graph
 from products import products_graph
 from erasure_requests import erasure_requests_graph
+from ingest import ingest_graph, ingest_partitions_graph
+from ingest_etl import RAW_DATA_PATH
+import metrics
+
 
+# Serves the metrics of the code server process, e.g. sensor ticks, on METRICS_PORT.
+# Run workers importing this module find the port taken and don't serve them.
+metrics.serve()
 
 customers_job = customers_graph.to_job(name="customers_job")
 products_job = products_graph.to_job(name="products_job")
 transactions_job = transactions_graph.to_job(name="transactions_job")
 erasure_requests_job = erasure_requests_graph.to_job(name="erasure_requests_job")
+ingest_job = ingest_graph.to_job(name="ingest_job")
+ingest_partitions_job = ingest_partitions_graph.to_job(name="ingest_partitions_job")
+hourly_assets_job = define_asset_job(
+    name="hourly_assets_job",
+    selection=AssetSelection.assets(*hourly_assets),
+    partitions_def=hourly_partitions,
+)
 
 
 @schedule(
@@ -51,6 +85,59 @@ def erasure_requests_schedule(_context):
     return {}
 
 
+@schedule(
+    cron_schedule="0 * * * *",
+    job=ingest_job,
+    execution_timezone="Europe/Zagreb",
+    default_status=DefaultScheduleStatus.STOPPED,
+)
+def ingest_schedule(_context):
+    return {}
+
+
+hourly_assets_schedule = build_schedule_from_partitioned_job(
+    hourly_assets_job,
+    default_status=DefaultScheduleStatus.STOPPED,
+)
+
+
+@sensor(
+    job=ingest_partitions_job,
+    minimum_interval_seconds=int(INGEST_POLL_INTERVAL_SECONDS),
+    default_status=DefaultSensorStatus.STOPPED,
+)
+def raw_data_sensor(context):
+    # The stat cache of the previous tick is kept in the cursor
+    state = json.loads(context.cursor) if context.cursor else {}
+    hour_folders, state = poll_raw_data_partitions(
+        RAW_DATA_PATH, state, time.time(), RAW_FILE_SETTLE_SECONDS
+    )
+    context.update_cursor(json.dumps(state))
+
+    if not hour_folders:
+        yield SkipReason("No finished raw_data partitions")
+        return
+
+    # One run for all finished partitions keeps them in dependency order
+    partition_keys = [f"{date}/{hour}" for date, hour in hour_folders]
+    yield RunRequest(
+        run_key=hashlib.sha1(
+            ",".join(state["reported"][key] for key in partition_keys).encode()
+        ).hexdigest(),
+        run_config={
+            "ops": {
+                "ingest_partitions_op": {
+                    "config": {
+                        "partitions": [
+                            {"date": date, "hour": hour} for date, hour in hour_folders
+                        ]
+                    }
+                }
+            }
+        },
+    )
+
+
 @repository
 def deploy_docker_repository():
     return [
@@ -58,8 +145,15 @@ def deploy_docker_repository():
         transactions_schedule,
         products_schedule,
         erasure_requests_schedule,
+        ingest_schedule,
+        hourly_assets_schedule,
+        raw_data_sensor,
         customers_job,
         products_job,
         transactions_job,
         erasure_requests_job,
+        ingest_job,
+        ingest_partitions_job,
+        hourly_assets_job,
+        *hourly_assets,
     ]
@@ -0,0 +1,66 @@
+import os
+
+from dotenv import load_dotenv
+
+# Modules read their settings when they are imported, so .env is loaded here,
+# before any of them. Variables already set in the environment take precedence.
+load_dotenv()
+
+
+def env_str(name: str, default: str) -> str:
+    """
+    Read a string setting from the environment.
+
+    Args:
+        name (str): The name of the environment variable.
+        default (str): The value used when the variable is unset or empty.
+
+    Returns:
+        str: The setting.
+    """
+    return os.getenv(name) or default
+
+
+def env_int(name: str, default: int) -> int:
+    """
+    Read an integer setting from the environment.
+
+    Args:
+        name (str): The name of the environment variable.
+        default (int): The value used when the variable is unset or empty.
+
+    Returns:
+        int: The setting.
+    """
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name: str, default: float) -> float:
+    """
+    Read a float setting from the environment.
+
+    Args:
+        name (str): The name of the environment variable.
+        default (float): The value used when the variable is unset or empty.
+
+    Returns:
+        float: The setting.
+    """
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def env_flag(name: str, default: bool) -> bool:
+    """
+    Read an on/off setting from the environment, where "1" means on.
+
+    Args:
+        name (str): The name of the environment variable.
+        default (bool): The value used when the variable is unset or empty.
+
+    Returns:
+        bool: The setting.
+    """
+    value = os.getenv(name)
+    return value == "1" if value else default
@@ -7,6 +7,24 @@ CREATE TABLE data.processing_statistics (
     dataset_type VARCHAR(255) NOT NULL,
     record_count INTEGER NOT NULL,
     processing_time INTERVAL NOT NULL,
+    bytes_in BIGINT,
+    bytes_out BIGINT,
+    compression_time INTERVAL,
+    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE data.processing_stage_statistics (
+    id SERIAL PRIMARY KEY,
+    record_date DATE NOT NULL,
+    record_hour INTEGER NOT NULL,
+    dataset_type VARCHAR(255) NOT NULL,
+    stage VARCHAR(32) NOT NULL,
+    duration INTERVAL NOT NULL,
+    calls INTEGER NOT NULL,
+    rows_in BIGINT NOT NULL,
+    rows_out BIGINT NOT NULL,
+    bytes_read BIGINT NOT NULL,
+    query_count INTEGER NOT NULL,
     processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -118,3 +136,10 @@ CREATE TABLE data.erasure_requests (
     error_message TEXT,
     processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+
+CREATE TABLE data.ingest_watermarks (
+    dataset_type VARCHAR(255) PRIMARY KEY,
+    record_date DATE NOT NULL,
+    record_hour INTEGER NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
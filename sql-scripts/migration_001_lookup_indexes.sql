@@ -0,0 +1,56 @@
+-- Indexes and unique constraints matching the lookups of the pipelines.
+--
+-- Runs after init.sql on a fresh database (docker-entrypoint-initdb.d runs the
+-- scripts in alphabetical order). Apply it to an existing database with
+--     psql -U $POSTGRES_USER -d $POSTGRES_DB -f sql-scripts/migration_001_lookup_indexes.sql
+-- It can be run more than once.
+
+BEGIN;
+
+-- Child rows of a transaction, looked up and cascade-deleted by transaction_id
+CREATE INDEX IF NOT EXISTS purchases_transaction_id_idx
+    ON data.purchases (transaction_id);
+CREATE INDEX IF NOT EXISTS delivery_addresses_transaction_id_idx
+    ON data.delivery_addresses (transaction_id);
+
+-- Rows loaded from one hour of raw data
+CREATE INDEX IF NOT EXISTS customers_record_date_record_hour_id_idx
+    ON data.customers (record_date, record_hour, id);
+CREATE INDEX IF NOT EXISTS products_record_date_record_hour_sku_idx
+    ON data.products (record_date, record_hour, sku);
+CREATE INDEX IF NOT EXISTS erasure_requests_record_date_record_hour_customer_id_idx
+    ON data.erasure_requests (record_date, record_hour, customer_id);
+
+-- Incremental refreshes of the reference data caches
+CREATE INDEX IF NOT EXISTS customers_processed_at_idx
+    ON data.customers (processed_at);
+CREATE INDEX IF NOT EXISTS products_processed_at_idx
+    ON data.products (processed_at);
+
+-- Invalid products and transactions are logged once per hour, so that
+-- reprocessing an hour updates them instead of adding duplicates. Existing
+-- duplicates are dropped first, keeping the latest row.
+DELETE FROM data.invalid_products a
+    USING data.invalid_products b
+    WHERE a.sku = b.sku
+        AND a.record_date = b.record_date
+        AND a.record_hour = b.record_hour
+        AND a.id < b.id;
+CREATE UNIQUE INDEX IF NOT EXISTS invalid_products_sku_record_date_record_hour_key
+    ON data.invalid_products (sku, record_date, record_hour);
+
+-- A transaction keeps one row per distinct error, e.g. both its own error
+-- and "Duplicate transaction_id". Schema errors can be longer than a btree
+-- index row allows, so the message is keyed by its md5 hash. Transactions
+-- without an ID never conflict, like any NULL key.
+DELETE FROM data.invalid_transactions a
+    USING data.invalid_transactions b
+    WHERE a.transaction_id = b.transaction_id
+        AND a.record_date = b.record_date
+        AND a.record_hour = b.record_hour
+        AND md5(a.error_message) = md5(b.error_message)
+        AND a.id < b.id;
+CREATE UNIQUE INDEX IF NOT EXISTS invalid_transactions_transaction_id_hour_error_md5_key
+    ON data.invalid_transactions (transaction_id, record_date, record_hour, md5(error_message));
+
+COMMIT;
@@ -0,0 +1,11 @@
+-- Size and compression time columns of data.processing_statistics.
+--
+-- init.sql already has them on a fresh database. Apply it to an existing
+-- database with
+--     psql -U $POSTGRES_USER -d $POSTGRES_DB -f sql-scripts/migration_002_processing_statistics_compression.sql
+-- It can be run more than once.
+
+ALTER TABLE data.processing_statistics
+    ADD COLUMN IF NOT EXISTS bytes_in BIGINT,
+    ADD COLUMN IF NOT EXISTS bytes_out BIGINT,
+    ADD COLUMN IF NOT EXISTS compression_time INTERVAL;
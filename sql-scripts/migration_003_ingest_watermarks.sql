@@ -0,0 +1,13 @@
+-- Last raw_data hour ingested by each pipeline.
+--
+-- init.sql already creates it on a fresh database. Apply it to an existing
+-- database with
+--     psql -U $POSTGRES_USER -d $POSTGRES_DB -f sql-scripts/migration_003_ingest_watermarks.sql
+-- It can be run more than once.
+
+CREATE TABLE IF NOT EXISTS data.ingest_watermarks (
+    dataset_type VARCHAR(255) PRIMARY KEY,
+    record_date DATE NOT NULL,
+    record_hour INTEGER NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
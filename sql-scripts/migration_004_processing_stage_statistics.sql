@@ -0,0 +1,21 @@
+-- Per-stage timings and counters of every processed hour.
+--
+-- init.sql already creates it on a fresh database. Apply it to an existing
+-- database with
+--     psql -U $POSTGRES_USER -d $POSTGRES_DB -f sql-scripts/migration_004_processing_stage_statistics.sql
+-- It can be run more than once.
+
+CREATE TABLE IF NOT EXISTS data.processing_stage_statistics (
+    id SERIAL PRIMARY KEY,
+    record_date DATE NOT NULL,
+    record_hour INTEGER NOT NULL,
+    dataset_type VARCHAR(255) NOT NULL,
+    stage VARCHAR(32) NOT NULL,
+    duration INTERVAL NOT NULL,
+    calls INTEGER NOT NULL,
+    rows_in BIGINT NOT NULL,
+    rows_out BIGINT NOT NULL,
+    bytes_read BIGINT NOT NULL,
+    query_count INTEGER NOT NULL,
+    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
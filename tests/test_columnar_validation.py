@@ -0,0 +1,95 @@
+from unittest.mock import patch
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import columnar_validation  # noqa: E402
+from columnar_validation import (  # noqa: E402
+    REASON_DUPLICATE_TRANSACTION_ID,
+    REASON_INVALID_CUSTOMER_ID,
+    REASON_INVALID_PRODUCT_SKUS,
+    REASON_INVALID_TOTAL_COST,
+    REASON_VALID,
+    first_occurrence_mask,
+    validate_transactions,
+)
+from transactions_etl import transform_and_validate_transactions  # noqa: E402
+
+
+def transaction(transaction_id, customer_id, products, total_cost):
+    return {
+        "transaction_id": transaction_id,
+        "transaction_time": "2022-01-01T01:00:00",
+        "customer_id": customer_id,
+        "delivery_address": {
+            "address": "Street 1",
+            "postcode": "10000",
+            "city": "Zagreb",
+            "country": "Croatia",
+        },
+        "purchases": {
+            "products": [
+                {"sku": sku, "quanitity": quantity, "price": price, "total": "0"}
+                for sku, quantity, price in products
+            ],
+            "total_cost": total_cost,
+        },
+    }
+
+
+TRANSACTIONS = [
+    transaction("a", "1", [(10, 2, "5.00"), (20, 1, "0.10")], "10.10"),
+    transaction("b", "2", [(10, 1, "5.00")], "5.00"),
+    transaction("a", "1", [(10, 1, "5.00")], "5.00"),
+    transaction("c", "1", [(10, 1, "5.00"), (30, 1, "1.00")], "6.00"),
+    transaction("d", "1", [(20, 3, "0.10")], "0.31"),
+    transaction("e", "1", [], "0.00"),
+    {"transaction_id": "f"},
+    transaction("g", "2", [(30, 1, "1.00")], "2.00"),
+]
+
+
+def test_first_occurrence_mask():
+    keys = np.array(["a", "b", "a", "c"], dtype=object)
+
+    assert first_occurrence_mask(keys).tolist() == [True, True, False, True]
+    assert first_occurrence_mask(keys, {"c"}).tolist() == [True, True, False, False]
+
+
+def test_validate_transactions_reason_codes():
+    seen = {"e"}
+
+    valid, reasons = validate_transactions(
+        [t for t in TRANSACTIONS if "purchases" in t], {"1"}, {10, 20}, seen
+    )
+
+    assert reasons.tolist() == [
+        REASON_VALID,
+        REASON_INVALID_CUSTOMER_ID,
+        REASON_DUPLICATE_TRANSACTION_ID,
+        REASON_INVALID_PRODUCT_SKUS,
+        REASON_INVALID_TOTAL_COST,
+        REASON_DUPLICATE_TRANSACTION_ID,
+        REASON_INVALID_CUSTOMER_ID,
+    ]
+    assert valid.tolist() == [True] + [False] * 6
+    assert seen == {"a", "b", "c", "d", "e", "g"}
+
+
+def test_columnar_matches_row_by_row(mock_connection):
+    def run(columnar):
+        with patch(
+            "transactions_etl.prefetch_reference_data",
+            return_value=({"1"}, {10, 20}),
+        ), patch(
+            "transactions_etl.bulk_insert_invalid_transactions"
+        ) as mock_invalid, patch.object(
+            columnar_validation, "COLUMNAR_VALIDATION", columnar
+        ):
+            valid = transform_and_validate_transactions(
+                mock_connection, TRANSACTIONS, "date=2022-01-01", "hour=01", {"e"}
+            )
+        return valid, mock_invalid.call_args[0][1]
+
+    assert run(True) == run(False)
@@ -1,14 +1,39 @@
 from common import (
     create_connection_pool,
+    get_connection_pool,
     get_postgres_connection,
     connect_to_postgres,
     archive_and_delete,
     extract_actual_date,
     extract_actual_hour,
     extract_data,
+    extract_data_chunks,
     load_data,
+    ProcessedDataWriter,
+    arrow_schema_from_json_schema,
+    create_processed_data_writer,
+    open_compressed,
+    processed_dataset_type,
+    read_block_lines,
+    read_block_table,
+    read_record_index,
+    ReferenceDataCache,
+    upsert_rows,
+    list_hour_partitions,
+    poll_raw_data_partitions,
+    process_hour_partitions,
+    get_json_codec,
+    SchemaValidator,
+    StageStatistics,
+    log_processing_statistics,
 )
 import datetime
+import gzip
+import json
+from unittest.mock import MagicMock
+import jsonschema
+import psycopg2
+import pytest
 
 
 def test_create_connection_pool(mock_connection_pool):
@@ -23,6 +48,39 @@ def test_connect_to_postgres(mock_connection_pool):
     assert connect_to_postgres() is not None
 
 
+def test_get_connection_pool_is_shared(mock_connection_pool):
+    assert get_connection_pool() is get_connection_pool()
+
+
+def test_get_postgres_connection_holds_connection(mock_connection_pool, mocker):
+    connection_pool = get_connection_pool()
+    mocker.patch.object(connection_pool, "getconn")
+    mocker.patch.object(connection_pool, "putconn")
+    connection = connection_pool.getconn.return_value
+    connection.closed = 0
+
+    with get_postgres_connection() as acquired:
+        assert acquired is connection
+        connection_pool.putconn.assert_not_called()
+
+    connection.commit.assert_called_once()
+    connection_pool.putconn.assert_called_once_with(connection, close=False)
+
+
+def test_get_postgres_connection_replaces_broken_connection(
+    mock_connection_pool, mocker
+):
+    connection_pool = get_connection_pool()
+    broken, healthy = MagicMock(closed=1), MagicMock(closed=0)
+    mocker.patch.object(connection_pool, "getconn", side_effect=[broken, healthy])
+    mocker.patch.object(connection_pool, "putconn")
+
+    with get_postgres_connection() as acquired:
+        assert acquired is healthy
+
+    assert connection_pool.putconn.call_args_list[0] == ((broken,), {"close": True})
+
+
 def test_archive_and_delete(mock_os_rename, mocker):
     mocker.patch("common.os.makedirs")
     archive_and_delete("file.json", "type", "2022-01-01", "00", "/archive")
@@ -49,6 +107,166 @@ def test_extract_data(mock_gzip_open, mock_open):
     assert result_json == [{"key": "value"}]
 
 
+def test_extract_data_chunks(tmp_path):
+    file_path = tmp_path / "customers.json.gz"
+    with gzip.open(file_path, "wt") as file:
+        file.writelines(f'{{"id": "{i}"}}\n' for i in range(5))
+
+    chunks = list(extract_data_chunks(str(file_path), chunk_size=2))
+
+    assert [[record["id"] for record in chunk] for chunk in chunks] == [
+        ["0", "1"],
+        ["2", "3"],
+        ["4"],
+    ]
+
+
+def test_load_data(tmp_path):
+    load_data(
+        [{"id": "1"}, {"id": "2"}],
+        "customers.json.gz",
+        "date=2022-01-01",
+        "hour=00",
+        str(tmp_path),
+    )
+
+    output_path = tmp_path / "date=2022-01-01" / "hour=00" / "customers.json.gz"
+    with gzip.open(output_path, "rt") as file:
+        assert [json.loads(line) for line in file] == [{"id": "1"}, {"id": "2"}]
+
+
+def test_processed_data_writer_record_index(tmp_path):
+    with ProcessedDataWriter(
+        "customers.json.gz", "date=2022-01-01", "hour=00", str(tmp_path), "id"
+    ) as writer:
+        writer.write([{"id": "1"}, {"id": "2"}])
+        writer.write([{"id": "3"}])
+
+    output_path = tmp_path / "date=2022-01-01" / "hour=00" / "customers.json.gz"
+    index = read_record_index(str(output_path))
+    with gzip.open(output_path, "rb") as file:
+        content = file.read()
+
+    assert [line_number for line_number, _ in index.values()] == [0, 1, 2]
+    for key, (_, offset) in index.items():
+        assert json.loads(content[offset:].split(b"\n", 1)[0])["id"] == key
+
+
+def test_processed_data_writer_blocks(tmp_path):
+    records = [{"id": str(i)} for i in range(7)]
+    with ProcessedDataWriter(
+        "customers.json.gz",
+        "date=2022-01-01",
+        "hour=00",
+        str(tmp_path),
+        block_records=3,
+    ) as writer:
+        writer.write(records[:2])
+        writer.write(records[2:])
+
+    output_path = str(tmp_path / "date=2022-01-01" / "hour=00" / "customers.json.gz")
+    blocks = read_block_table(output_path)
+
+    # Still readable as a regular gzip file
+    assert extract_data(output_path) == records
+    assert [(first_line, count) for _, _, first_line, count in blocks] == [
+        (0, 3),
+        (3, 3),
+        (6, 1),
+    ]
+    assert [json.loads(line) for line in read_block_lines(output_path, blocks[1])] == (
+        records[3:6]
+    )
+    assert read_record_index(output_path) is None
+
+
+@pytest.mark.parametrize(
+    "extension, module",
+    [(".json.gz", None), (".json.zst", "zstandard"), (".json.lz4", "lz4.frame")],
+)
+def test_open_compressed_round_trip(tmp_path, extension, module):
+    if module is not None:
+        pytest.importorskip(module)
+    file_path = str(tmp_path / f"customers{extension}")
+    with open_compressed(file_path, "wb") as file:
+        file.write(b'{"id": "1"}\n{"id": "2"}\n')
+
+    assert extract_data(file_path) == [{"id": "1"}, {"id": "2"}]
+
+
+def test_processed_dataset_type(monkeypatch):
+    monkeypatch.setenv("PROCESSED_COMPRESSION_TRANSACTIONS", "zstd")
+
+    assert processed_dataset_type("transactions") == "transactions.json.zst"
+    assert processed_dataset_type("customers") == "customers.json.gz"
+
+
+def test_processed_data_writer_statistics(tmp_path):
+    with ProcessedDataWriter(
+        "customers.json.gz", "date=2022-01-01", "hour=00", str(tmp_path)
+    ) as writer:
+        writer.write([{"id": str(i)} for i in range(100)])
+
+    output_path = tmp_path / "date=2022-01-01" / "hour=00" / "customers.json.gz"
+    assert writer.bytes_written == output_path.stat().st_size
+    assert writer.compression_time > datetime.timedelta()
+
+
+def test_parquet_writer_follows_json_schema(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    with open("transactions_schema.json") as schema_file:
+        schema = json.load(schema_file)
+    transaction = {
+        "transaction_id": "a",
+        "transaction_time": "2022-01-01T01:00:00",
+        "customer_id": "1",
+        "delivery_address": {
+            "address": "Street 1",
+            "postcode": "10000",
+            "city": "Zagreb",
+            "country": "Croatia",
+        },
+        "purchases": {
+            "products": [{"sku": 1, "quanitity": 2, "price": "5.00", "total": "10"}],
+            "total_cost": "10.00",
+        },
+    }
+
+    with create_processed_data_writer(
+        "transactions.parquet", "date=2022-01-01", "hour=00", str(tmp_path), schema
+    ) as writer:
+        writer.write([transaction])
+        writer.write([dict(transaction, transaction_id="b")])
+
+    output_path = tmp_path / "date=2022-01-01" / "hour=00" / "transactions.parquet"
+    parquet_file = pq.ParquetFile(output_path)
+    # One row group per chunk
+    assert parquet_file.num_row_groups == 2
+    assert writer.bytes_written == output_path.stat().st_size
+    assert parquet_file.read().to_pylist()[0] == transaction
+
+
+def test_arrow_schema_from_json_schema():
+    pa = pytest.importorskip("pyarrow")
+    with open("products_schema.json") as schema_file:
+        schema = json.load(schema_file)
+
+    arrow_schema = arrow_schema_from_json_schema(
+        schema, extra_fields={"last_change": "string"}
+    )
+
+    assert arrow_schema == pa.schema(
+        [
+            ("sku", pa.int64()),
+            ("name", pa.string()),
+            ("price", pa.float64()),
+            ("category", pa.dictionary(pa.int32(), pa.string())),
+            ("popularity", pa.float64()),
+            ("last_change", pa.string()),
+        ]
+    )
+
+
 def test_load_data_empty_dataset(mocker, mock_os_makedirs, mocker_open):
     mocker.patch("common.os.makedirs")
     mocker.patch("common.os.path.join")
@@ -56,3 +274,397 @@ def test_load_data_empty_dataset(mocker, mock_os_makedirs, mocker_open):
 
     load_data([], "type.json", "2022-01-01", "00", "/processed_data")
     mocker_open.assert_not_called()
+
+
+def test_reference_data_cache_refreshes_incrementally():
+    connection = MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    first_load = datetime.datetime(2022, 1, 1, 0)
+    second_load = datetime.datetime(2022, 1, 1, 1)
+    cursor.fetchall.side_effect = [[(1, first_load)], [(2, second_load)]]
+    cache = ReferenceDataCache("data.customers", "id", ttl_seconds=3600)
+
+    assert cache.lookup(connection, {1}) == {1}
+    # Within the TTL the cached keys are served without querying
+    assert cache.lookup(connection, {1}) == {1}
+    assert cursor.execute.call_count == 1
+
+    cache.invalidate()
+    assert cache.lookup(connection, {1, 2}) == {1, 2}
+    assert cursor.execute.call_count == 2
+    assert cursor.execute.call_args[0][1] == (first_load,)
+
+
+def test_reference_data_cache_disabled():
+    connection = MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [(1,)]
+    cache = ReferenceDataCache("data.products", "sku", ttl_seconds=0)
+
+    assert cache.lookup(connection, {1, 2}) == {1}
+    assert cache.lookup(connection, {1, 2}) == {1}
+    assert cursor.execute.call_count == 2
+
+
+def test_upsert_rows(mocker):
+    mock_execute_values = mocker.patch("common.execute_values")
+    cursor = MagicMock()
+
+    row_count = upsert_rows(
+        cursor,
+        "data.invalid_customers",
+        {"record_hour": 1, "id": [1, 2, 1], "error_message": ["a", "b", "c"]},
+        conflict_columns=("id",),
+        update_columns=("error_message",),
+        page_size=2,
+    )
+
+    assert row_count == 2
+    query, rows = mock_execute_values.call_args[0][1:]
+    assert query == (
+        "INSERT INTO data.invalid_customers (record_hour, id, error_message) "
+        "VALUES %s ON CONFLICT (id) DO UPDATE SET error_message = EXCLUDED.error_message"
+    )
+    # The last row wins for duplicate keys when updating
+    assert rows == [(1, 1, "c"), (1, 2, "b")]
+    assert mock_execute_values.call_args[1] == {"page_size": 2}
+
+
+def test_upsert_rows_do_nothing(mocker):
+    mock_execute_values = mocker.patch("common.execute_values")
+
+    upsert_rows(MagicMock(), "data.products", {"sku": [1, 1]}, ("sku",))
+
+    query, rows = mock_execute_values.call_args[0][1:]
+    assert query.endswith("ON CONFLICT (sku) DO NOTHING")
+    assert rows == [(1,)]
+
+
+def test_upsert_rows_null_keys_never_conflict(mocker):
+    mock_execute_values = mocker.patch("common.execute_values")
+
+    upsert_rows(
+        MagicMock(),
+        "data.invalid_transactions",
+        {
+            "transaction_id": [None, "a", None, "a"],
+            "record_hour": 1,
+            "error_message": ["b", "c", "d", "e"],
+        },
+        conflict_columns=("transaction_id", "record_hour"),
+        update_columns=("error_message",),
+    )
+
+    rows = mock_execute_values.call_args[0][2]
+    assert rows == [(None, 1, "b"), ("a", 1, "e"), (None, 1, "d")]
+
+
+def test_upsert_rows_missing_unique_index(mocker):
+    mocker.patch(
+        "common.execute_values",
+        side_effect=psycopg2.errors.InvalidColumnReference(
+            "there is no unique or exclusion constraint matching the ON CONFLICT specification"
+        ),
+    )
+
+    with pytest.raises(RuntimeError, match="apply the migrations in sql-scripts/"):
+        upsert_rows(MagicMock(), "data.products", {"sku": [1]}, ("sku",))
+
+
+def test_list_hour_partitions(tmp_path):
+    for hour in ("hour=01", "hour=00"):
+        (tmp_path / "date=2022-01-01" / hour).mkdir(parents=True)
+        (tmp_path / "date=2022-01-01" / hour / "customers.json.gz").touch()
+    (tmp_path / "date=2022-01-01" / "hour=01" / "transactions.json.gz").touch()
+
+    result = list_hour_partitions(str(tmp_path), "customers")
+
+    assert result == [
+        ("date=2022-01-01", "hour=00", ["customers.json.gz"]),
+        ("date=2022-01-01", "hour=01", ["customers.json.gz"]),
+    ]
+
+
+def test_list_hour_partitions_since_watermark(tmp_path):
+    for day, hour in (("01", "23"), ("02", "00"), ("02", "01"), ("02", "02")):
+        (tmp_path / f"date=2022-01-{day}" / f"hour={hour}").mkdir(parents=True)
+        (
+            tmp_path / f"date=2022-01-{day}" / f"hour={hour}" / "customers.json.gz"
+        ).touch()
+
+    result = list_hour_partitions(
+        str(tmp_path), "customers", since=(datetime.date(2022, 1, 2), 1)
+    )
+
+    # The watermark hour itself is listed again
+    assert [(d, h) for d, h, _ in result] == [
+        ("date=2022-01-02", "hour=01"),
+        ("date=2022-01-02", "hour=02"),
+    ]
+
+
+def test_poll_raw_data_partitions_waits_for_settled_files(tmp_path):
+    hour_path = tmp_path / "date=2022-01-01" / "hour=10"
+    hour_path.mkdir(parents=True)
+    data_file = hour_path / "customers.json.gz"
+    data_file.write_bytes(b"1")
+    (hour_path / "transactions.json.gz.part").write_bytes(b"in progress")
+    mtime = data_file.stat().st_mtime
+
+    # First sighting: nothing to compare the size with yet
+    finished, state = poll_raw_data_partitions(str(tmp_path), {}, mtime + 60, 30)
+    assert finished == []
+
+    # Unchanged, but modified too recently
+    finished, state = poll_raw_data_partitions(str(tmp_path), state, mtime + 1, 30)
+    assert finished == []
+
+    finished, state = poll_raw_data_partitions(str(tmp_path), state, mtime + 60, 30)
+    assert finished == [("date=2022-01-01", "hour=10")]
+
+    # Reported partitions aren't reported again while their files are unchanged
+    finished, state = poll_raw_data_partitions(str(tmp_path), state, mtime + 90, 30)
+    assert finished == []
+
+    # ...but are once a new file has settled in them
+    (hour_path / "transactions.json.gz.part").rename(hour_path / "transactions.json.gz")
+    mtime = (hour_path / "transactions.json.gz").stat().st_mtime
+    finished, state = poll_raw_data_partitions(str(tmp_path), state, mtime + 60, 30)
+    assert finished == []
+    finished, state = poll_raw_data_partitions(str(tmp_path), state, mtime + 60, 30)
+    assert finished == [("date=2022-01-01", "hour=10")]
+    assert json.loads(json.dumps(state)) == state
+
+
+def test_process_hour_partitions_advances_watermark_in_order(mocker):
+    mocker.patch("common.get_postgres_connection")
+    mock_advance = mocker.patch("common.advance_ingest_watermark")
+    connection = MagicMock()
+    process_hourly_data = MagicMock(side_effect=[None, RuntimeError("boom"), None])
+    partitions = [
+        ("date=2022-01-01", f"hour=0{h}", ["customers.json.gz"]) for h in range(3)
+    ]
+
+    with pytest.raises(RuntimeError):
+        process_hour_partitions(
+            connection,
+            partitions,
+            process_hourly_data,
+            watermark_dataset="customers",
+        )
+
+    # The watermark stops before the failed partition
+    mock_advance.assert_called_once_with(
+        connection, "customers", "date=2022-01-01", "hour=00"
+    )
+
+
+def test_process_hour_partitions_in_parallel(mocker):
+    mock_get_postgres_connection = mocker.patch("common.get_postgres_connection")
+    worker_connection = mock_get_postgres_connection.return_value.__enter__.return_value
+    process_hourly_data = MagicMock()
+    partitions = [
+        ("date=2022-01-01", f"hour=0{h}", ["customers.json.gz"]) for h in range(4)
+    ]
+
+    process_hour_partitions(MagicMock(), partitions, process_hourly_data, max_workers=2)
+
+    assert mock_get_postgres_connection.call_count == 4
+    assert sorted(c[0][2] for c in process_hourly_data.call_args_list) == [
+        "hour=00",
+        "hour=01",
+        "hour=02",
+        "hour=03",
+    ]
+    assert all(c[0][0] is worker_connection for c in process_hourly_data.call_args_list)
+
+
+def test_process_hour_partitions_ordered(mocker):
+    mock_get_postgres_connection = mocker.patch("common.get_postgres_connection")
+    connection = MagicMock()
+    process_hourly_data = MagicMock()
+    partitions = [
+        ("date=2022-01-01", f"hour=0{h}", ["products.json.gz"]) for h in range(3)
+    ]
+
+    process_hour_partitions(
+        connection, partitions, process_hourly_data, max_workers=4, ordered=True
+    )
+
+    mock_get_postgres_connection.assert_not_called()
+    assert [c[0] for c in process_hourly_data.call_args_list] == [
+        (connection, *partition) for partition in partitions
+    ]
+
+
+def test_get_json_codec_falls_back_to_stdlib():
+    name, loads, dumps_line = get_json_codec("not-installed")
+
+    assert name == "json"
+    assert dumps_line({"id": "1"}) == b'{"id": "1"}\n'
+    assert loads(b'{"id": "1"}') == {"id": "1"}
+
+
+def test_get_json_codec_round_trip():
+    record = {"id": "1", "name": "\u017dana", "price": 10.5, "tags": [1, None]}
+    for codec in ("auto", "json", "orjson", "msgspec"):
+        _, loads, dumps_line = get_json_codec(codec)
+        line = dumps_line(record)
+        assert line.endswith(b"\n") and line.count(b"\n") == 1
+        assert loads(line) == record
+
+
+VALID_CUSTOMER = {
+    "id": "1",
+    "first_name": "Ana",
+    "last_name": "Horvat",
+    "email": "ana@example.com",
+    "date_of_birth": "1990-01-01",
+    "segment": None,
+}
+
+
+@pytest.mark.parametrize(
+    "schema_file, instance",
+    [
+        ("customer_schema.json", VALID_CUSTOMER),
+        ("customer_schema.json", {**VALID_CUSTOMER, "id": 1}),
+        ("customer_schema.json", {**VALID_CUSTOMER, "email": "not-an-email"}),
+        ("customer_schema.json", {**VALID_CUSTOMER, "date_of_birth": "01/01/1990"}),
+        ("customer_schema.json", {**VALID_CUSTOMER, "unexpected": "field"}),
+        ("customer_schema.json", {"id": "1"}),
+        ("customer_schema.json", []),
+        (
+            "products_schema.json",
+            {"sku": 1, "name": "A", "price": 1.5, "category": "C", "popularity": 0.1},
+        ),
+        (
+            "products_schema.json",
+            {"sku": 1.0, "name": "A", "price": 1, "category": "C", "popularity": 1},
+        ),
+        (
+            "products_schema.json",
+            {"sku": True, "name": "A", "price": 1, "category": "C", "popularity": 1},
+        ),
+        (
+            "products_schema.json",
+            {"sku": 1, "name": "A", "price": 0, "category": "C", "popularity": 1},
+        ),
+        ("erasure_requests_schema.json", {"customer-id": "1", "email": "a@b.c"}),
+        ("erasure_requests_schema.json", {"customer-id": 1}),
+        (
+            "transactions_schema.json",
+            {
+                "transaction_id": "a",
+                "transaction_time": "2022-01-01T01:00:00",
+                "customer_id": "1",
+                "delivery_address": {
+                    "address": "Street 1",
+                    "postcode": "10000",
+                    "city": "Zagreb",
+                    "country": "Croatia",
+                },
+                "purchases": {
+                    "products": [
+                        {"sku": 1, "quanitity": 2, "price": "5.00", "total": "10.00"}
+                    ],
+                    "total_cost": "10.00",
+                },
+            },
+        ),
+        (
+            "transactions_schema.json",
+            {
+                "transaction_id": "a",
+                "transaction_time": "2022-01-01T01:00:00",
+                "customer_id": "1",
+                "delivery_address": {"address": "Street 1"},
+                "purchases": {"products": [{"sku": "1"}], "total_cost": "10.00"},
+            },
+        ),
+    ],
+)
+def test_schema_validator_matches_jsonschema(schema_file, instance):
+    with open(schema_file) as file:
+        schema = json.load(file)
+    full_validator = jsonschema.Draft7Validator(
+        schema, format_checker=jsonschema.Draft7Validator.FORMAT_CHECKER
+    )
+    validator = SchemaValidator(schema)
+
+    assert validator.is_valid_fast(instance) == full_validator.is_valid(instance)
+    if full_validator.is_valid(instance):
+        validator.validate(instance)
+    else:
+        with pytest.raises(jsonschema.exceptions.ValidationError) as error:
+            validator.validate(instance)
+        expected = jsonschema.exceptions.best_match(
+            full_validator.iter_errors(instance)
+        )
+        assert str(error.value) == str(expected)
+
+
+def test_schema_validator_unsupported_keyword_falls_back():
+    validator = SchemaValidator({"type": "string", "pattern": "^a"})
+
+    assert validator.is_valid_fast("abc") is False
+    validator.validate("abc")
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        validator.validate("xyz")
+
+
+def test_stage_statistics_counts_rows_and_queries():
+    stages = StageStatistics()
+    connection = MagicMock(query_count=0)
+
+    chunks = list(stages.iterate("extract", iter([[1, 2], [3]])))
+    for chunk in chunks:
+        with stages.stage("load", connection, rows_in=len(chunk)) as counters:
+            connection.query_count += 2
+            counters["rows_out"] += len(chunk) - 1
+
+    @stages.stage("archive")
+    def archive():
+        pass
+
+    archive()
+    archive()
+
+    assert chunks == [[1, 2], [3]]
+    assert stages.stages["extract"]["calls"] == 2
+    assert stages.stages["extract"]["rows_out"] == 3
+    assert stages.stages["load"]["queries"] == 4
+    assert stages.stages["load"]["rows_in"] == 3
+    assert stages.stages["load"]["rows_out"] == 1
+    assert stages.stages["archive"]["calls"] == 2
+    assert [row[0] for row in stages.rows()] == ["extract", "load", "archive"]
+    assert all(row[1] >= datetime.timedelta(0) for row in stages.rows())
+
+
+def test_log_processing_statistics_inserts_stages_in_one_batch(mocker):
+    mock_execute_values = mocker.patch("common.execute_values")
+    connection = MagicMock()
+    stages = StageStatistics()
+    with stages.stage("extract", bytes_read=10):
+        pass
+    with stages.stage("load"):
+        pass
+
+    log_processing_statistics(
+        connection,
+        "date=2022-01-01",
+        "hour=01",
+        "customers.json.gz",
+        5,
+        datetime.timedelta(seconds=1),
+        stages=stages,
+    )
+
+    mock_execute_values.assert_called_once()
+    rows = mock_execute_values.call_args[0][2]
+    assert [row[:4] for row in rows] == [
+        (datetime.date(2022, 1, 1), 1, "customers.json.gz", "extract"),
+        (datetime.date(2022, 1, 1), 1, "customers.json.gz", "load"),
+    ]
+    assert rows[0][8] == 10
+    connection.commit.assert_called_once()
@@ -1,5 +1,14 @@
+import json
+import os
+import random
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import pytest
 from psycopg2 import OperationalError
-from customers_etl import main
+from benchmarks.generate_raw_data import synthetic_customer
+from common import extract_data, open_compressed
+from customers_etl import main, process_hourly_data
 import customers_etl
 
 
@@ -20,3 +29,39 @@ def test_main_with_connection_error(mocker):
     main()
 
     assert customers_etl.process_all_data.call_count == 0
+
+
+@pytest.mark.parametrize(
+    "extension, module", [(".json.zst", "zstandard"), (".json.lz4", "lz4.frame")]
+)
+def test_process_hourly_data_reads_any_compression(tmp_path, mocker, extension, module):
+    pytest.importorskip(module)
+    rng = random.Random(0)
+    customers = [synthetic_customer(rng, i, datetime(2022, 1, 1)) for i in (1, 2)]
+    raw_file = f"customers{extension}"
+    hour_path = tmp_path / "raw_data" / "date=2022-01-01" / "hour=00"
+    hour_path.mkdir(parents=True)
+    with open_compressed(str(hour_path / raw_file), "wb") as file:
+        for customer in customers:
+            file.write(json.dumps(customer).encode() + b"\n")
+    for name in ("raw_data", "processed_data", "archived_data"):
+        mocker.patch(f"customers_etl.{name.upper()}_PATH", str(tmp_path / name))
+    mock_log_processed = mocker.patch("customers_etl.log_processed_customers")
+    mocker.patch("customers_etl.log_processing_statistics")
+
+    process_hourly_data(MagicMock(), "date=2022-01-01", "hour=00", [raw_file])
+
+    assert mock_log_processed.call_args[0][3] == ["1", "2"]
+    processed = extract_data(
+        str(
+            tmp_path
+            / "processed_data"
+            / "date=2022-01-01"
+            / "hour=00"
+            / "customers.json.gz"
+        )
+    )
+    assert [customer["id"] for customer in processed] == ["1", "2"]
+    assert os.path.exists(
+        tmp_path / "archived_data" / "date=2022-01-01" / "hour=00" / raw_file
+    )
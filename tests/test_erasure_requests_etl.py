@@ -1,11 +1,27 @@
+import gzip
+import json
 import os
 from datetime import datetime
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
+import pytest
+from common import (
+    ProcessedDataWriter,
+    create_processed_data_writer,
+    read_block_table,
+    read_record_index,
+    write_record_index,
+)
 from erasure_requests_etl import (
     get_date_and_hour_to_anonymize,
     anonymize_and_update_data,
+    anonymize_customers_in_file,
+    anonymize_email,
     archive_updated_file,
+    log_invalid_erasure_requests,
     process_erasure_requests,
+    process_hourly_data,
+    resolve_customer_locations,
+    transform_and_validate_erasure_requests,
 )
 
 
@@ -56,18 +72,330 @@ def test_archive_updated_file(tmp_path, mock_date, mock_hour, monkeypatch):
     )
 
 
+def test_anonymize_customers_in_file_rewrites_once(tmp_path):
+    file_path = tmp_path / "customers.json.gz"
+    with gzip.open(file_path, "wt") as file:
+        for customer_id in ("1", "2", "3"):
+            file.write(f'{{"id": "{customer_id}", "email": "{customer_id}@x.com"}}\n')
+
+    anonymized_count = anonymize_customers_in_file(
+        str(file_path), {"1": "hash-1", "3": "hash-3", "4": "hash-4"}
+    )
+
+    assert anonymized_count == 2
+    with gzip.open(file_path, "rt") as file:
+        emails = [json.loads(line)["email"] for line in file]
+    assert emails == ["hash-1", "2@x.com", "hash-3"]
+    assert os.listdir(tmp_path) == ["customers.json.gz"]
+
+
+def write_indexed_customers(tmp_path, block_records=0):
+    with ProcessedDataWriter(
+        "customers.json.gz",
+        "date=2024-01-01",
+        "hour=12",
+        str(tmp_path),
+        "id",
+        block_records,
+    ) as writer:
+        writer.write([{"id": str(i), "email": f"{i}@example.com"} for i in range(1, 6)])
+    return str(tmp_path / "date=2024-01-01" / "hour=12" / "customers.json.gz")
+
+
+def test_anonymize_customers_in_file_uses_record_index(tmp_path):
+    file_path = write_indexed_customers(tmp_path)
+
+    with patch("erasure_requests_etl.json_loads", side_effect=json.loads) as mock_loads:
+        anonymized_count = anonymize_customers_in_file(
+            file_path, {"2": "hash-2", "4": "hash-4"}
+        )
+
+    assert anonymized_count == 2
+    # Only the indexed records are decoded
+    assert mock_loads.call_count == 2
+    with gzip.open(file_path, "rb") as file:
+        content = file.read()
+    emails = [json.loads(line)["email"] for line in content.splitlines()]
+    assert emails == [
+        "1@example.com",
+        "hash-2",
+        "3@example.com",
+        "hash-4",
+        "5@example.com",
+    ]
+
+    # The index follows the new offsets
+    for key, (_, offset) in read_record_index(file_path).items():
+        assert json.loads(content[offset:].split(b"\n", 1)[0])["id"] == key
+
+
+def test_anonymize_customers_in_file_rewrites_affected_blocks(tmp_path):
+    file_path = write_indexed_customers(tmp_path, block_records=2)
+    with open(file_path, "rb") as file:
+        original = file.read()
+    blocks = read_block_table(file_path)
+
+    assert anonymize_customers_in_file(file_path, {"4": "hash-4"}) == 1
+
+    with open(file_path, "rb") as file:
+        content = file.read()
+    new_blocks = read_block_table(file_path)
+    # Blocks without the customer are copied unchanged
+    for old_block, new_block in (
+        (blocks[0], new_blocks[0]),
+        (blocks[2], new_blocks[2]),
+    ):
+        old_offset, old_length, _, _ = old_block
+        new_offset, new_length, _, _ = new_block
+        old_end = old_offset + old_length
+        new_end = new_offset + new_length
+        assert content[new_offset:new_end] == original[old_offset:old_end]
+
+    with gzip.open(file_path, "rb") as file:
+        uncompressed = file.read()
+    emails = [json.loads(line)["email"] for line in uncompressed.splitlines()]
+    assert emails == [
+        "1@example.com",
+        "2@example.com",
+        "3@example.com",
+        "hash-4",
+        "5@example.com",
+    ]
+    for key, (_, offset) in read_record_index(file_path).items():
+        assert json.loads(uncompressed[offset:].split(b"\n", 1)[0])["id"] == key
+
+
+def test_anonymize_customers_in_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    with open("customer_schema.json") as schema_file:
+        schema = json.load(schema_file)
+    with create_processed_data_writer(
+        "customers.parquet", "date=2024-01-01", "hour=12", str(tmp_path), schema
+    ) as writer:
+        for i in range(1, 4):
+            writer.write(
+                [
+                    {
+                        "id": str(i),
+                        "first_name": "A",
+                        "last_name": "B",
+                        "email": f"{i}@example.com",
+                    }
+                ]
+            )
+    file_path = str(tmp_path / "date=2024-01-01" / "hour=12" / "customers.parquet")
+
+    assert anonymize_customers_in_file(file_path, {"2": "hash-2"}) == 1
+    assert anonymize_customers_in_file(file_path, {"42": "hash-42"}) == 0
+
+    parquet_file = pq.ParquetFile(file_path)
+    assert parquet_file.num_row_groups == 3
+    assert parquet_file.read(columns=["email"]).column("email").to_pylist() == [
+        "1@example.com",
+        "hash-2",
+        "3@example.com",
+    ]
+
+
+def test_anonymize_customers_in_file_skips_files_without_customers(tmp_path):
+    file_path = write_indexed_customers(tmp_path)
+    modified_at = os.stat(file_path).st_mtime_ns
+
+    assert anonymize_customers_in_file(file_path, {"42": "hash-42"}) == 0
+    assert os.stat(file_path).st_mtime_ns == modified_at
+    # Scanning the whole file doesn't replace it either
+    files = sorted(os.listdir(os.path.dirname(file_path)))
+    assert (
+        anonymize_customers_in_file(file_path, {"42": "hash-42"}, use_index=False) == 0
+    )
+    assert os.stat(file_path).st_mtime_ns == modified_at
+    assert sorted(os.listdir(os.path.dirname(file_path))) == files
+
+
+def test_anonymize_customers_in_file_with_stale_index(tmp_path):
+    file_path = write_indexed_customers(tmp_path)
+    write_record_index(file_path, "id", {"3": (0, 0)})
+
+    assert anonymize_customers_in_file(file_path, {"3": "hash-3"}) == 1
+    with gzip.open(file_path, "rt") as file:
+        assert [json.loads(line)["email"] for line in file][2] == "hash-3"
+    assert read_record_index(file_path) is None
+
+
+def test_anonymize_customers_in_blocks_with_stale_index(tmp_path):
+    file_path = write_indexed_customers(tmp_path, block_records=2)
+    write_record_index(file_path, "id", {"3": (0, 0)}, read_block_table(file_path))
+
+    assert anonymize_customers_in_file(file_path, {"3": "hash-3"}) == 1
+    with gzip.open(file_path, "rt") as file:
+        assert [json.loads(line)["email"] for line in file][2] == "hash-3"
+    # The temporary file of the abandoned block rewrite is removed
+    assert not [
+        name for name in os.listdir(os.path.dirname(file_path)) if "tmp" in name
+    ]
+
+
+def test_resolve_customer_locations(mock_connection):
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchall.return_value = [
+        (123, datetime(2024, 1, 1), 12),
+        (456, datetime(2024, 1, 1), 12),
+        (789, datetime(2024, 1, 2), 3),
+    ]
+
+    locations, missing_ids = resolve_customer_locations(
+        mock_connection, ["123", "456", "789", "999", "abc"]
+    )
+
+    assert locations == {
+        (datetime(2024, 1, 1), 12): {"123", "456"},
+        (datetime(2024, 1, 2), 3): {"789"},
+    }
+    assert missing_ids == {"999", "abc"}
+    # One query for the whole batch
+    mock_cursor.execute.assert_called_once()
+    assert mock_cursor.execute.call_args[0][1] == ([123, 456, 789, 999],)
+
+
 def test_process_erasure_requests(mock_postgres_connection, mock_erasure_request_data):
+    erasure_requests = mock_erasure_request_data + [
+        {"customer-id": "999", "email": "unknown@example.com"}
+    ]
     with patch(
-        "erasure_requests_etl.get_date_and_hour_to_anonymize",
-        return_value=(datetime(2024, 1, 1), 12),
+        "erasure_requests_etl.resolve_customer_locations",
+        return_value=({(datetime(2024, 1, 1), 12): {"123", "456"}}, {"999"}),
     ):
         with patch(
             "erasure_requests_etl.locate_processed_data_file",
             return_value="/path/to/processed_data.json",
         ):
-            with patch("erasure_requests_etl.anonymize_and_update_data"):
-                with patch("erasure_requests_etl.archive_updated_file"):
-                    process_erasure_requests(
-                        mock_postgres_connection, mock_erasure_request_data
+            with patch(
+                "erasure_requests_etl.anonymize_customers_in_file", return_value=2
+            ) as mock_anonymize:
+                with patch("erasure_requests_etl.archive_updated_file") as mock_archive:
+                    with patch(
+                        "erasure_requests_etl.log_invalid_erasure_requests"
+                    ) as mock_log_invalid:
+                        process_erasure_requests(
+                            mock_postgres_connection,
+                            erasure_requests,
+                            "date=2024-01-02",
+                            "hour=01",
+                        )
+
+                    # Both customers live in the same file, which is rewritten once
+                    mock_anonymize.assert_called_once_with(
+                        "/path/to/processed_data.json",
+                        {
+                            "123": anonymize_email("test@example.com"),
+                            "456": anonymize_email("another@example.com"),
+                        },
                     )
-                    # Add assertions based on your specific logic
+                    mock_archive.assert_called_once_with(
+                        "/path/to/processed_data.json", datetime(2024, 1, 1), 12
+                    )
+                    mock_log_invalid.assert_called_once_with(
+                        mock_postgres_connection,
+                        [(erasure_requests[2], "Customer not found")],
+                        "date=2024-01-02",
+                        "hour=01",
+                    )
+
+
+def test_process_erasure_requests_leaves_files_without_customers(
+    mock_postgres_connection, mock_erasure_request_data, mocker
+):
+    mocker.patch(
+        "erasure_requests_etl.resolve_customer_locations",
+        return_value=({(datetime(2024, 1, 1), 12): {"123", "456"}}, set()),
+    )
+    mocker.patch(
+        "erasure_requests_etl.locate_processed_data_file",
+        return_value="/path/to/processed_data.json",
+    )
+    mocker.patch("erasure_requests_etl.anonymize_customers_in_file", return_value=0)
+    mock_archive = mocker.patch("erasure_requests_etl.archive_updated_file")
+
+    process_erasure_requests(mock_postgres_connection, mock_erasure_request_data)
+
+    mock_archive.assert_not_called()
+
+
+def test_transform_and_validate_erasure_requests_rejects_non_integer_ids(
+    mock_postgres_connection,
+):
+    erasure_requests = [
+        {"customer-id": "123", "email": "test@example.com"},
+        {"customer-id": "abc", "email": "abc@example.com"},
+        {"customer-id": "123", "email": "test@example.com"},
+    ]
+
+    with patch("erasure_requests_etl.log_invalid_erasure_requests") as mock_log_invalid:
+        valid = transform_and_validate_erasure_requests(
+            mock_postgres_connection, erasure_requests, "date=2024-01-02", "hour=01"
+        )
+
+    assert valid == erasure_requests[:1]
+    assert mock_log_invalid.call_args[0][1] == [
+        (erasure_requests[1], "Invalid customer-id"),
+        (erasure_requests[2], "Duplicate customer-id"),
+    ]
+
+
+def test_transform_and_validate_erasure_requests_rejects_missing_email(
+    mock_postgres_connection,
+):
+    erasure_requests = [
+        {"customer-id": "123"},
+        {"customer-id": "456", "email": ""},
+        {"customer-id": "123", "email": "test@example.com"},
+    ]
+
+    with patch("erasure_requests_etl.log_invalid_erasure_requests") as mock_log_invalid:
+        valid = transform_and_validate_erasure_requests(
+            mock_postgres_connection, erasure_requests, "date=2024-01-02", "hour=01"
+        )
+
+    # Only the request with an email is processed and logged as processed
+    assert valid == erasure_requests[2:]
+    assert mock_log_invalid.call_args[0][1] == [
+        (erasure_requests[0], "Missing email"),
+        (erasure_requests[1], "Missing email"),
+    ]
+
+
+def test_log_invalid_erasure_requests_skips_non_integer_ids(mocker):
+    mock_upsert_rows = mocker.patch("erasure_requests_etl.upsert_rows")
+    connection = MagicMock()
+
+    log_invalid_erasure_requests(
+        connection,
+        [({"customer-id": "abc"}, "Invalid customer-id"), ({"customer-id": "7"}, "x")],
+        "date=2024-01-02",
+        "hour=01",
+    )
+
+    columns = mock_upsert_rows.call_args[0][2]
+    assert columns["customer_id"] == [7]
+    assert columns["error_message"] == ["x"]
+
+
+def test_process_hourly_data_skips_missing_customers(mocker, mock_erasure_request_data):
+    mocker.patch(
+        "erasure_requests_etl.extract_data", return_value=mock_erasure_request_data
+    )
+    mocker.patch("erasure_requests_etl.log_invalid_erasure_requests")
+    mocker.patch("erasure_requests_etl.process_erasure_requests", return_value={"456"})
+    mocker.patch("erasure_requests_etl.archive_and_delete")
+    mocker.patch("erasure_requests_etl.get_files_size", return_value=0)
+    mocker.patch("erasure_requests_etl.log_processing_statistics")
+    mock_log_processed = mocker.patch(
+        "erasure_requests_etl.log_processed_erasure_requests"
+    )
+
+    process_hourly_data(
+        Mock(), "date=2024-01-02", "hour=01", ["erasure-requests.json.gz"]
+    )
+
+    mock_log_processed.assert_called_once()
+    assert mock_log_processed.call_args[0][3:] == (["123"], ["test@example.com"])
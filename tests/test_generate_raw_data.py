@@ -0,0 +1,108 @@
+import datetime
+import os
+import random
+
+import jsonschema
+import pytest
+
+import customers_etl
+import products_etl
+import transactions_etl
+from benchmarks.generate_raw_data import (
+    GeneratorConfig,
+    generate_raw_data,
+    invalidate,
+    synthetic_customer,
+    synthetic_product,
+    with_noise,
+)
+from benchmarks.stub_postgres import StubConnection
+from common import extract_data
+
+CONFIG = GeneratorConfig(
+    hours=2,
+    products_per_hour=20,
+    customers_per_hour=50,
+    transactions_per_hour=100,
+    erasure_requests_per_hour=5,
+    invalid_ratio=0,
+    duplicate_ratio=0,
+)
+
+
+def test_generate_raw_data_follows_schemas(tmp_path):
+    generated = generate_raw_data(str(tmp_path), CONFIG)
+
+    assert generated.partitions == [
+        ("date=2022-01-01", "hour=00"),
+        ("date=2022-01-01", "hour=01"),
+    ]
+    assert generated.record_counts["customers.json.gz"] == 100
+    assert generated.record_counts["erasure-requests.json.gz"] == 5
+    hour_path = os.path.join(str(tmp_path), "date=2022-01-01", "hour=01")
+    for product in extract_data(os.path.join(hour_path, "products.json.gz")):
+        product["price"] = float(product["price"])
+        products_etl.PRODUCTS_VALIDATOR.validate(product)
+    for customer in extract_data(os.path.join(hour_path, "customers.json.gz")):
+        customers_etl.CUSTOMERS_VALIDATOR.validate(customer)
+    transactions = extract_data(os.path.join(hour_path, "transactions.json.gz"))
+    assert len(transactions) == 100
+    for transaction in transactions:
+        transactions_etl.TRANSACTIONS_VALIDATOR.validate(transaction)
+        assert "quanitity" in transaction["purchases"]["products"][0]
+
+
+def test_generate_raw_data_is_reproducible(tmp_path):
+    first = generate_raw_data(str(tmp_path / "first"), CONFIG)
+    second = generate_raw_data(str(tmp_path / "second"), CONFIG)
+
+    assert first == second
+
+
+def test_with_noise():
+    rng = random.Random(0)
+    records = [
+        synthetic_customer(rng, i, datetime.datetime(2022, 1, 1))
+        for i in range(1, 1001)
+    ]
+
+    noisy = with_noise(rng, records, invalid_ratio=0.1, duplicate_ratio=0.05)
+
+    invalid_count = 0
+    for record in noisy:
+        try:
+            customers_etl.CUSTOMERS_VALIDATOR.validate(record)
+        except jsonschema.ValidationError:
+            invalid_count += 1
+    assert 50 < invalid_count < 150
+    assert 20 < len(noisy) - len(records) < 80
+
+
+def test_invalidate_keeps_the_key():
+    rng = random.Random(0)
+    product = synthetic_product(rng, 7)
+
+    for _ in range(20):
+        assert invalidate(rng, product)["sku"] == 7
+
+
+def test_stub_connection_answers_lookups():
+    connection = StubConnection({1: ("2022-01-01", 0)}, skus=[10, 11])
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT record_date, record_hour FROM data.customers WHERE id = %s", (1,)
+        )
+        assert cursor.fetchone() == ("2022-01-01", 0)
+        cursor.execute("SELECT sku FROM data.products WHERE sku = ANY(%s)", ([10, 12],))
+        assert cursor.fetchall() == [(10,)]
+        cursor.execute("INSERT INTO data.products VALUES (%s)", (12,))
+        assert cursor.fetchall() == []
+    assert connection.query_count == 3
+
+
+@pytest.mark.parametrize("value", ["Babić", 1, None])
+def test_stub_cursor_mogrify(value):
+    cursor = StubConnection().cursor()
+
+    assert cursor.mogrify("SELECT %s", (value,)).startswith(b"SELECT ")
@@ -0,0 +1,160 @@
+from unittest.mock import MagicMock, patch
+import ingest_etl
+import pytest
+from ingest_etl import (
+    Pipeline,
+    partition_key_to_hour_folders,
+    process_all_data,
+    process_dataset_partition,
+    process_partitions,
+    watch,
+)
+
+
+def test_process_all_data_runs_pipelines_in_dependency_order(tmp_path):
+    for hour in ("hour=00", "hour=01"):
+        (tmp_path / "date=2022-01-01" / hour).mkdir(parents=True)
+    for filename in ("customers.json.gz", "transactions.json.gz"):
+        (tmp_path / "date=2022-01-01" / "hour=00" / filename).touch()
+    (tmp_path / "date=2022-01-01" / "hour=01" / "products.json.gz").touch()
+    (tmp_path / "date=2022-01-01" / "hour=01" / "erasure-requests.json").touch()
+
+    calls = []
+
+    def process_hourly_data(dataset_prefix):
+        def process(connection, date, hour, available_datasets):
+            calls.append((dataset_prefix, hour, available_datasets))
+            # Archive the files, like the real pipelines do
+            for filename in available_datasets:
+                (tmp_path / date / hour / filename).unlink()
+
+        return process
+
+    pipelines = [
+        Pipeline(prefix, process_hourly_data(prefix), ordered)
+        for prefix, _, ordered in ingest_etl.PIPELINES
+    ]
+    with patch.object(ingest_etl, "PIPELINES", pipelines), patch.object(
+        ingest_etl, "RAW_DATA_PATH", str(tmp_path)
+    ), patch("ingest_etl.get_ingest_watermark", return_value=None), patch(
+        "common.advance_ingest_watermark"
+    ), patch(
+        "ingest_etl.scan_hour_partitions", wraps=ingest_etl.scan_hour_partitions
+    ) as mock_scan:
+        process_all_data(MagicMock())
+
+    mock_scan.assert_called_once()
+    assert calls == [
+        ("products", "hour=01", ["products.json.gz"]),
+        ("customers", "hour=00", ["customers.json.gz"]),
+        ("transactions", "hour=00", ["transactions.json.gz"]),
+        ("erasure", "hour=01", ["erasure-requests.json"]),
+    ]
+    # The emptied directories are removed
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_process_all_data_stops_after_failed_pipeline(tmp_path):
+    (tmp_path / "date=2022-01-01" / "hour=00").mkdir(parents=True)
+    for filename in ("products.json.gz", "customers.json.gz"):
+        (tmp_path / "date=2022-01-01" / "hour=00" / filename).touch()
+    process_products = MagicMock(side_effect=RuntimeError("boom"))
+    process_customers = MagicMock()
+
+    pipelines = [
+        Pipeline("products", process_products, True),
+        Pipeline("customers", process_customers, False),
+    ]
+    with patch.object(ingest_etl, "PIPELINES", pipelines), patch.object(
+        ingest_etl, "RAW_DATA_PATH", str(tmp_path)
+    ), patch("ingest_etl.get_ingest_watermark", return_value=None):
+        process_all_data(MagicMock())
+
+    process_products.assert_called_once()
+    process_customers.assert_not_called()
+    # Directories that still hold files are kept
+    assert (tmp_path / "date=2022-01-01" / "hour=00").exists()
+
+
+def test_process_partitions_only_scans_given_hours(tmp_path):
+    for hour in ("hour=00", "hour=01"):
+        (tmp_path / "date=2022-01-01" / hour).mkdir(parents=True)
+        (tmp_path / "date=2022-01-01" / hour / "customers.json.gz").touch()
+    process_customers = MagicMock()
+
+    with patch.object(
+        ingest_etl, "PIPELINES", [Pipeline("customers", process_customers, False)]
+    ), patch.object(ingest_etl, "RAW_DATA_PATH", str(tmp_path)), patch(
+        "common.advance_ingest_watermark"
+    ) as advance_ingest_watermark:
+        process_partitions(
+            MagicMock(),
+            [("date=2022-01-01", "hour=01"), ("date=2022-01-01", "hour=02")],
+        )
+
+    # An older hour may still be waiting, so the watermark stays put
+    advance_ingest_watermark.assert_not_called()
+    process_customers.assert_called_once()
+    assert process_customers.call_args[0][1:] == (
+        "date=2022-01-01",
+        "hour=01",
+        ["customers.json.gz"],
+    )
+
+
+def test_watch_ingests_settled_partitions(tmp_path):
+    (tmp_path / "date=2022-01-01" / "hour=10").mkdir(parents=True)
+    (tmp_path / "date=2022-01-01" / "hour=10" / "customers.json.gz").touch()
+
+    with patch.object(ingest_etl, "RAW_DATA_PATH", str(tmp_path)), patch.object(
+        ingest_etl, "Observer", None
+    ), patch("ingest_etl.connect_to_postgres"), patch(
+        "ingest_etl.process_partitions"
+    ) as mock_process:
+        watch(poll_interval=0, settle_seconds=0, max_polls=3)
+
+    # The first poll only records the file, the second finds it settled
+    mock_process.assert_called_once()
+    assert mock_process.call_args[0][1] == [("date=2022-01-01", "hour=10")]
+
+
+def test_partition_key_to_hour_folders():
+    assert partition_key_to_hour_folders("2022-01-01-09:00") == (
+        "date=2022-01-01",
+        "hour=09",
+    )
+
+
+def test_process_dataset_partition(tmp_path):
+    hour_path = tmp_path / "date=2022-01-01" / "hour=09"
+    hour_path.mkdir(parents=True)
+    (hour_path / "customers.json.gz").touch()
+    (hour_path / "transactions.json.gz").touch()
+
+    def process_customers(connection, date, hour, available_datasets):
+        for filename in available_datasets:
+            (tmp_path / date / hour / filename).unlink()
+
+    pipelines = [
+        Pipeline("customers", process_customers, False),
+        Pipeline("transactions", MagicMock(side_effect=RuntimeError("boom")), False),
+    ]
+    with patch.object(ingest_etl, "PIPELINES", pipelines), patch.object(
+        ingest_etl, "RAW_DATA_PATH", str(tmp_path)
+    ), patch("common.advance_ingest_watermark") as advance_ingest_watermark:
+        assert process_dataset_partition(
+            MagicMock(), "customers", "date=2022-01-01", "hour=09"
+        ) == ["customers.json.gz"]
+        # Failures are re-raised so the partition can be retried
+        with pytest.raises(RuntimeError):
+            process_dataset_partition(
+                MagicMock(), "transactions", "date=2022-01-01", "hour=09"
+            )
+        assert (
+            process_dataset_partition(
+                MagicMock(), "customers", "date=2022-01-01", "hour=10"
+            )
+            == []
+        )
+    # Partitions can complete in any order, so the watermark stays put
+    advance_ingest_watermark.assert_not_called()
@@ -0,0 +1,72 @@
+import datetime
+from unittest.mock import MagicMock
+
+import pytest
+
+pytest.importorskip("prometheus_client")
+
+import metrics  # noqa: E402
+from common import StageStatistics, process_hour_partitions  # noqa: E402
+
+
+def sample(name, **labels):
+    return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_observe_hour():
+    stages = StageStatistics()
+    with stages.stage("extract", bytes_read=100) as counters:
+        counters["rows_out"] += 5
+    with stages.stage("validate", rows_in=5) as counters:
+        counters["rows_out"] += 3
+    processed = sample("etl_records_processed_total", dataset="customers")
+    invalid = sample("etl_records_invalid_total", dataset="customers")
+    validations = sample(
+        "etl_stage_duration_seconds_count", dataset="customers", stage="validate"
+    )
+
+    metrics.observe_hour("customers.json.gz", 3, datetime.timedelta(seconds=2), stages)
+
+    assert sample("etl_records_processed_total", dataset="customers") == processed + 3
+    assert sample("etl_records_invalid_total", dataset="customers") == invalid + 2
+    assert (
+        sample(
+            "etl_stage_duration_seconds_count", dataset="customers", stage="validate"
+        )
+        == validations + 1
+    )
+
+
+def test_backlog_follows_processed_partitions(mocker):
+    mocker.patch("common.advance_ingest_watermark")
+    backlog = []
+
+    def process_hourly_data(*args):
+        backlog.append(sample("etl_backlog_partitions", dataset="customers"))
+
+    partitions = [
+        ("date=2022-01-01", f"hour=0{h}", ["customers.json.gz"]) for h in range(3)
+    ]
+    process_hour_partitions(
+        MagicMock(), partitions, process_hourly_data, watermark_dataset="customers"
+    )
+
+    assert backlog == [3, 2, 1]
+    assert sample("etl_backlog_partitions", dataset="customers") == 0
+
+
+def test_write_textfile(tmp_path):
+    metrics.write_textfile("customers_etl", str(tmp_path))
+
+    assert "etl_records_processed" in (tmp_path / "customers_etl.prom").read_text()
+
+
+def test_serve_port_in_use(mocker):
+    mocker.patch.object(metrics, "_server_started", False)
+    start_http_server = mocker.patch.object(
+        metrics, "start_http_server", side_effect=OSError(98, "Address already in use")
+    )
+
+    assert metrics.serve(18931) is False
+    assert start_http_server.call_count == 1
+    assert metrics._server_started is False
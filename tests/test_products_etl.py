@@ -1,5 +1,5 @@
-from unittest.mock import patch
-from products_etl import process_hourly_data, process_all_data
+from unittest.mock import MagicMock, patch
+from products_etl import log_processed_products, process_hourly_data, process_all_data
 
 
 def test_process_hourly_data(mock_connection, mock_products_data, mocker):
@@ -14,24 +14,63 @@ def test_process_hourly_data(mock_connection, mock_products_data, mocker):
     # Mock the open function to avoid FileNotFoundError
     mocker.patch("builtins.open", mocker.mock_open())
 
-    with mocker.patch("products_etl.extract_data", return_value=mock_products_data):
-        process_hourly_data(mock_connection, date, hour, available_datasets)
+    mock_upsert_rows = mocker.patch("products_etl.upsert_rows")
 
-    # Assert or perform other checks as needed
+    mocker.patch(
+        "products_etl.extract_data_chunks", return_value=iter([mock_products_data])
+    )
+    mock_writer = mocker.patch("products_etl.create_processed_data_writer")
+    mocker.patch("products_etl.log_processing_statistics")
+
+    process_hourly_data(mock_connection, date, hour, available_datasets)
+
+    mock_writer.return_value.__enter__.return_value.write.assert_called_once_with(
+        mock_products_data
+    )
+
+    # Both products are valid and written with a single set-based upsert
+    mock_upsert_rows.assert_called_once()
+    assert mock_upsert_rows.call_args[0][2]["sku"] == [123, 456]
+
+
+def test_log_processed_products_updates_existing(mocker):
+    mock_execute_values = mocker.patch("common.execute_values")
+
+    log_processed_products(
+        MagicMock(),
+        "date=2022-01-01",
+        "hour=12",
+        [123],
+        ["Book"],
+        [9.5],
+        ["books"],
+        [1],
+    )
+
+    query = mock_execute_values.call_args[0][1]
+    assert query.endswith(
+        "ON CONFLICT (sku) DO UPDATE SET name = EXCLUDED.name, "
+        "price = EXCLUDED.price, category = EXCLUDED.category, "
+        "popularity = EXCLUDED.popularity, record_date = EXCLUDED.record_date, "
+        "record_hour = EXCLUDED.record_hour, processed_at = EXCLUDED.processed_at"
+    )
 
 
 def test_process_all_data(mock_connection):
-    with patch("products_etl.os.listdir", return_value=["2022-01-01"]):
-        with patch(
-            "products_etl.os.path.join", side_effect=lambda *args: "/".join(args)
-        ):
-            with patch("products_etl.os.listdir", return_value=["12"]):
-                with patch(
-                    "products_etl.os.listdir", return_value=["products.json.gz"]
-                ):
-                    process_all_data(mock_connection)
-
-    # Add assertions for the expected behavior during all data processing
+    partitions = [
+        ("date=2022-01-01", "hour=00", ["products.json.gz"]),
+        ("date=2022-01-01", "hour=01", ["products.json.gz"]),
+    ]
+    with patch("products_etl.discover_hour_partitions", return_value=partitions):
+        with patch("products_etl.process_hourly_data") as mock_process_hourly_data:
+            with patch("products_etl.cleanup_empty_directories"):
+                process_all_data(mock_connection)
+
+    # Products are applied hour by hour, in order, on the given connection
+    assert mock_process_hourly_data.call_args_list == [
+        ((mock_connection, "date=2022-01-01", "hour=00", ["products.json.gz"]),),
+        ((mock_connection, "date=2022-01-01", "hour=01", ["products.json.gz"]),),
+    ]
 
 
 # You can add more test cases for edge cases, exceptions, etc.
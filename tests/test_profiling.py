@@ -0,0 +1,60 @@
+import pstats
+from unittest.mock import patch
+
+import pytest
+
+import profiling
+
+
+@pytest.fixture
+def profile_dir(tmp_path):
+    settings = dict(profiling._settings)
+    with patch.object(profiling, "PROFILE_DIR", str(tmp_path)):
+        profiling.configure(run_id="run-1")
+        yield tmp_path
+    profiling._settings.update(settings)
+
+
+def busy_loop():
+    return sum(i * i for i in range(200000))
+
+
+def test_profiled_hour_writes_pstats(profile_dir):
+    profiling.configure("cprofile")
+
+    @profiling.profiled_hour("customers")
+    def process_hourly_data(connection, date, hour, available_datasets):
+        return busy_loop()
+
+    assert process_hourly_data(None, "date=2022-01-01", "hour=10", []) == busy_loop()
+
+    stats = pstats.Stats(str(profile_dir / "run-1" / "customers_2022-01-01_10.pstats"))
+    assert any(name == "busy_loop" for _, _, name in stats.stats)
+
+
+def test_profile_run_writes_collapsed_stacks(profile_dir):
+    profiling.configure("sampling")
+
+    with patch.object(profiling, "PROFILE_SCOPE", "run"), patch.object(
+        profiling, "SAMPLING_INTERVAL_MS", 1
+    ):
+        with profiling.profile_run("transactions"):
+            for _ in range(20):
+                busy_loop()
+
+    lines = (profile_dir / "run-1" / "transactions.collapsed").read_text().splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert any("busy_loop" in line for line in lines)
+
+
+def test_profiling_is_off_by_default(profile_dir):
+    profiling.configure("")
+
+    with profiling.profile("customers"):
+        busy_loop()
+
+    assert list(profile_dir.iterdir()) == []
+    with pytest.raises(ValueError):
+        profiling.configure("perf")
@@ -0,0 +1,22 @@
+from settings import env_flag, env_float, env_int, env_str
+
+
+def test_settings_use_environment(monkeypatch):
+    monkeypatch.setenv("TEST_SETTING", "5")
+
+    assert env_int("TEST_SETTING", 1) == 5
+    assert env_float("TEST_SETTING", 1.0) == 5.0
+    assert env_str("TEST_SETTING", "1") == "5"
+    assert env_flag("TEST_SETTING", True) is False
+
+
+def test_settings_default_when_unset_or_empty(monkeypatch):
+    monkeypatch.delenv("TEST_SETTING", raising=False)
+    assert env_int("TEST_SETTING", 1) == 1
+
+    # .env.example leaves every setting empty
+    monkeypatch.setenv("TEST_SETTING", "")
+    assert env_int("TEST_SETTING", 1) == 1
+    assert env_float("TEST_SETTING", 2.5) == 2.5
+    assert env_str("TEST_SETTING", "gzip") == "gzip"
+    assert env_flag("TEST_SETTING", True) is True
@@ -1,8 +1,13 @@
-from unittest.mock import patch
+from datetime import datetime
+from unittest.mock import MagicMock, patch
 from transactions_etl import (
+    bulk_insert_invalid_transactions,
     is_existing_product,
     are_valid_product_skus,
     is_valid_total_cost,
+    get_existing_customer_ids,
+    transform_and_validate_transactions,
+    log_processed_transactions,
     process_hourly_data,
 )
 
@@ -40,6 +45,141 @@ def test_are_valid_product_skus(mock_connection):
         assert result is True
 
 
+def test_get_existing_customer_ids(mock_connection):
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    # Initial cache load, then a lookup of the ID the cache doesn't know
+    mock_cursor.fetchall.side_effect = [[(1, datetime(2022, 1, 1))], []]
+
+    result = get_existing_customer_ids(mock_connection, {"1", "2", "not-a-number"})
+
+    assert result == {"1"}
+    assert mock_cursor.execute.call_count == 2
+    assert mock_cursor.execute.call_args[0][1][0] == [2]
+
+
+def test_transform_and_validate_transactions_prefetches_references(mock_connection):
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    loaded_at = datetime(2022, 1, 1)
+    # Cache loads of customers and products, then lookups of the unknown keys
+    mock_cursor.fetchall.side_effect = [
+        [(1, loaded_at)],
+        [],
+        [(10, loaded_at)],
+        [],
+        [],
+        [],
+    ]
+
+    def transaction(transaction_id, customer_id, sku):
+        return {
+            "transaction_id": transaction_id,
+            "transaction_time": "2022-01-01T01:00:00",
+            "customer_id": customer_id,
+            "delivery_address": {
+                "address": "Street 1",
+                "postcode": "10000",
+                "city": "Zagreb",
+                "country": "Croatia",
+            },
+            "purchases": {
+                "products": [
+                    {"sku": sku, "quanitity": 2, "price": "5.00", "total": "10.00"}
+                ],
+                "total_cost": "10.00",
+            },
+        }
+
+    transactions = [
+        transaction("a", "1", 10),
+        transaction("b", "2", 10),
+        transaction("c", "1", 20),
+    ]
+
+    with patch("transactions_etl.bulk_insert_invalid_transactions") as mock_invalid:
+        result = transform_and_validate_transactions(
+            mock_connection, transactions, "date=2022-01-01", "hour=01"
+        )
+
+        assert [t["transaction_id"] for t in result] == ["a"]
+        # Two queries per reference table, regardless of batch size
+        assert mock_cursor.execute.call_count == 4
+        errors = [error for _, error, _, _ in mock_invalid.call_args[0][1]]
+        assert errors == ["Invalid customer_id: 2", "Invalid product skus"]
+
+        # A warm cache only looks up the keys it doesn't know
+        transform_and_validate_transactions(
+            mock_connection, transactions, "date=2022-01-01", "hour=01"
+        )
+        assert mock_cursor.execute.call_count == 6
+
+
+def test_log_processed_transactions_copies_batch(mock_connection):
+    mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+    copied = {}
+    mock_cursor.copy_expert.side_effect = lambda sql, buffer: copied.update(
+        {sql.split()[1]: buffer.read()}
+    )
+    transactions = [
+        {
+            "transaction_id": "a",
+            "transaction_time": "2022-01-01T01:00:00",
+            "customer_id": "1",
+            "delivery_address": {
+                "address": "Street 1",
+                "postcode": "",
+                "city": "Zagreb",
+                "country": "Croatia",
+            },
+            "purchases": {
+                "products": [
+                    {"sku": 10, "quanitity": 2, "price": "5.00", "total": "10.00"},
+                    {"sku": 20, "quanitity": 1, "price": "1.00", "total": "1.00"},
+                ],
+                "total_cost": "11.00",
+            },
+        }
+    ]
+
+    log_processed_transactions(
+        mock_connection, "date=2022-01-01", "hour=01", transactions
+    )
+
+    assert copied == {
+        "staging_transactions": "a,2022-01-01T01:00:00,1,2022-01-01,1\n",
+        "staging_delivery_addresses": "a,Street 1,,Zagreb,Croatia\n",
+        "staging_purchases": "a,10,2,5.00,10.00\na,20,1,1.00,1.00\n",
+    }
+    # Staging DDL and a single merge statement, no per-row statements
+    assert mock_cursor.execute.call_count == 2
+    assert "ON CONFLICT (transaction_id) DO NOTHING" in (
+        mock_cursor.execute.call_args[0][0]
+    )
+    mock_connection.commit.assert_called_once()
+
+
+def test_bulk_insert_invalid_transactions_keeps_each_error(mocker):
+    mock_execute_values = mocker.patch("common.execute_values")
+    transaction = {"transaction_id": "a", "customer_id": 1}
+
+    bulk_insert_invalid_transactions(
+        MagicMock(),
+        [
+            (transaction, "Invalid total cost", "date=2022-01-01", "hour=01"),
+            (transaction, "Duplicate transaction_id", "date=2022-01-01", "hour=01"),
+        ],
+    )
+
+    query, rows = mock_execute_values.call_args[0][1:]
+    assert query.endswith(
+        "ON CONFLICT (transaction_id, record_date, record_hour, md5(error_message)) "
+        "DO UPDATE SET customer_id = EXCLUDED.customer_id"
+    )
+    assert [row[-1] for row in rows] == [
+        "Invalid total cost",
+        "Duplicate transaction_id",
+    ]
+
+
 def test_is_valid_total_cost():
     products = [{"price": 10, "quanitity": 2}, {"price": 5, "quanitity": 3}]
     result = is_valid_total_cost(products, "35")
@@ -47,16 +187,39 @@ def test_is_valid_total_cost():
 
 
 def test_process_hourly_data(mock_connection):
-    with patch(
-        "transactions_etl.extract_data", return_value=[{"transaction_id": "123"}]
-    ):
+    chunks = [[{"transaction_id": "1"}], [{"transaction_id": "2"}]]
+    with patch("transactions_etl.extract_data_chunks", return_value=iter(chunks)):
         with patch(
             "transactions_etl.transform_and_validate_transactions",
-            return_value=[{"transaction_id": "123"}],
-        ):
-            with patch("transactions_etl.load_data"):
-                with patch("transactions_etl.log_processed_transactions"):
-                    with patch("transactions_etl.archive_and_delete"):
+            side_effect=lambda connection, chunk, *args: chunk,
+        ) as mock_transform:
+            with patch("transactions_etl.create_processed_data_writer") as mock_writer:
+                with patch(
+                    "transactions_etl.log_processed_transactions"
+                ) as mock_log_processed:
+                    with patch("transactions_etl.archive_and_delete"), patch(
+                        "transactions_etl.log_processing_statistics"
+                    ) as mock_statistics:
                         process_hourly_data(
                             mock_connection, "2022-01-01", "01", ["transactions.json"]
                         )
+
+    # Each chunk is validated, written and logged on its own, sharing the
+    # set of transaction ids seen so far
+    writer = mock_writer.return_value.__enter__.return_value
+    assert [c[0][0] for c in writer.write.call_args_list] == chunks
+    assert [c[0][3] for c in mock_log_processed.call_args_list] == chunks
+    seen_ids = [c[0][4] for c in mock_transform.call_args_list]
+    assert seen_ids[0] is seen_ids[1]
+
+    # Every stage of the hour is logged with the hour's statistics
+    stages = mock_statistics.call_args[1]["stages"]
+    assert [row[0] for row in stages.rows()] == [
+        "extract",
+        "validate",
+        "write",
+        "load",
+        "archive",
+    ]
+    assert stages.stages["validate"]["calls"] == 2
+    assert stages.stages["validate"]["rows_out"] == 2
@@ -1,9 +1,11 @@
-from dagster import graph, op
+from dagster import Field, graph, op
+import profiling
 from transactions_etl import main
 
 
-@op
-def process_transactions_op():
+@op(config_schema={"profiler": Field(str, default_value=profiling.PROFILER)})
+def process_transactions_op(context):
+    profiling.configure(context.op_config["profiler"], context.run_id)
     main()
 
 
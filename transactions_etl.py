@@ -4,21 +4,31 @@ import os
 from datetime import datetime
 from dotenv import load_dotenv
 import jsonschema
-from jsonschema import validate
+import metrics
+import profiling
 from common import (
-    load_data,
+    dataset_file_paths,
+    create_processed_data_writer,
     archive_and_delete,
     extract_actual_date,
     extract_actual_hour,
     connect_to_postgres,
-    extract_data,
+    extract_data_chunks,
     log_processing_statistics,
+    StageStatistics,
     cleanup_empty_directories,
+    get_reference_cache,
+    copy_rows,
+    upsert_rows,
+    discover_hour_partitions,
+    process_hour_partitions,
+    processed_dataset_type,
+    get_files_size,
+    SchemaValidator,
 )
+import columnar_validation
 import psycopg2
-import cProfile
-from typing import Any, List, Dict, Tuple
-
+from typing import Any, List, Dict, Optional, Set, Tuple
 
 load_dotenv()
 
@@ -36,6 +46,9 @@ TRANSACTIONS_SCHEMA_FILE = "transactions_schema.json"
 with open(TRANSACTIONS_SCHEMA_FILE, "r") as schema_file:
     TRANSACTIONS_SCHEMA = json.load(schema_file)
 
+# Build the validator once and reuse it for every record
+TRANSACTIONS_VALIDATOR = SchemaValidator(TRANSACTIONS_SCHEMA)
+
 
 def is_existing_customer(connection: Any, customer_id: str) -> bool:
     """
@@ -107,6 +120,85 @@ def are_valid_product_skus(connection: Any, products: List[Dict[str, Any]]) -> b
     return True
 
 
+def get_existing_customer_ids(connection: Any, customer_ids: Set[str]) -> Set[str]:
+    """
+    Fetch which of the given customer IDs exist in the customer dataset.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        customer_ids (Set[str]): Distinct customer IDs referenced by a batch.
+
+    Returns:
+        Set[str]: The subset of customer IDs that exist.
+    """
+    # data.customers.id is an INTEGER column, so IDs that don't parse can't exist
+    numeric_ids = {}
+    for customer_id in customer_ids:
+        try:
+            numeric_ids[customer_id] = int(customer_id)
+        except (TypeError, ValueError):
+            continue
+
+    existing_ids = get_reference_cache("customers").lookup(
+        connection, set(numeric_ids.values())
+    )
+
+    return {
+        customer_id
+        for customer_id, numeric_id in numeric_ids.items()
+        if numeric_id in existing_ids
+    }
+
+
+def get_existing_product_skus(connection: Any, skus: Set[int]) -> Set[int]:
+    """
+    Fetch which of the given product SKUs exist in the product dataset.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        skus (Set[int]): Distinct product SKUs referenced by a batch.
+
+    Returns:
+        Set[int]: The subset of product SKUs that exist.
+    """
+    return get_reference_cache("products").lookup(connection, skus)
+
+
+def prefetch_reference_data(
+    connection: Any, transactions_data: List[Dict[str, Any]]
+) -> Tuple[Set[str], Set[int]]:
+    """
+    Collect the distinct customer IDs and product SKUs referenced by a batch
+    of transactions and fetch the ones that exist.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        transactions_data (List[Dict[str, Any]]): List of transaction records.
+
+    Returns:
+        Tuple[Set[str], Set[int]]: Existing customer IDs and existing product SKUs.
+    """
+    customer_ids = set()
+    skus = set()
+    for transaction in transactions_data:
+        if not isinstance(transaction, dict):
+            continue
+        customer_id = transaction.get("customer_id")
+        if isinstance(customer_id, str):
+            customer_ids.add(customer_id)
+        purchases = transaction.get("purchases")
+        products = purchases.get("products") if isinstance(purchases, dict) else None
+        for product in products if isinstance(products, list) else []:
+            sku = product.get("sku") if isinstance(product, dict) else None
+            if isinstance(sku, int) and not isinstance(sku, bool):
+                skus.add(sku)
+
+    return (
+        get_existing_customer_ids(connection, customer_ids),
+        get_existing_product_skus(connection, skus),
+    )
+
+
 def is_valid_total_cost(products: List[Dict[str, Any]], total_cost: str) -> bool:
     """
     Check if the total cost matches the sum of individual product costs.
@@ -135,28 +227,46 @@ def bulk_insert_invalid_transactions(
         connection (Any): The PostgreSQL connection.
         invalid_transactions (List[Tuple[Dict[str, Any], str, str, str]]): List of tuples containing invalid transaction details.
     """
+    if not invalid_transactions:
+        return
+
+    transactions = [transaction for transaction, _, _, _ in invalid_transactions]
     with connection.cursor() as cursor:
-        cursor.executemany(
-            """
-            INSERT INTO data.invalid_transactions (record_date, record_hour, transaction_id, customer_id, error_message)
-            VALUES (%s, %s, %s, %s, %s);
-        """,
-            [
-                (
-                    extract_actual_date(date),
-                    extract_actual_hour(hour),
-                    t.get("transaction_id"),
-                    t.get("customer_id"),
-                    error_message,
-                )
-                for t, error_message, date, hour in invalid_transactions
-            ],
+        upsert_rows(
+            cursor,
+            "data.invalid_transactions",
+            {
+                "record_date": [
+                    extract_actual_date(date) for _, _, date, _ in invalid_transactions
+                ],
+                "record_hour": [
+                    extract_actual_hour(hour) for _, _, _, hour in invalid_transactions
+                ],
+                "transaction_id": [t.get("transaction_id") for t in transactions],
+                "customer_id": [t.get("customer_id") for t in transactions],
+                "error_message": [error for _, error, _, _ in invalid_transactions],
+            },
+            # One row per transaction and error, so that an hour can be
+            # reprocessed without duplicating them. Schema errors can be
+            # longer than a btree index row, so the index hashes the message.
+            conflict_columns=(
+                "transaction_id",
+                "record_date",
+                "record_hour",
+                "error_message",
+            ),
+            update_columns=("customer_id",),
+            conflict_expressions={"error_message": "md5(error_message)"},
         )
     connection.commit()
 
 
 def transform_and_validate_transactions(
-    connection: Any, transactions_data: List[Dict[str, Any]], date: str, hour: str
+    connection: Any,
+    transactions_data: List[Dict[str, Any]],
+    date: str,
+    hour: str,
+    unique_transaction_ids: Optional[Set[str]] = None,
 ) -> List[Dict[str, Any]]:
     """
     Transform and validate transactions data.
@@ -166,20 +276,32 @@ def transform_and_validate_transactions(
         transactions_data (List[Dict[str, Any]]): List of transaction records.
         date (str): The date of the transactions.
         hour (str): The hour of the transactions.
+        unique_transaction_ids (Optional[Set[str]]): Transaction ids already seen in earlier chunks of the same file.
 
     Returns:
         List[Dict[str, Any]]: List of valid transactions.
     """
-    schema = TRANSACTIONS_SCHEMA
+    if unique_transaction_ids is None:
+        unique_transaction_ids = set()
+
+    if columnar_validation.is_enabled():
+        return transform_and_validate_transactions_columnar(
+            connection, transactions_data, date, hour, unique_transaction_ids
+        )
 
     valid_transactions = []
     invalid_transactions = []
-    unique_transaction_ids = set()
+
+    # Prefetch the referenced customers and products with one query each,
+    # so the checks below are in-memory lookups instead of per-row queries
+    existing_customer_ids, existing_skus = prefetch_reference_data(
+        connection, transactions_data
+    )
 
     # Validate each transaction record against the schema
     for transaction in transactions_data:
         try:
-            validate(instance=transaction, schema=schema)
+            TRANSACTIONS_VALIDATOR.validate(transaction)
 
             # Check uniqueness of transaction_id
             transaction_id = transaction.get("transaction_id")
@@ -195,7 +317,7 @@ def transform_and_validate_transactions(
 
             # Check if customer_id refers to an existing customer
             customer_id = transaction.get("customer_id")
-            if not is_existing_customer(connection, customer_id):
+            if customer_id not in existing_customer_ids:
                 # Log or handle invalid customer_id
                 logger.debug(f"Invalid customer_id found: {customer_id}")
                 invalid_transactions.append(
@@ -204,8 +326,9 @@ def transform_and_validate_transactions(
                 continue
 
             # Check if product skus correspond to existing products
-            if not are_valid_product_skus(
-                connection, transaction.get("purchases", {}).get("products", [])
+            if any(
+                product.get("sku") not in existing_skus
+                for product in transaction.get("purchases", {}).get("products", [])
             ):
                 # Log or handle invalid product skus
                 logger.debug(
@@ -244,91 +367,218 @@ def transform_and_validate_transactions(
     return valid_transactions
 
 
+def transform_and_validate_transactions_columnar(
+    connection: Any,
+    transactions_data: List[Dict[str, Any]],
+    date: str,
+    hour: str,
+    unique_transaction_ids: Set[str],
+) -> List[Dict[str, Any]]:
+    """
+    Transform and validate transactions data with the columnar checks.
+
+    Records are validated against the schema one by one; the business rules
+    are then checked for the whole batch at once. Produces the same valid
+    records and error messages as the row-by-row validation.
+
+    Args:
+        connection (Any): The PostgreSQL connection.
+        transactions_data (List[Dict[str, Any]]): List of transaction records.
+        date (str): The date of the transactions.
+        hour (str): The hour of the transactions.
+        unique_transaction_ids (Set[str]): Transaction ids already seen in earlier chunks of the same file.
+
+    Returns:
+        List[Dict[str, Any]]: List of valid transactions.
+    """
+    existing_customer_ids, existing_skus = prefetch_reference_data(
+        connection, transactions_data
+    )
+
+    # Schema errors are kept by position so invalid records are logged in file order
+    schema_errors = {}
+    schema_valid_transactions = []
+    for index, transaction in enumerate(transactions_data):
+        try:
+            TRANSACTIONS_VALIDATOR.validate(transaction)
+            schema_valid_transactions.append(transaction)
+        except jsonschema.exceptions.ValidationError as e:
+            logger.error(f"Validation error for transaction: {e}")
+            schema_errors[index] = str(e)
+
+    valid_mask, reasons = columnar_validation.validate_transactions(
+        schema_valid_transactions,
+        existing_customer_ids,
+        existing_skus,
+        unique_transaction_ids,
+    )
+
+    valid_transactions = []
+    invalid_transactions = []
+    position = 0
+    for index, transaction in enumerate(transactions_data):
+        if index in schema_errors:
+            invalid_transactions.append((transaction, schema_errors[index], date, hour))
+            continue
+        if valid_mask[position]:
+            valid_transactions.append(transaction)
+        else:
+            error_message = columnar_validation.reason_message(
+                reasons[position], transaction
+            )
+            logger.debug(
+                f"{error_message} in transaction_id: {transaction['transaction_id']}"
+            )
+            invalid_transactions.append((transaction, error_message, date, hour))
+        position += 1
+
+    # Bulk insert invalid transactions
+    bulk_insert_invalid_transactions(connection, invalid_transactions)
+
+    return valid_transactions
+
+
+STAGING_TABLES_DDL = """
+    CREATE TEMP TABLE staging_transactions (
+        transaction_id UUID,
+        transaction_time TIMESTAMP WITH TIME ZONE,
+        customer_id INTEGER,
+        record_date DATE,
+        record_hour INTEGER
+    ) ON COMMIT DROP;
+
+    CREATE TEMP TABLE staging_delivery_addresses (
+        transaction_id UUID,
+        address TEXT,
+        postcode TEXT,
+        city TEXT,
+        country TEXT
+    ) ON COMMIT DROP;
+
+    CREATE TEMP TABLE staging_purchases (
+        transaction_id UUID,
+        product_sku INTEGER,
+        quantity INTEGER,
+        price NUMERIC(10, 2),
+        total NUMERIC(10, 2)
+    ) ON COMMIT DROP;
+"""
+
+# Child rows are only merged for transactions that were actually inserted, so
+# transactions already present in the database are skipped as a whole
+MERGE_STAGED_TRANSACTIONS = """
+    WITH inserted_transactions AS (
+        INSERT INTO data.transactions (transaction_id, transaction_time, customer_id, record_date, record_hour)
+        SELECT transaction_id, transaction_time, customer_id, record_date, record_hour
+        FROM staging_transactions
+        ON CONFLICT (transaction_id) DO NOTHING
+        RETURNING transaction_id
+    ), inserted_delivery_addresses AS (
+        INSERT INTO data.delivery_addresses (transaction_id, address, postcode, city, country)
+        SELECT s.transaction_id, s.address, s.postcode, s.city, s.country
+        FROM staging_delivery_addresses s
+        JOIN inserted_transactions USING (transaction_id)
+    )
+    INSERT INTO data.purchases (transaction_id, product_sku, quantity, price, total)
+    SELECT s.transaction_id, s.product_sku, s.quantity, s.price, s.total
+    FROM staging_purchases s
+    JOIN inserted_transactions USING (transaction_id);
+"""
+
+
 def log_processed_transactions(
     connection: Any, date: str, hour: str, transactions: List[Dict[str, Any]]
 ) -> None:
     """
     Log processed transactions to the database.
 
+    The batch is streamed into temporary staging tables with COPY and merged
+    into data.transactions, data.delivery_addresses and data.purchases with a
+    single set-based statement, skipping transactions that already exist.
+
     Args:
         connection (Any): The PostgreSQL connection.
         date (str): The date of the transactions.
         hour (str): The hour of the transactions.
         transactions (List[Dict[str, Any]]): List of processed transactions.
     """
-    with connection.cursor() as cursor:
-        for transaction in transactions:
-            transaction_id = transaction.get("transaction_id")
-            record_date = extract_actual_date(date)
-            record_hour = extract_actual_hour(hour)
-
-            # Check if the transaction_id already exists
-            cursor.execute(
-                """
-                SELECT COUNT(*) FROM data.transactions
-                WHERE transaction_id = %s;
-            """,
-                (transaction_id,),
+    if not transactions:
+        return
+
+    record_date = extract_actual_date(date)
+    record_hour = extract_actual_hour(hour)
+
+    transaction_rows = []
+    delivery_address_rows = []
+    purchase_rows = []
+    for transaction in transactions:
+        transaction_id = transaction.get("transaction_id")
+        transaction_rows.append(
+            (
+                transaction_id,
+                transaction.get("transaction_time"),
+                transaction.get("customer_id"),
+                record_date,
+                record_hour,
             )
+        )
 
-            if cursor.fetchone()[0] > 0:
-                logger.debug(f"Duplicate transaction_id found: {transaction_id}")
-                # Log or handle duplicate transaction_id
-                continue
-
-            # Insert transaction data
-            cursor.execute(
-                """
-                INSERT INTO data.transactions (transaction_id, transaction_time, customer_id, record_date, record_hour)
-                VALUES (%s, %s, %s, %s, %s);
-            """,
+        delivery_address = transaction.get("delivery_address")
+        if delivery_address:
+            delivery_address_rows.append(
                 (
                     transaction_id,
-                    transaction.get("transaction_time"),
-                    transaction.get("customer_id"),
-                    record_date,
-                    record_hour,
-                ),
+                    delivery_address.get("address"),
+                    delivery_address.get("postcode"),
+                    delivery_address.get("city"),
+                    delivery_address.get("country"),
+                )
             )
 
-            # Insert delivery address data
-            delivery_address = transaction.get("delivery_address")
-            if delivery_address:
-                cursor.execute(
-                    """
-                    INSERT INTO data.delivery_addresses (transaction_id, address, postcode, city, country)
-                    VALUES (%s, %s, %s, %s, %s);
-                """,
-                    (
-                        transaction_id,
-                        delivery_address.get("address"),
-                        delivery_address.get("postcode"),
-                        delivery_address.get("city"),
-                        delivery_address.get("country"),
-                    ),
+        for purchase in transaction.get("purchases", {}).get("products", []):
+            purchase_rows.append(
+                (
+                    transaction_id,
+                    purchase.get("sku"),
+                    purchase.get("quanitity"),
+                    purchase.get("price"),
+                    purchase.get("total"),
                 )
+            )
 
-            # Insert purchases data
-            purchases = transaction.get("purchases", {}).get("products", [])
-            for purchase in purchases:
-                cursor.execute(
-                    """
-                    INSERT INTO data.purchases (transaction_id, product_sku, quantity, price, total)
-                    VALUES (%s, %s, %s, %s, %s);
-                """,
-                    (
-                        transaction_id,
-                        purchase.get("sku"),
-                        purchase.get("quanitity"),
-                        purchase.get("price"),
-                        purchase.get("total"),
-                    ),
-                )
+    with connection.cursor() as cursor:
+        cursor.execute(STAGING_TABLES_DDL)
+        copy_rows(
+            cursor,
+            "staging_transactions",
+            (
+                "transaction_id",
+                "transaction_time",
+                "customer_id",
+                "record_date",
+                "record_hour",
+            ),
+            transaction_rows,
+        )
+        copy_rows(
+            cursor,
+            "staging_delivery_addresses",
+            ("transaction_id", "address", "postcode", "city", "country"),
+            delivery_address_rows,
+        )
+        copy_rows(
+            cursor,
+            "staging_purchases",
+            ("transaction_id", "product_sku", "quantity", "price", "total"),
+            purchase_rows,
+        )
+        cursor.execute(MERGE_STAGED_TRANSACTIONS)
 
     connection.commit()
     logger.debug(f"Data loaded successfully for transactions ({date}/{hour}).")
 
 
+@profiling.profiled_hour("transactions")
 def process_hourly_data(
     connection: Any, date: str, hour: str, available_datasets: List[str]
 ) -> None:
@@ -350,25 +600,56 @@ def process_hourly_data(
     # Record the start time
     start_time = datetime.now()
 
-    # Extract raw_data
-    transactions_data = extract_data(dataset_paths.get("transactions.json.gz", ""))
-
-    # Transform and validate raw_data
-    transformed_transactions = transform_and_validate_transactions(
-        connection, transactions_data, date, hour
-    )
-
-    # Load processed raw_data
-    load_data(
-        transformed_transactions,
-        "transactions.json.gz",
+    # Extract, transform, validate and load raw_data chunk by chunk
+    stages = StageStatistics()
+    unique_transaction_ids = set()
+    record_count = 0
+    # Raw files may come with any of the supported compressions
+    transactions_paths = dataset_file_paths(dataset_paths, "transactions")
+    stages.counters("extract")["bytes_read"] += get_files_size(transactions_paths)
+    with create_processed_data_writer(
+        processed_dataset_type("transactions"),
         date,
         hour,
         PROCESSED_DATA_PATH,
-    )
+        TRANSACTIONS_SCHEMA,
+    ) as writer:
+        for transactions_data in stages.iterate(
+            "extract",
+            (
+                chunk
+                for path in transactions_paths
+                for chunk in extract_data_chunks(path)
+            ),
+        ):
+            with stages.stage(
+                "validate", connection, rows_in=len(transactions_data)
+            ) as counters:
+                transformed_transactions = transform_and_validate_transactions(
+                    connection, transactions_data, date, hour, unique_transaction_ids
+                )
+                counters["rows_out"] += len(transformed_transactions)
+
+            # Load processed raw_data
+            with stages.stage("write", rows_in=len(transformed_transactions)):
+                writer.write(transformed_transactions)
+
+            # Log processed transactions
+            with stages.stage(
+                "load", connection, rows_in=len(transformed_transactions)
+            ):
+                log_processed_transactions(
+                    connection, date, hour, transformed_transactions
+                )
+            record_count += len(transformed_transactions)
 
-    # Log processed transactions
-    log_processed_transactions(connection, date, hour, transformed_transactions)
+    # Archive and delete the original files
+    bytes_in = get_files_size(dataset_paths.values())
+    with stages.stage("archive", rows_in=len(dataset_paths)):
+        for dataset_type, dataset_path in dataset_paths.items():
+            archive_and_delete(
+                dataset_path, dataset_type, date, hour, ARCHIVED_DATA_PATH
+            )
 
     # Record the end time
     end_time = datetime.now()
@@ -380,13 +661,13 @@ def process_hourly_data(
         date,
         hour,
         "transactions.json.gz",
-        len(transformed_transactions),
+        record_count,
         processing_time,
+        bytes_in=bytes_in,
+        bytes_out=writer.bytes_written,
+        compression_time=writer.compression_time,
+        stages=stages,
     )
-
-    # Archive and delete the original files
-    for dataset_type, dataset_path in dataset_paths.items():
-        archive_and_delete(dataset_path, dataset_type, date, hour, ARCHIVED_DATA_PATH)
     logger.debug("Processing completed.")
 
 
@@ -397,34 +678,14 @@ def process_all_data(connection: Any) -> None:
     Args:
         connection (Any): The PostgreSQL connection.
     """
-    # Get a sorted list of date folders
     try:
-        date_folders = os.listdir(RAW_DATA_PATH)
-        date_folders.sort()
-        # Process all available raw_data
-        for date_folder in date_folders:
-            date_path = os.path.join(RAW_DATA_PATH, date_folder)
-
-            # Get a sorted list of hour folders
-            hour_folders = os.listdir(date_path)
-            hour_folders.sort()
-
-            for hour_folder in hour_folders:
-                hour_path = os.path.join(date_path, hour_folder)
-
-                available_datasets = [
-                    filename
-                    for filename in os.listdir(hour_path)
-                    if filename.startswith("transactions")
-                    and filename.endswith((".json", ".json.gz"))
-                ]
-
-                if available_datasets:
-                    process_hourly_data(
-                        connection, date_folder, hour_folder, available_datasets
-                    )
-                else:
-                    logger.warning(f"No datasets found for {date_folder}/{hour_folder}")
+        partitions = discover_hour_partitions(connection, RAW_DATA_PATH, "transactions")
+        process_hour_partitions(
+            connection,
+            partitions,
+            process_hourly_data,
+            watermark_dataset="transactions",
+        )
 
         # Clean up empty directories in raw_data after processing
         cleanup_empty_directories(RAW_DATA_PATH)
@@ -438,13 +699,16 @@ def main() -> None:
     Main function to run the data processing pipeline.
     """
     try:
-        with connect_to_postgres() as connection:
+        with profiling.profile_run("transactions"), connect_to_postgres() as connection:
             process_all_data(connection)
     except psycopg2.Error:
         logger.exception("An error occurred while processing data")
     except Exception:
         logger.exception("An error occurred")
+    finally:
+        # Publish this run's metrics for the textfile collector
+        metrics.write_textfile("transactions_etl")
 
 
 if __name__ == "__main__":
-    cProfile.run("main()", sort="cumulative")
+    main()